@@ -0,0 +1,135 @@
+# Copyright Tom Westerhout (c) 2018
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of Tom Westerhout nor the names of other
+#       contributors may be used to endorse or promote products derived
+#       from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Helpers shared by the benchmarks: timing, (de)serialisation of the results
+and comparison against a stored baseline.
+"""
+
+import json
+import logging
+import math
+import platform
+import time
+from typing import Callable, Dict, List, Optional
+
+
+def measure(
+    fn: Callable[[], None], setup: Optional[Callable[[], None]] = None, repeat: int = 5
+) -> Dict[str, float]:
+    """
+    Times ``fn``. ``setup`` (if given) is run before every repetition and is
+    not included in the timings. One untimed call is done first to trigger
+    JIT compilation and warm up the caches.
+
+    :return: a dict with the minimal, mean and standard deviation of the run
+             time (in seconds) over ``repeat`` runs.
+    """
+    if setup is not None:
+        setup()
+    fn()
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    mean = sum(times) / len(times)
+    std = math.sqrt(sum((t - mean) ** 2 for t in times) / len(times))
+    return {"min": min(times), "mean": mean, "std": std, "repeat": repeat}
+
+
+def make_key(record: Dict) -> str:
+    """
+    Returns a string uniquely identifying a benchmark record, e.g.
+    ``"log_wf[net=rbm,n=24,batch=16]"``.
+    """
+    params = ",".join(
+        "{}={}".format(k, v) for (k, v) in sorted(record["params"].items())
+    )
+    return "{}[{}]".format(record["name"], params)
+
+
+def save_results(out_file, records: List[Dict]):
+    """
+    Writes the results as JSON to the already opened ``out_file``.
+    """
+    json.dump(
+        {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "node": platform.node(),
+            },
+            "results": records,
+        },
+        out_file,
+        indent=2,
+    )
+    out_file.write("\n")
+
+
+def load_results(in_file) -> Dict[str, Dict]:
+    """
+    Reads results written by :py:func:`save_results` and returns them as a
+    dict mapping :py:func:`make_key` to the record.
+    """
+    return {make_key(r): r for r in json.load(in_file)["results"]}
+
+
+def compare(records: List[Dict], baseline: Dict[str, Dict], tolerance: float) -> int:
+    """
+    Compares ``records`` against ``baseline`` using minimal run times, logs a
+    table and returns the number of regressions, i.e. benchmarks which got
+    slower by more than a factor ``1 + tolerance``.
+    """
+    regressions = 0
+    for record in records:
+        key = make_key(record)
+        old = baseline.get(key)
+        if old is None:
+            logging.info("{:<60} {:>12.3e}s        (new)".format(key, record["min"]))
+            continue
+        ratio = record["min"] / old["min"]
+        if ratio > 1 + tolerance:
+            status = "SLOWER"
+            regressions += 1
+        elif ratio < 1 / (1 + tolerance):
+            status = "faster"
+        else:
+            status = ""
+        logging.info(
+            "{:<60} {:>12.3e}s  x{:<6.2f} {}".format(key, record["min"], ratio, status)
+        )
+    return regressions
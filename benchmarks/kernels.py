@@ -0,0 +1,322 @@
+# Copyright Tom Westerhout (c) 2018
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of Tom Westerhout nor the names of other
+#       contributors may be used to endorse or promote products derived
+#       from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Micro-benchmarks for the hot kernels of :py:mod:`nqs_playground.Trial`.
+
+Run them from the root of the repository::
+
+    python -m benchmarks.kernels -o results.json
+
+Results are written as JSON and, if a baseline file exists, compared against
+it. Use ``--save-baseline`` to (re)create the baseline on a given machine.
+"""
+
+import logging
+import os
+import sys
+from typing import Dict, List
+
+import click
+import numpy as np
+import torch
+
+from nqs_playground import lattice, model, rbm
+from nqs_playground.functional import logcosh
+from nqs_playground.Trial import (
+    _make_machine,
+    from_bytes,
+    random_spin,
+    to_bytes,
+    Covariance,
+    Heisenberg,
+    MonteCarloState,
+)
+from benchmarks.common import compare, load_results, make_key, measure, save_results
+
+NETWORKS = {"model": model.Net, "rbm": rbm.Net}
+
+KERNELS = [
+    "to_bytes",
+    "from_bytes",
+    "logcosh_forward",
+    "logcosh_backward",
+    "log_wf",
+    "der_log_wf",
+    "heisenberg",
+    "covariance_solve",
+]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline_kernels.json")
+
+
+def _random_spins(n: int, batch: int) -> List[np.ndarray]:
+    magnetisation = 0 if n % 2 == 0 else 1
+    return [random_spin(n, magnetisation) for _ in range(batch)]
+
+
+def bench_bytes(n: int, spins: List[np.ndarray], repeat: int) -> Dict[str, Dict]:
+    """
+    Times :py:func:`to_bytes` and :py:func:`from_bytes` on a batch of spins.
+    """
+    packed = [to_bytes(s).tobytes() for s in spins]
+    return {
+        "to_bytes": measure(lambda: [to_bytes(s) for s in spins], repeat=repeat),
+        "from_bytes": measure(
+            lambda: [from_bytes(b, n) for b in packed], repeat=repeat
+        ),
+    }
+
+
+def bench_logcosh(n: int, batch: int, repeat: int) -> Dict[str, Dict]:
+    """
+    Times forward and backward passes of :py:func:`logcosh` on a
+    ``batch × 5n`` input, i.e. what ``rbm.Net`` with α = 2.5 sees.
+    """
+    z = torch.randn(batch, 5 * n, dtype=torch.float32)
+    with torch.no_grad():
+        forward = measure(lambda: logcosh(z), repeat=repeat)
+    z.requires_grad_(True)
+    graph = {}
+
+    def setup():
+        graph["out"] = logcosh(z)
+        graph["dout"] = torch.ones_like(graph["out"])
+
+    def run():
+        graph["out"].backward(graph["dout"])
+
+    return {"logcosh_forward": forward, "logcosh_backward": measure(run, setup, repeat)}
+
+
+def bench_machine(
+    Net, n: int, spins: List[np.ndarray], repeat: int, kernels: List[str]
+) -> Dict[str, Dict]:
+    """
+    Times ``Machine.log_wf``, ``Machine.der_log_wf``, ``Heisenberg.__call__``
+    and ``Covariance.solve`` for a ``Machine`` built from ``Net``. The cache
+    of the machine is cleared before every repetition so that we measure the
+    actual evaluation rather than dictionary lookups.
+    """
+    machine = _make_machine(Net)(n)
+    results = {}
+    if "log_wf" in kernels:
+        results["log_wf"] = measure(
+            lambda: [machine.log_wf(s) for s in spins], machine.clear_cache, repeat
+        )
+    if "der_log_wf" in kernels:
+        out = np.empty((machine.size,), dtype=np.complex64)
+        results["der_log_wf"] = measure(
+            lambda: [machine.der_log_wf(s, out) for s in spins],
+            machine.clear_cache,
+            repeat,
+        )
+    if "heisenberg" in kernels:
+        hamiltonian = Heisenberg(lattice.chain(n))
+        states = []
+
+        def setup():
+            machine.clear_cache()
+            states[:] = [MonteCarloState(machine, s) for s in spins]
+            machine.clear_cache()
+
+        results["heisenberg"] = measure(
+            lambda: [hamiltonian(s) for s in states], setup, repeat
+        )
+    if "covariance_solve" in kernels:
+        # Using actual gradients rather than random numbers to get a
+        # realistically conditioned S.
+        machine.clear_cache()
+        gradients = np.array([machine.der_log_wf(s) for s in spins], dtype=np.complex64)
+        energies = np.random.normal(-0.4 * n, 1.0, size=len(spins)).astype(np.complex64)
+        mean_O = np.mean(gradients, axis=0)
+        force = np.mean(energies * gradients.conj().transpose(), axis=1)
+        force -= mean_O.conj() * np.mean(energies)
+        results["covariance_solve"] = measure(
+            lambda: Covariance(gradients, mean_O, 1.0).solve(force), repeat=repeat
+        )
+    return results
+
+
+def run_benchmarks(
+    sizes: List[int],
+    batch_sizes: List[int],
+    networks: List[str],
+    kernels: List[str],
+    repeat: int,
+) -> List[Dict]:
+    records = []
+
+    def record(name, params, timing):
+        r = {"name": name, "params": params}
+        r.update(timing)
+        r["per_item"] = timing["min"] / params["batch"]
+        logging.info("{:<60} {:>12.3e}s".format(make_key(r), r["min"]))
+        records.append(r)
+
+    for n in sizes:
+        for batch in batch_sizes:
+            spins = _random_spins(n, batch)
+            params = {"n": n, "batch": batch}
+            if "to_bytes" in kernels or "from_bytes" in kernels:
+                for name, timing in bench_bytes(n, spins, repeat).items():
+                    if name in kernels:
+                        record(name, params, timing)
+            if "logcosh_forward" in kernels or "logcosh_backward" in kernels:
+                for name, timing in bench_logcosh(n, batch, repeat).items():
+                    if name in kernels:
+                        record(name, params, timing)
+            for net in networks:
+                timings = bench_machine(NETWORKS[net], n, spins, repeat, kernels)
+                for name, timing in timings.items():
+                    record(name, dict(params, net=net), timing)
+    return records
+
+
+def _parse_ints(ctx, param, value):
+    try:
+        return [int(x) for x in value.split(",") if x.strip()]
+    except ValueError:
+        raise click.BadParameter("expected a comma-separated list of integers")
+
+
+@click.command()
+@click.option(
+    "--sizes",
+    callback=_parse_ints,
+    default="12,24,48,96",
+    show_default=True,
+    help="Comma-separated list of numbers of spins.",
+)
+@click.option(
+    "--batch-sizes",
+    callback=_parse_ints,
+    default="1,16,256",
+    show_default=True,
+    help="Comma-separated list of batch sizes, i.e. number of spin configurations "
+    "(or Monte Carlo samples for `covariance_solve`) processed per timed run.",
+)
+@click.option(
+    "--net",
+    "networks",
+    type=click.Choice(list(NETWORKS)),
+    multiple=True,
+    help="Networks to benchmark. Defaults to all of them.",
+)
+@click.option(
+    "--only",
+    "kernels",
+    type=click.Choice(KERNELS),
+    multiple=True,
+    help="Kernels to benchmark. Defaults to all of them.",
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=5,
+    show_default=True,
+    help="Number of timed runs per benchmark.",
+)
+@click.option(
+    "-o",
+    "--out-file",
+    type=click.File(mode="w"),
+    default=sys.stdout,
+    show_default=True,
+    help="Where to write the results (JSON).",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(dir_okay=False, path_type=str),
+    default=DEFAULT_BASELINE,
+    show_default=True,
+    help="Baseline file to compare against.",
+)
+@click.option(
+    "--save-baseline",
+    is_flag=True,
+    help="Overwrite the baseline with the current results instead of comparing.",
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0.0),
+    default=0.1,
+    show_default=True,
+    help="Relative slowdown which is reported as a regression.",
+)
+@click.option(
+    "--strict",
+    is_flag=True,
+    help="Exit with a non-zero code if any regressions are found.",
+)
+def main(
+    sizes,
+    batch_sizes,
+    networks,
+    kernels,
+    repeat,
+    out_file,
+    baseline,
+    save_baseline,
+    tolerance,
+    strict,
+):
+    """
+    Micro-benchmarks for the hot kernels.
+    """
+    logging.basicConfig(
+        format="[%(asctime)s] [%(levelname)s] %(message)s", level=logging.INFO
+    )
+    networks = list(networks) if networks else list(NETWORKS)
+    kernels = list(kernels) if kernels else KERNELS
+    records = run_benchmarks(sizes, batch_sizes, networks, kernels, repeat)
+    save_results(out_file, records)
+    if save_baseline:
+        with open(baseline, "w") as f:
+            save_results(f, records)
+        logging.info("Baseline written to {}".format(baseline))
+    elif os.path.exists(baseline):
+        with open(baseline, "r") as f:
+            regressions = compare(records, load_results(f), tolerance)
+        logging.info("{} regression(s) found.".format(regressions))
+        if strict and regressions > 0:
+            sys.exit(1)
+    else:
+        logging.warning(
+            "Baseline {} does not exist, run with --save-baseline to create it.".format(
+                baseline
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
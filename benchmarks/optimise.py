@@ -0,0 +1,315 @@
+# Copyright Tom Westerhout (c) 2018
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of Tom Westerhout nor the names of other
+#       contributors may be used to endorse or promote products derived
+#       from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+End-to-end benchmark of the variational Monte Carlo loop: runs a few epochs
+of :py:class:`nqs_playground.Trial.Optimiser` on lattices of growing size and
+reports throughput of the sampler, time spent solving the SR equations and
+peak memory usage as functions of the number of spins.
+
+Run it from the root of the repository::
+
+    python -m benchmarks.optimise --lattice chain:12 --lattice square:4x4
+
+Every configuration runs in a fresh process so that peak memory usage is
+measured per configuration.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from typing import Dict
+
+import click
+import numpy as np
+import torch
+
+from nqs_playground import lattice, model, rbm
+from nqs_playground import Trial
+from benchmarks.common import compare, load_results, save_results
+
+NETWORKS = {"model": model.Net, "rbm": rbm.Net}
+
+DEFAULT_LATTICES = [
+    "chain:12",
+    "chain:24",
+    "chain:48",
+    "square:4x4",
+    "square:6x6",
+    "triangular:4x4",
+    "kagome:2x2",
+    "kagome:2x4",
+]
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline_optimise.json")
+
+
+class _Stopwatch(object):
+    """
+    Accumulates the time spent in a function.
+    """
+
+    def __init__(self):
+        self.total = 0.0
+        self.calls = 0
+
+    def wrap(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - start
+                self.calls += 1
+
+        return wrapper
+
+
+def _peak_memory_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def run_one(
+    spec: str, net: str, steps: int, epochs: int, use_sr: bool, seed: int
+) -> Dict:
+    """
+    Runs ``epochs`` learning cycles of the Optimiser on lattice ``spec`` and
+    returns the collected statistics.
+    """
+    logging.basicConfig(
+        format="[%(asctime)s] [%(levelname)s] %(message)s", level=logging.WARNING
+    )
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    hamiltonian = Trial.Heisenberg(lattice.from_spec(spec))
+    n = hamiltonian.number_spins
+    psi = Trial._make_machine(NETWORKS[net])(n)
+    thermalisation = int(0.1 * steps)
+    monte_carlo_steps = (thermalisation * n, (thermalisation + steps) * n, n)
+    optimiser = Trial.Optimiser(
+        psi,
+        hamiltonian,
+        magnetisation=0 if n % 2 == 0 else 1,
+        epochs=epochs,
+        monte_carlo_steps=monte_carlo_steps,
+        learning_rate=0.05,
+        use_sr=use_sr,
+        regulariser=lambda i: 100.0 * 0.9**i + 0.01,
+        model_file=None,
+        time_limit=None,
+    )
+
+    sampling, solving = _Stopwatch(), _Stopwatch()
+    monte_carlo, solve = Trial.monte_carlo, Trial.Covariance.solve
+    Trial.monte_carlo = sampling.wrap(monte_carlo)
+    Trial.Covariance.solve = solving.wrap(solve)
+    try:
+        epoch_times = []
+        for i in range(epochs):
+            start = time.perf_counter()
+            optimiser.learning_cycle(i)
+            epoch_times.append(time.perf_counter() - start)
+    finally:
+        Trial.monte_carlo, Trial.Covariance.solve = monte_carlo, solve
+
+    samples = len(range(*monte_carlo_steps))
+    return {
+        "name": "optimise",
+        "params": {"lattice": spec, "net": net, "steps": steps, "use_sr": use_sr},
+        "n": n,
+        "parameters": psi.size,
+        "min": min(epoch_times),
+        "mean": sum(epoch_times) / epochs,
+        "repeat": epochs,
+        "samples_per_second": epochs * samples / sampling.total,
+        "chain_steps_per_second": epochs * monte_carlo_steps[1] / sampling.total,
+        "monte_carlo_time": sampling.total / epochs,
+        "solve_time": solving.total / epochs,
+        "peak_memory_mb": _peak_memory_mb(),
+    }
+
+
+@click.command()
+@click.option(
+    "--lattice",
+    "lattices",
+    type=str,
+    multiple=True,
+    help="Lattice specifications, e.g. `chain:24` or `kagome:2x2`. May be given "
+    "multiple times. Defaults to: {}.".format(", ".join(DEFAULT_LATTICES)),
+)
+@click.option(
+    "--net",
+    "networks",
+    type=click.Choice(list(NETWORKS)),
+    multiple=True,
+    help="Networks to benchmark. Defaults to all of them.",
+)
+@click.option(
+    "--steps",
+    type=click.IntRange(min=1),
+    default=200,
+    show_default=True,
+    help="Length of the Markov Chain (in sweeps) per epoch.",
+)
+@click.option(
+    "--epochs",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Number of learning cycles per configuration.",
+)
+@click.option(
+    "--use-sr",
+    type=bool,
+    default=True,
+    show_default=True,
+    help="Whether to use Stochastic Reconfiguration.",
+)
+@click.option("--seed", type=int, default=42, show_default=True, help="Random seed.")
+@click.option(
+    "-o",
+    "--out-file",
+    type=click.File(mode="w"),
+    default=sys.stdout,
+    show_default=True,
+    help="Where to write the results (JSON).",
+)
+@click.option(
+    "--baseline",
+    type=click.Path(dir_okay=False, path_type=str),
+    default=DEFAULT_BASELINE,
+    show_default=True,
+    help="Baseline file to compare against.",
+)
+@click.option(
+    "--save-baseline",
+    is_flag=True,
+    help="Overwrite the baseline with the current results instead of comparing.",
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0.0),
+    default=0.1,
+    show_default=True,
+    help="Relative slowdown which is reported as a regression.",
+)
+def main(
+    lattices,
+    networks,
+    steps,
+    epochs,
+    use_sr,
+    seed,
+    out_file,
+    baseline,
+    save_baseline,
+    tolerance,
+):
+    """
+    End-to-end throughput of the Optimiser as a function of system size.
+    """
+    logging.basicConfig(
+        format="[%(asctime)s] [%(levelname)s] %(message)s", level=logging.INFO
+    )
+    lattices = list(lattices) if lattices else DEFAULT_LATTICES
+    for spec in lattices:
+        try:
+            lattice.from_spec(spec)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--lattice")
+    networks = list(networks) if networks else list(NETWORKS)
+
+    records = []
+    context = multiprocessing.get_context("spawn")
+    for spec in lattices:
+        for net in networks:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                records.append(
+                    executor.submit(
+                        run_one, spec, net, steps, epochs, use_sr, seed
+                    ).result()
+                )
+
+    logging.info(
+        "{:<16} {:>5} {:>6} {:>8} {:>12} {:>10} {:>10} {:>10}".format(
+            "lattice",
+            "n",
+            "net",
+            "params",
+            "samples/s",
+            "MC [s]",
+            "solve [s]",
+            "mem [MB]",
+        )
+    )
+    for r in sorted(records, key=lambda r: (r["params"]["net"], r["n"])):
+        logging.info(
+            "{:<16} {:>5} {:>6} {:>8} {:>12.1f} {:>10.3f} {:>10.3f} {:>10.1f}".format(
+                r["params"]["lattice"],
+                r["n"],
+                r["params"]["net"],
+                r["parameters"],
+                r["samples_per_second"],
+                r["monte_carlo_time"],
+                r["solve_time"],
+                r["peak_memory_mb"],
+            )
+        )
+
+    save_results(out_file, records)
+    if save_baseline:
+        with open(baseline, "w") as f:
+            save_results(f, records)
+        logging.info("Baseline written to {}".format(baseline))
+    elif os.path.exists(baseline):
+        with open(baseline, "r") as f:
+            regressions = compare(records, load_results(f), tolerance)
+        logging.info("{} regression(s) found.".format(regressions))
+    else:
+        logging.warning(
+            "Baseline {} does not exist, run with --save-baseline to create it.".format(
+                baseline
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -32,32 +32,127 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
+import asyncio
+import base64
 import cmath
+import collections
+import concurrent.futures
 import copy
 import cProfile
+import hashlib
 import importlib
+import inspect
+import json
 from itertools import islice
 from functools import reduce
 import logging
 import math
+import multiprocessing
 import os
+import signal
 import sys
+import tempfile
+import threading
 import time
+import warnings
 from typing import Dict, List, Tuple, Optional
 
 import click
-import mpmath  # Just to be safe: for accurate computation of L2 norms
-from numba import jit, jitclass, uint8, int64, float32
-from numba.types import Bytes
+from numba import jit, boolean, uint8, int64, float32, void
+from numba.types import Array, Bytes
 import numpy as np
-import scipy
-from scipy.sparse.linalg import lgmres, LinearOperator
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.nn.functional as F
 
+from nqs_playground import lattice
 
-@jit(uint8[:](float32[:]), nopython=True)
+
+# NOTE: scipy is imported lazily in functions which need it to keep the
+# startup time low. For the same reason all numba kernels are compiled with
+# `cache=True`: compiled code is stored on disk (next to the source or in
+# $NUMBA_CACHE_DIR) and reused by later invocations. Run the `warmup` command
+# once to populate the cache.
+
+
+class _AllocationCounter(object):
+    """
+    Debug counter of memory allocations on the Monte Carlo hot path.
+
+    It is only active if the ``NQS_DEBUG_ALLOCATIONS`` environment variable
+    is set to 1, in which case :py:func:`monte_carlo_loop` reports per Monte
+    Carlo step (i.e. advancing the chain and processing the new state):
+
+    * the number of memory blocks allocated during the step which are still
+      alive at its end (e.g. new cache entries);
+    * the peak amount of memory allocated during the step. It is non-zero if
+      the step allocates anything at all, even objects which are freed
+      before the step ends (e.g. temporary ``CompactSpin`` keys);
+    * the source lines responsible for most of the allocations.
+
+    Allocations are traced with :py:mod:`tracemalloc` which only sees memory
+    managed by Python (in particular, not numba's own allocations). Tracing
+    slows the simulation down considerably.
+    """
+
+    def __init__(self):
+        self.enabled = os.environ.get("NQS_DEBUG_ALLOCATIONS", "0") == "1"
+
+    def trace(self, iterable):
+        """
+        Wraps the iterator of Monte Carlo states. Every iteration of the loop
+        consuming the result is measured as one step.
+        """
+        if not self.enabled:
+            return iterable
+        return self._trace(iterable)
+
+    def _trace(self, iterable):
+        import tracemalloc
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        steps, blocks, peak = 0, 0, 0
+        sources = collections.Counter()
+        try:
+            # NOTE: After clear_traces(), memory allocated before is no longer
+            # traced, so the peak only includes what the step itself allocates.
+            tracemalloc.clear_traces()
+            tracemalloc.reset_peak()
+            for x in iterable:
+                yield x
+                # NOTE: The snapshot is taken first, so that it doesn't include
+                # the objects allocated by get_traced_memory.
+                snapshot = tracemalloc.take_snapshot()
+                peak += tracemalloc.get_traced_memory()[1]
+                blocks += len(snapshot.traces)
+                for stat in snapshot.statistics("lineno"):
+                    sources[str(stat.traceback)] += stat.count
+                steps += 1
+                tracemalloc.clear_traces()
+                tracemalloc.reset_peak()
+        finally:
+            if started:
+                tracemalloc.stop()
+            if steps > 0:
+                logging.debug(
+                    "Allocations per Monte Carlo step: {:.3f} memory blocks kept, "
+                    "{:.1f} bytes at peak".format(blocks / steps, peak / steps)
+                )
+                for source, count in sources.most_common(5):
+                    logging.debug(
+                        "    {:.3f} blocks kept per step at {}".format(
+                            count / steps, source
+                        )
+                    )
+
+
+_allocations = _AllocationCounter()
+
+
+@jit(uint8[:](float32[:]), nopython=True, cache=True)
 def to_bytes(spin: np.ndarray) -> np.ndarray:
     """
     Converts a spin to a bit array. It is assumed that a spin-up corresponds to
@@ -84,7 +179,7 @@ def to_bytes(spin: np.ndarray) -> np.ndarray:
     return b
 
 
-@jit(float32[:](Bytes(uint8, 1, "C"), int64), nopython=True)
+@jit(float32[:](Bytes(uint8, 1, "C"), int64), nopython=True, cache=True)
 def from_bytes(b: bytes, n: int) -> np.ndarray:
     chunks, rest = divmod(n, 8)
     spin = np.empty(n, dtype=np.float32)
@@ -110,6 +205,14 @@ class CompactSpin(bytes):
         """
         return bytes.__new__(cls, to_bytes(spin).tobytes())
 
+    @classmethod
+    def from_packed(cls, b: bytes) -> "CompactSpin":
+        """
+        Creates a new ``CompactSpin`` from a spin which has already been
+        packed with :py:func:`to_bytes`.
+        """
+        return bytes.__new__(cls, b)
+
     def __int__(self):
         """
         Returns an int representation of the spin.
@@ -117,6 +220,71 @@ class CompactSpin(bytes):
         return int.from_bytes(self, byteorder="big")
 
 
+@jit(
+    [
+        void(uint8[:, ::1], float32[:, ::1], float32[::1], float32[:, ::1]),
+        void(
+            Array(uint8, 2, "C", readonly=True),
+            float32[:, ::1],
+            float32[::1],
+            float32[:, ::1],
+        ),
+    ],
+    nopython=True,
+    fastmath=True,
+    cache=True,
+)
+def _packed_linear(packed, weight_t, shift, out):
+    """
+    Evaluates a dense layer on spin configurations packed with
+    :py:func:`to_bytes` without unpacking them.
+
+    For S ∈ {±1}ⁿ, W·S + b = 2∑_{i: Sᵢ = ↑} W[:, i] + (b - ∑ᵢ W[:, i]), so
+    we only need to gather and sum the columns of W corresponding to up
+    spins.
+
+    :param packed: ``(N, ⌈n/8⌉)`` array of packed spin configurations.
+    :param weight_t: 2Wᵀ, i.e. an ``(n, m)`` array whose rows are the doubled
+                     columns of W.
+    :param shift: b - ∑ᵢ W[:, i].
+    :param out: ``(N, m)`` output array.
+    """
+    n, m = weight_t.shape
+    # Number of unused (high) bits in the first byte
+    offset = (8 - n % 8) % 8
+    ups = np.empty(n, dtype=np.int64)
+    for k in range(packed.shape[0]):
+        count = 0
+        for c in range(packed.shape[1]):
+            b = packed[k, c]
+            for bit in range(8):
+                i = 8 * c - offset + bit
+                if i >= 0 and (b >> (7 - bit)) & 1:
+                    ups[count] = i
+                    count += 1
+        acc = out[k]
+        for j in range(m):
+            acc[j] = shift[j]
+        for t in range(count):
+            w = weight_t[ups[t]]
+            for j in range(m):
+                acc[j] += w[j]
+
+
+class _Precomputed(object):
+    """
+    Stand-in for a layer whose output has already been computed (see
+    :py:meth:`Machine.log_wf_packed`). It's not an ``nn.Module`` to keep
+    swapping it in and out cheap.
+    """
+
+    def __init__(self):
+        self.output = None
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        return self.output
+
+
 def _make_machine(BaseNet):
     """
     Creates the ``Machine`` class by deriving from a user-defined Neural
@@ -128,6 +296,16 @@ def _make_machine(BaseNet):
         Our variational ansatz |Ψ〉.
         """
 
+        # Properties which TorchScript should not try to compile (see
+        # compile_network)
+        __jit_unused_properties__ = [
+            "flat_parameters",
+            "flat_gradients",
+            "parameter_shapes",
+            "parameter_offsets",
+            "size",
+        ]
+
         class Cell(object):
             """
             Cache cell corresponding to a spin configuration |S〉. A cell stores
@@ -162,6 +340,107 @@ def _make_machine(BaseNet):
                 self._size = None
             # Hash-table mapping CompactSpin to Machine.Cell
             self._cache = {}
+            # Contiguous buffers backing the parameters and their gradients
+            # (see flatten_parameters_)
+            self._flat_parameters = None
+            self._flat_gradients = None
+            # Workspaces which are reused across calls: input tensor (and its
+            # numpy view) and seeds for backward propagation.
+            self._input = None
+            self._seeds = (
+                torch.tensor([1, 0], dtype=torch.float32),
+                torch.tensor([0, 1], dtype=torch.float32),
+            )
+            # Name of the leading nn.Linear layer which can be evaluated on
+            # packed spins ("" if there is none, None if not checked yet) and
+            # the tables used for that (see log_wf_packed)
+            self._packed_layer = None
+            self._packed_tables = None
+            self._precomputed = _Precomputed()
+            # Whether der_log_wf_batch can evaluate gradients in batches (None
+            # if not checked yet)
+            self._batched_gradients = None
+
+        def _as_input(self, x: np.ndarray) -> torch.Tensor:
+            """
+            Copies ``x`` into the reusable input tensor and returns it.
+            """
+            if self._input is None or self._input[0].shape != x.shape:
+                t = torch.empty(x.shape, dtype=torch.float32)
+                self._input = (t.numpy(), t)
+            self._input[0][...] = x
+            return self._input[1]
+
+        def flatten_parameters_(self):
+            """
+            Makes all variational parameters and their gradients views into
+            two contiguous 1D buffers. Gradients can then be read and written
+            as a single array rather than parameter by parameter.
+
+            Parameters are left in place (only their storage changes), so
+            existing optimisers keep working. Loading a ``state_dict``
+            afterwards is fine as it copies into the existing storage.
+            """
+            parameters = list(self.parameters())
+            if len(set(p.dtype for p in parameters)) > 1:
+                raise ValueError("All parameters must have the same dtype.")
+            with torch.no_grad():
+                flat = torch.cat([p.detach().reshape(-1) for p in parameters])
+                gradients = torch.zeros_like(flat)
+                for p, offset, shape in zip(
+                    parameters, self.parameter_offsets, self.parameter_shapes
+                ):
+                    n = reduce(int.__mul__, shape, 1)
+                    p.data = flat[offset : offset + n].view(shape)
+                    p.grad = gradients[offset : offset + n].view(shape)
+            self._flat_parameters = flat
+            self._flat_gradients = gradients
+            return self
+
+        @property
+        def flat_parameters(self) -> Optional[torch.Tensor]:
+            """
+            Returns the contiguous buffer holding all variational parameters
+            or ``None`` if :py:meth:`flatten_parameters_` has not been called.
+            """
+            return self._flat_parameters
+
+        @property
+        def flat_gradients(self) -> Optional[torch.Tensor]:
+            """
+            Returns the contiguous buffer holding the gradients of all
+            variational parameters or ``None`` if :py:meth:`flatten_parameters_`
+            has not been called.
+            """
+            return self._flat_gradients
+
+        @property
+        def parameter_shapes(self) -> List[Tuple[int, ...]]:
+            """
+            Returns the shapes of the variational parameters in the order in
+            which they appear in flattened vectors (e.g. ``der_log_wf``).
+            """
+            return [tuple(p.size()) for p in self.parameters()]
+
+        @property
+        def parameter_offsets(self) -> List[int]:
+            """
+            Returns the offsets of the variational parameters in flattened
+            vectors.
+            """
+            offsets = []
+            i = 0
+            for shape in self.parameter_shapes:
+                offsets.append(i)
+                i += reduce(int.__mul__, shape, 1)
+            return offsets
+
+        def zero_grad(self, *args, **kwargs):
+            if self._flat_gradients is not None:
+                # Keep the gradients as views into the flat buffer
+                self._flat_gradients.zero_()
+            else:
+                super().zero_grad(*args, **kwargs)
 
         def log_wf(self, x: np.ndarray) -> complex:
             """
@@ -178,11 +457,165 @@ def _make_machine(BaseNet):
                 return cell.log_wf
             else:
                 with torch.no_grad():
-                    (a, b) = self.forward(torch.from_numpy(x))
+                    a, b = self.forward(self._as_input(x))
                     log_wf = complex(a, b)
                     self._cache[key] = Machine.Cell(log_wf)
                     return log_wf
 
+        def _find_packed_layer(self) -> Optional[str]:
+            """
+            Returns the name of the leading ``nn.Linear`` layer, i.e. a direct
+            child which is the only consumer of the input, or ``None`` if
+            there is none (or the network doesn't support batched input).
+
+            The check is done once: the network is run with the input replaced
+            by NaNs and the output of the candidate layer substituted by its
+            true value. If the result doesn't change, the rest of the network
+            never looks at the input.
+            """
+            if self._packed_layer is None:
+                self._packed_layer = ""
+                n = self.number_spins
+                xs = torch.from_numpy(np.stack([random_spin(n) for _ in range(4)]))
+                with torch.no_grad():
+                    try:
+                        expected = type(self).forward(self, xs)
+                    except (RuntimeError, ValueError, IndexError):
+                        expected = None
+                    if expected is not None and tuple(expected.size()) == (4, 2):
+                        for name, module in self.named_children():
+                            if type(module) is not nn.Linear or module.in_features != n:
+                                continue
+                            y = self._forward_with(
+                                name, module(xs), torch.full_like(xs, float("nan"))
+                            )
+                            if torch.allclose(y, expected, rtol=1e-5, atol=1e-6):
+                                self._packed_layer = name
+                                break
+            return self._packed_layer or None
+
+        def _forward_with(self, name: str, y: torch.Tensor, x: torch.Tensor):
+            """
+            Runs the (eager) forward propagation with the child ``name``
+            temporarily replaced by :py:class:`_Precomputed` returning ``y``.
+            """
+            modules = self._modules
+            layer = modules[name]
+            self._precomputed.output = y
+            modules[name] = self._precomputed
+            try:
+                return type(self).forward(self, x)
+            finally:
+                modules[name] = layer
+                self._precomputed.output = None
+
+        def _packed_layer_tables(self, layer: nn.Linear):
+            """
+            Returns 2Wᵀ and b - ∑ᵢ W[:, i] for :py:func:`_packed_linear`. They
+            are recomputed whenever the weights change.
+            """
+            # NOTE: After flatten_parameters_, parameters are views into
+            # _flat_parameters which don't share its version counter, so
+            # updating the flat buffer (e.g. in __isub__) doesn't bump the
+            # versions of the weights.
+            version = (
+                layer.weight.data_ptr(),
+                layer.weight._version,
+                None if layer.bias is None else layer.bias._version,
+                (
+                    None
+                    if self._flat_parameters is None
+                    else self._flat_parameters._version
+                ),
+            )
+            if self._packed_tables is None or self._packed_tables[0] != version:
+                with torch.no_grad():
+                    w = layer.weight.detach()
+                    shift = -w.sum(dim=1)
+                    if layer.bias is not None:
+                        shift += layer.bias.detach()
+                    self._packed_tables = (
+                        version,
+                        np.ascontiguousarray(2 * w.t().numpy(), dtype=np.float32),
+                        np.ascontiguousarray(shift.numpy(), dtype=np.float32),
+                    )
+            return self._packed_tables[1], self._packed_tables[2]
+
+        # Largest batch for which log_wf_packed uses _packed_linear. For larger
+        # batches a BLAS matrix-matrix product wins even with the unpacking.
+        _PACKED_BATCH_LIMIT = 16
+
+        def log_wf_packed(self, packed: np.ndarray) -> np.ndarray:
+            """
+            Same as :py:meth:`log_wf_batch`, but takes spin configurations
+            packed with :py:func:`to_bytes` (rows of a 2D array of ``uint8``).
+
+            If the network starts with an ``nn.Linear`` layer (see
+            :py:meth:`_find_packed_layer`) and the batch is small, the layer is
+            evaluated directly on the packed configurations (see
+            :py:func:`_packed_linear`) and only the rest of the network is run
+            as usual. Otherwise configurations are unpacked and passed to
+            :py:meth:`log_wf_batch`.
+            """
+            packed = np.ascontiguousarray(packed, dtype=np.uint8)
+            n = self.number_spins
+            # NOTE: Compiled networks (see compile_network) replace forward, and
+            # we don't want to fall back to eager mode for them.
+            if (
+                len(packed) == 0
+                or len(packed) > self._PACKED_BATCH_LIMIT
+                or "forward" in self.__dict__
+                or self._find_packed_layer() is None
+            ):
+                # See to_bytes for the layout
+                bits = np.unpackbits(packed, axis=1)[:, packed.shape[1] * 8 - n :]
+                return self.log_wf_batch(2 * bits.astype(np.float32) - 1)
+            name = self._packed_layer
+            weight_t, shift = self._packed_layer_tables(self._modules[name])
+            y = np.empty((len(packed), shift.size), dtype=np.float32)
+            _packed_linear(packed, weight_t, shift, y)
+            with torch.no_grad():
+                # The input is never read, only its shape matters
+                y = self._forward_with(
+                    name, torch.from_numpy(y), torch.empty((len(packed), n))
+                )
+            y = y.numpy().astype(np.float64)
+            log_wf = y[:, 0] + 1j * y[:, 1]
+            for row, value in zip(packed, log_wf):
+                key = CompactSpin.from_packed(row.tobytes())
+                if key not in self._cache:
+                    self._cache[key] = Machine.Cell(complex(value))
+            return log_wf
+
+        def log_wf_batch(self, xs: np.ndarray) -> np.ndarray:
+            """
+            Computes log(Ψ(x)) for every row x of ``xs`` and stores the results
+            in the cache.
+
+            If the underlying network supports batched input (i.e. maps an
+            ``(N, number_spins)`` tensor to an ``(N, 2)`` one), all
+            configurations are evaluated in a single forward pass. Otherwise we
+            fall back to calling :py:meth:`log_wf` for each row.
+
+            :param np.ndarray xs: 2D array of ``float32`` spin configurations.
+            :return: 1D array of ``complex128``.
+            """
+            xs = np.ascontiguousarray(xs, dtype=np.float32)
+            with torch.no_grad():
+                try:
+                    y = self.forward(torch.from_numpy(xs))
+                except (RuntimeError, ValueError, IndexError):
+                    y = None
+            if y is None or tuple(y.size()) != (xs.shape[0], 2):
+                return np.array([self.log_wf(x) for x in xs], dtype=np.complex128)
+            y = y.numpy().astype(np.float64)
+            log_wf = y[:, 0] + 1j * y[:, 1]
+            for x, value in zip(xs, log_wf):
+                key = CompactSpin(x)
+                if key not in self._cache:
+                    self._cache[key] = Machine.Cell(complex(value))
+            return log_wf
+
         @property
         def size(self) -> int:
             """
@@ -217,25 +650,16 @@ def _make_machine(BaseNet):
                 out[:] = cell.der_log_wf
             else:
                 # Forward-propagation to construct the graph
-                result = self.forward(torch.from_numpy(x))
+                result = self.forward(self._as_input(x))
+                seed_real, seed_imag = self._seeds
                 # Computes ∇Re[log(Ψ(x))]
                 self.zero_grad()
-                result.backward(
-                    torch.tensor([1, 0], dtype=torch.float32), retain_graph=True
-                )
-                # TODO(twesterhout): This is ugly and error-prone.
-                i = 0
-                for p in map(lambda p_: p_.grad.view(-1).numpy(), self.parameters()):
-                    out.real[i : i + p.size] = p
-                    i += p.size
+                result.backward(seed_real, retain_graph=True)
+                self._read_gradients(out.real)
                 # Computes ∇Im[log(Ψ(x))]
                 self.zero_grad()
-                result.backward(torch.tensor([0, 1], dtype=torch.float32))
-                # TODO(twesterhout): This is ugly and error-prone.
-                i = 0
-                for p in map(lambda p_: p_.grad.view(-1).numpy(), self.parameters()):
-                    out.imag[i : i + p.size] = p
-                    i += p.size
+                result.backward(seed_imag)
+                self._read_gradients(out.imag)
                 # Save the results
                 # TODO(twesterhout): Remove the copy when it's safe to do so.
                 self._cache[key] = Machine.Cell(
@@ -243,6 +667,112 @@ def _make_machine(BaseNet):
                 )
             return out
 
+        # Number of configurations per forward pass in der_log_wf_batch
+        _GRADIENT_BATCH_SIZE = 256
+
+        def der_log_wf_batch(
+            self, xs: np.ndarray, out: np.ndarray = None
+        ) -> np.ndarray:
+            """
+            Computes ∇log(Ψ(x)) for every row x of ``xs``.
+
+            Configurations are processed in chunks of ``_GRADIENT_BATCH_SIZE``
+            with one forward and two backward passes per chunk. Gradients of
+            individual configurations are then recovered from the inputs and
+            output gradients of ``nn.Linear`` layers (see :py:class:`KFAC`).
+            This only works if all parameters belong to ``nn.Linear`` layers
+            which are applied once per forward pass and if rows of a batch
+            don't interact. It is checked against :py:meth:`der_log_wf` on the
+            first call; if the check fails, we fall back to calling
+            :py:meth:`der_log_wf` for each row. Unlike the latter, results are
+            not cached.
+
+            :param np.ndarray xs: 2D array of ``float32`` spin configurations.
+            :param np.ndarray out: Destination array of shape
+                ``(len(xs), self.size)``. Must be a numpy array of ``complex64``.
+            :return: Gradients as rows of a 2D array of ``complex64``.
+            """
+            xs = np.ascontiguousarray(xs, dtype=np.float32)
+            if out is None:
+                out = np.empty((len(xs), self.size), dtype=np.complex64)
+            if self._batched_gradients is None and len(xs) > 0:
+                self._batched_gradients = self._check_batched_gradients(xs[:2])
+            if not self._batched_gradients:
+                for x, row in zip(xs, out):
+                    self.der_log_wf(x, out=row)
+                return out
+            for i in range(0, len(xs), self._GRADIENT_BATCH_SIZE):
+                j = i + self._GRADIENT_BATCH_SIZE
+                self._der_log_wf_chunk(xs[i:j], out[i:j])
+            return out
+
+        def _check_batched_gradients(self, xs: np.ndarray) -> bool:
+            """
+            Checks whether :py:meth:`_der_log_wf_chunk` agrees with
+            :py:meth:`der_log_wf` on ``xs``.
+            """
+            expected = np.empty((len(xs), self.size), dtype=np.complex64)
+            for x, row in zip(xs, expected):
+                self.der_log_wf(x, out=row)
+            got = np.empty_like(expected)
+            try:
+                self._der_log_wf_chunk(xs, got)
+            except (RuntimeError, ValueError, IndexError) as e:
+                logging.debug("Batched gradients are not supported: {}".format(e))
+                return False
+            if not np.allclose(got, expected, rtol=1e-3, atol=1e-5):
+                logging.debug("Batched gradients disagree with der_log_wf.")
+                return False
+            return True
+
+        def _der_log_wf_chunk(self, xs: np.ndarray, out: np.ndarray):
+            """
+            Implementation of :py:meth:`der_log_wf_batch` for one chunk.
+            """
+            layers = [m for m in self.modules() if isinstance(m, nn.Linear)]
+            covered = set(p for m in layers for p in m.parameters(recurse=False))
+            if any(p not in covered for p in self.parameters()):
+                raise ValueError("not all parameters belong to nn.Linear layers")
+            inputs = {}
+            outputs = {}
+
+            def hook(module, args, output):
+                if module in outputs:
+                    raise ValueError("nn.Linear layers must be applied only once")
+                inputs[module] = args[0].detach()
+                outputs[module] = output
+
+            handles = [m.register_forward_hook(hook) for m in layers]
+            try:
+                # NOTE: Hooks only fire in eager mode, so we bypass the compiled
+                # forward (see compile_network) if there is one.
+                y = type(self).forward(self, torch.from_numpy(xs))
+            finally:
+                for handle in handles:
+                    handle.remove()
+            if tuple(y.size()) != (len(xs), 2):
+                raise ValueError("network doesn't support batched input")
+            layers = [m for m in layers if m in outputs]
+            s = [outputs[m] for m in layers]
+            g_re = torch.autograd.grad(y[:, 0].sum(), s, retain_graph=True)
+            g_im = torch.autograd.grad(y[:, 1].sum(), s)
+            out[...] = 0
+            offsets = dict(zip(self.parameters(), self.parameter_offsets))
+            n = len(xs)
+            for m, gr, gi in zip(layers, g_re, g_im):
+                # Layers may be applied to a batch of vectors per configuration
+                # (e.g. rbm.SymmetricNet), contributions of which are summed.
+                a = inputs[m].reshape(n, -1, m.in_features)
+                for g, part in ((gr, out.real), (gi, out.imag)):
+                    g = g.reshape(n, -1, m.out_features)
+                    i = offsets[m.weight]
+                    part[:, i : i + m.weight.numel()] = (
+                        torch.einsum("nko,nki->noi", g, a).reshape(n, -1).numpy()
+                    )
+                    if m.bias is not None:
+                        i = offsets[m.bias]
+                        part[:, i : i + m.out_features] = g.sum(dim=1).numpy()
+
         def clear_cache(self):
             """
             Clears the internal cache. This function must be called when the
@@ -250,6 +780,19 @@ def _make_machine(BaseNet):
             """
             self._cache = {}
 
+        def _read_gradients(self, out: np.ndarray):
+            """
+            Copies the gradients of all parameters into ``out``.
+            """
+            if self._flat_gradients is not None:
+                out[:] = self._flat_gradients.numpy()
+                return
+            # TODO(twesterhout): This is ugly and error-prone.
+            i = 0
+            for p in map(lambda p_: p_.grad.view(-1).numpy(), self.parameters()):
+                out[i : i + p.size] = p
+                i += p.size
+
         def set_gradients(self, x: np.ndarray):
             """
             Performs ∇W = x, i.e. sets the gradients of the variational parameters.
@@ -259,8 +802,16 @@ def _make_machine(BaseNet):
             """
             with torch.no_grad():
                 gradients = torch.from_numpy(x)
+                if self._flat_gradients is not None:
+                    self._flat_gradients.copy_(gradients)
+                    return
                 i = 0
-                for dp in map(lambda p_: p_.grad.data.view(-1), self.parameters()):
+                for p in self.parameters():
+                    # Gradients may not have been allocated yet if they were
+                    # computed without calling backward()
+                    if p.grad is None:
+                        p.grad = torch.empty_like(p)
+                    dp = p.grad.data.view(-1)
                     (n,) = dp.size()
                     dp.copy_(gradients[i : i + n])
                     i += n
@@ -274,6 +825,10 @@ def _make_machine(BaseNet):
             """
             with torch.no_grad():
                 delta = torch.from_numpy(x)
+                if self._flat_parameters is not None:
+                    self._flat_parameters.sub_(delta)
+                    self._cache = {}
+                    return self
                 i = 0
                 for p in map(lambda p_: p_.data.view(-1), self.parameters()):
                     (n,) = p.size()
@@ -292,16 +847,20 @@ class MonteCarloState(object):
     configuration.
     """
 
-    def __init__(self, machine, spin):
+    def __init__(self, machine, spin, hamiltonian=None):
         """
         Initialises the Monte-Carlo state.
 
         :param machine: Variational state
         :param np.ndarray spin: Initial spin configuration
+        :param hamiltonian: If given, the state keeps track of bonds of
+                            ``hamiltonian`` (see :py:meth:`Heisenberg.track`)
+                            which speeds up the computation of local energies.
         """
         self._machine = machine
         self._spin = np.copy(spin)
         self._log_wf = self._machine.log_wf(self._spin)
+        self._bonds = None if hamiltonian is None else hamiltonian.track(self._spin)
         # TODO(twesterhout): Remove this.
         # with torch.no_grad():
         #     for p in self._machine.parameters():
@@ -318,6 +877,13 @@ class MonteCarloState(object):
     def machine(self):
         return self._machine
 
+    @property
+    def bonds(self):
+        """
+        Returns the bond tracker (see :py:meth:`Heisenberg.track`) or ``None``.
+        """
+        return self._bonds
+
     def log_wf(self) -> complex:
         """
         Returns log(〈S|ψ〉) where S is the current spin configuration.
@@ -331,46 +897,91 @@ class MonteCarloState(object):
         ``flips``.
         """
         # TODO(twesterhout): Yes, this is ugly, but it does avoid copying :)
-        self._spin[flips] *= -1
-        new_log_wf = self._machine.log_wf(self._spin)
-        self._spin[flips] *= -1
+        # NOTE: Flipping spins one by one rather than using fancy indexing
+        # avoids allocating temporary index arrays.
+        spin = self._spin
+        for i in flips:
+            spin[i] = -spin[i]
+        new_log_wf = self._machine.log_wf(spin)
+        for i in flips:
+            spin[i] = -spin[i]
         return new_log_wf - self.log_wf()
 
-    def der_log_wf(self):
-        return self._machine.der_log_wf(self._spin)
+    def der_log_wf(self, out=None, key=None):
+        return self._machine.der_log_wf(self._spin, out=out, key=key)
 
     def update(self, flips: List[int]):
         """
         "Accepts" the flips.
         """
-        self._spin[flips] *= -1
-        self._log_wf = self._machine.log_wf(self._spin)
+        spin = self._spin
+        for i in flips:
+            spin[i] = -spin[i]
+        self._log_wf = self._machine.log_wf(spin)
+        if self._bonds is not None:
+            self._bonds.update(spin, flips)
         return self
 
 
-@jitclass([("_ups", int64[:]), ("_downs", int64[:]), ("_n", int64), ("_i", int64)])
+@jit(void(int64[:], int64[:], boolean[:]), nopython=True, cache=True)
+def _flipper_commit(ups: np.ndarray, downs: np.ndarray, accepted: np.ndarray):
+    """
+    Kernel for :py:class:`_Flipper`: applies the accepted exchanges of a
+    whole pass and reshuffles the arrays for the next one.
+    """
+    for i in range(accepted.size):
+        if accepted[i]:
+            t = ups[i]
+            ups[i] = downs[i]
+            downs[i] = t
+        accepted[i] = False
+    np.random.shuffle(ups)
+    np.random.shuffle(downs)
+
+
 class _Flipper(object):
     """
     Magnetisation-preserving spin flipper.
+
+    Proposals are processed in passes: the i'th proposal of a pass exchanges
+    ``ups[i]`` and ``downs[i]``. Since accepting it only changes the i'th
+    entries, all proposals of a pass are known in advance, and we only need
+    to record which ones were accepted. The bookkeeping (applying the
+    exchanges and reshuffling) is done by one numba call per pass, while
+    reading proposals and recording acceptances remain per-step Python
+    calls.
     """
 
+    # NOTE: This used to be a numba jitclass, but those can't be cached on
+    # disk and were thus recompiled on every run.
+
     def __init__(self, spin: np.ndarray):
         """
         Initialises the flipper with the given spin. Magnetisation is deduced
         from the spin and is kept constant.
         """
-        self._ups = np.where(spin == 1.0)[0]
-        self._downs = np.where(spin != 1.0)[0]
+        self._ups = np.where(spin == 1.0)[0].astype(np.int64)
+        self._downs = np.where(spin != 1.0)[0].astype(np.int64)
         self._n = min(self._ups.size, self._downs.size)
         self._i = 0
         if self._i >= self._n:
             raise ValueError("Failed to initialise the Flipper.")
+        self._accepted = np.zeros(max(self._ups.size, self._downs.size), dtype=bool)
+        # Start from a random order rather than from the sorted one, otherwise
+        # the first proposal after (re)initialisation is deterministic.
+        _flipper_commit(self._ups, self._downs, self._accepted)
+        # Reused by read()
+        self._flips = [0, 0]
 
     def read(self) -> List[int]:
         """
         Suggests the next spins to flip.
+
+        The returned list is overwritten by the next call to ``read``.
         """
-        return [self._ups[self._i], self._downs[self._i]]
+        self._flips[0] = int(self._ups[self._i])
+        self._flips[1] = int(self._downs[self._i])
+        return self._flips
 
     def next(self, accepted: bool):
         """
@@ -379,120 +990,749 @@ class _Flipper(object):
         :param bool accepted: Specifies whether the last proposed flips were
         accepted.
         """
-        if accepted:
-            i = self._i
-            t = self._ups[i]
-            self._ups[i] = self._downs[i]
-            self._downs[i] = t
+        self._accepted[self._i] = accepted
         self._i += 1
         if self._i == self._n:
+            _flipper_commit(self._ups, self._downs, self._accepted)
             self._i = 0
-            np.random.shuffle(self._ups)
-            np.random.shuffle(self._downs)
+
+
+class ExchangeKernel(object):
+    """
+    Proposal kernel which exchanges an up spin with a down spin (see
+    :py:class:`_Flipper`). This is the default.
+    """
+
+    name = "exchange"
+    # Whether the kernel has to be reset when the spin is changed by a
+    # different kernel
+    stateful = True
+
+    def reset(self, spin: np.ndarray):
+        self._flipper = _Flipper(spin)
+
+    def propose(self, spin: np.ndarray) -> Optional[List[int]]:
+        return self._flipper.read()
+
+    def feedback(self, accepted: bool):
+        self._flipper.next(accepted)
+
+
+class BondExchangeKernel(object):
+    """
+    Proposal kernel which exchanges the spins on a uniformly chosen edge of
+    the Hamiltonian. Edges with aligned spins result in no move.
+    """
+
+    name = "bond"
+    stateful = False
+
+    def __init__(self, edges: List[Tuple[int, int]]):
+        self._edges = list(edges)
+        self._choices = np.empty((0,), dtype=np.int64)
+        self._k = 0
+        self._flips = [0, 0]
+
+    def reset(self, spin: np.ndarray):
+        pass
+
+    def propose(self, spin: np.ndarray) -> Optional[List[int]]:
+        if self._k == self._choices.size:
+            self._choices = np.random.randint(len(self._edges), size=4096)
+            self._k = 0
+        i, j = self._edges[self._choices[self._k]]
+        self._k += 1
+        if spin[i] == spin[j]:
+            return None
+        self._flips[0] = i
+        self._flips[1] = j
+        return self._flips
+
+    def feedback(self, accepted: bool):
+        pass
+
+
+class MultiPairExchangeKernel(object):
+    """
+    Proposal kernel which simultaneously exchanges ``pairs`` randomly chosen
+    up spins with as many randomly chosen down spins.
+    """
+
+    name = "multi"
+    stateful = False
+
+    def __init__(self, pairs: int = 2):
+        if pairs < 1:
+            raise ValueError("Invalid number of pairs: {}".format(pairs))
+        self._pairs = pairs
+        self.name = "multi{}".format(pairs)
+
+    def reset(self, spin: np.ndarray):
+        pass
+
+    def propose(self, spin: np.ndarray) -> Optional[List[int]]:
+        ups = np.flatnonzero(spin == 1.0)
+        downs = np.flatnonzero(spin != 1.0)
+        if min(ups.size, downs.size) < self._pairs:
+            return None
+        return list(np.random.choice(ups, self._pairs, replace=False)) + list(
+            np.random.choice(downs, self._pairs, replace=False)
+        )
+
+    def feedback(self, accepted: bool):
+        pass
+
+
+class GlobalInversionKernel(object):
+    """
+    Proposal kernel which flips all spins. It only preserves magnetisation
+    in the zero-magnetisation sector; otherwise no move is made.
+    """
+
+    name = "inversion"
+    stateful = False
+
+    def reset(self, spin: np.ndarray):
+        self._flips = list(range(spin.size))
+
+    def propose(self, spin: np.ndarray) -> Optional[List[int]]:
+        if np.sum(spin) != 0:
+            return None
+        return self._flips
+
+    def feedback(self, accepted: bool):
+        pass
+
+
+def make_kernels(specs: List[str], hamiltonian=None) -> List[Tuple[object, float]]:
+    """
+    Creates a mixture of proposal kernels from specifications of the form
+    ``<kind>[:<weight>]`` where ``<kind>`` is one of ``exchange``, ``bond``,
+    ``multi`` (``multi<N>`` for N pairs, 2 by default) or ``inversion``.
+    Weights default to 1 and are normalised by :py:class:`MetropolisMC`.
+    """
+    kernels = []
+    for spec in specs:
+        kind, _, weight = spec.partition(":")
+        weight = float(weight) if weight else 1.0
+        if kind == "exchange":
+            kernel = ExchangeKernel()
+        elif kind == "bond":
+            if hamiltonian is None:
+                raise ValueError("'bond' kernel requires a Hamiltonian.")
+            kernel = BondExchangeKernel(hamiltonian.edges)
+        elif kind.startswith("multi"):
+            kernel = MultiPairExchangeKernel(int(kind[5:]) if kind[5:] else 2)
+        elif kind == "inversion":
+            kernel = GlobalInversionKernel()
+        else:
+            raise ValueError("Unknown proposal kernel: {!r}".format(kind))
+        kernels.append((kernel, weight))
+    return kernels
 
 
 class MetropolisMC(object):
     """
     Markov chain constructed using Metropolis-Hasting algorithm. Elements of
     the chain are ``MonteCarloState``s.
+
+    Moves are proposed by a mixture of proposal kernels. A kernel is an
+    object with methods ``reset(spin)``, ``propose(spin)`` (returning the
+    list of spins to flip or ``None`` for no move) and ``feedback(accepted)``,
+    and a ``stateful`` attribute telling whether it needs to be reset when
+    another kernel changes the spin. All kernels must be symmetric.
     """
 
-    def __init__(self, machine, spin: np.ndarray):
+    def __init__(self, machine, spin: np.ndarray, hamiltonian=None, kernels=None):
         """
         Initialises a Markov chain.
 
         :param machine: The variational state
         :param np.ndarray spin: Initial spin configuration
+        :param hamiltonian: Hamiltonian whose local energies will be computed
+                            along the chain (optional, see
+                            :py:class:`MonteCarloState`).
+        :param kernels: List of ``(kernel, weight)`` pairs. At every step a
+                        kernel is chosen with probability proportional to its
+                        weight. Defaults to :py:class:`ExchangeKernel`.
         """
-        self._state = MonteCarloState(machine, spin)
-        self._flipper = _Flipper(spin)
+        if kernels is None:
+            kernels = [(ExchangeKernel(), 1.0)]
+        self._kernels = [kernel for (kernel, _) in kernels]
+        weights = np.array([weight for (_, weight) in kernels], dtype=np.float64)
+        if len(weights) == 0 or np.any(weights < 0) or np.sum(weights) == 0:
+            raise ValueError("Invalid kernel weights: {}".format(weights))
+        self._probabilities = weights / np.sum(weights)
+        self._choices = []
+        self._hamiltonian = hamiltonian
+        self._state = MonteCarloState(machine, spin, hamiltonian)
+        for kernel in self._kernels:
+            kernel.reset(self._state.spin)
+        self._reset_statistics()
+        # Block of pre-generated log(u) where u ~ U[0, 1) used in the
+        # acceptance test, and the position of the next unused one. Blocks
+        # are stored as lists, because indexing numpy arrays element by
+        # element is slow.
+        self._log_uniforms = []
+        self._k = 0
+
+    def _reset_statistics(self):
         self._steps = 0
         self._accepted = 0
+        # NOTE: These are updated on every step, so we use Python lists rather
+        # than numpy arrays to keep the overhead low.
+        number_kernels = len(self._kernels)
+        self._kernel_proposed = [0] * number_kernels
+        self._kernel_accepted = [0] * number_kernels
+        # ∑(Δlog|ψ|)² over transitions made by every kernel
+        self._kernel_jumps = [0.0] * number_kernels
+        # Running sums of log|ψ| and log²|ψ| over the chain
+        self._moments = [0.0, 0.0]
+
+    @property
+    def spin(self) -> np.ndarray:
+        """
+        Returns the current spin configuration.
+        """
+        return self._state.spin
+
+    def restart_(self, spin: Optional[np.ndarray] = None):
+        """
+        Prepares the chain to be continued. Cached log(ψ) of the current
+        configuration is recomputed (it must be called after the variational
+        parameters have changed) and acceptance statistics are reset.
+
+        :param spin: If given, the chain jumps to this configuration and the
+                     kernels are reinitialised. Otherwise the chain continues
+                     from where it stopped.
+        """
+        if spin is None:
+            spin = self._state.spin
+        else:
+            for kernel in self._kernels:
+                kernel.reset(spin)
+        self._state = MonteCarloState(self._state.machine, spin, self._hamiltonian)
+        self._reset_statistics()
+        return self
+
+    def kernel_statistics(self) -> List[Dict[str, float]]:
+        """
+        Returns acceptance rate and lag-1 autocorrelation of log|ψ| for every
+        kernel. The autocorrelation is estimated from the transitions made by
+        the kernel as 1 - 〈(Δlog|ψ|)²〉/(2 Var[log|ψ|]); values close to 1
+        mean the kernel hardly decorrelates the chain.
+        """
+        s1, s2 = self._moments
+        n = max(self._steps, 1)
+        variance = s2 / n - (s1 / n) ** 2
+        statistics = []
+        for i, kernel in enumerate(self._kernels):
+            proposed = self._kernel_proposed[i]
+            if proposed > 0 and variance > 0:
+                autocorrelation = 1 - self._kernel_jumps[i] / proposed / (2 * variance)
+            else:
+                autocorrelation = float("nan")
+            statistics.append(
+                {
+                    "kernel": kernel.name,
+                    "proposed": proposed,
+                    "acceptance": self._kernel_accepted[i] / max(proposed, 1),
+                    "autocorrelation": autocorrelation,
+                }
+            )
+        return statistics
+
+    def log_statistics(self):
+        logging.info(
+            "Acceptance rate: {:.2f}%".format(self._accepted / self._steps * 100)
+        )
+        if len(self._kernels) > 1:
+            for x in self.kernel_statistics():
+                logging.info(
+                    "  {kernel}: {proposed} proposals, acceptance "
+                    "{acceptance:.2%}, autocorrelation {autocorrelation:.3f}".format(
+                        **x
+                    )
+                )
+
+    # Number of random numbers drawn at once
+    _BLOCK_SIZE = 4096
 
     def __iter__(self):
+        # NOTE: Only the random numbers and the flipper bookkeeping are
+        # handled in blocks (the latter in numba, see _flipper_commit). The
+        # acceptance test itself runs in Python on every step: it needs
+        # log(Ψ) of the proposed configuration which comes from torch and
+        # can't be computed in nopython code. Calling back into Python from
+        # numba (objmode) costs more than the few operations it would
+        # replace, and every state has to be handed to the caller anyway.
         def do_generate():
+            kernels = self._kernels
+            mixture = len(kernels) > 1
+            x = self._state.log_wf().real
             while True:
                 self._steps += 1
+                self._moments[0] += x
+                self._moments[1] += x * x
                 yield self._state
-                flips = self._flipper.read()
-                if min(
-                    1.0, math.exp(self._state.log_quot_wf(flips).real) ** 2
-                ) > np.random.uniform(0, 1):
+                if self._k == len(self._log_uniforms):
+                    self._log_uniforms = np.log(
+                        np.random.random(self._BLOCK_SIZE)
+                    ).tolist()
+                    if mixture:
+                        self._choices = np.random.choice(
+                            len(kernels), size=self._BLOCK_SIZE, p=self._probabilities
+                        ).tolist()
+                    self._k = 0
+                log_u = self._log_uniforms[self._k]
+                i = self._choices[self._k] if mixture else 0
+                self._k += 1
+                kernel = kernels[i]
+                state = self._state
+                flips = kernel.propose(state.spin)
+                self._kernel_proposed[i] += 1
+                # min(1, |Ψ(S')/Ψ(S)|²) > u  <=>  2Re[log(Ψ(S')/Ψ(S))] > log(u)
+                accepted = (
+                    flips is not None and 2 * state.log_quot_wf(flips).real > log_u
+                )
+                if accepted:
                     self._accepted += 1
-                    self._state.update(flips)
-                    self._flipper.next(True)
-                else:
-                    self._flipper.next(False)
+                    self._kernel_accepted[i] += 1
+                    state.update(flips)
+                kernel.feedback(accepted)
+                if accepted:
+                    if mixture:
+                        for other in kernels:
+                            if other is not kernel and other.stateful:
+                                other.reset(state.spin)
+                    x_new = state.log_wf().real
+                    self._kernel_jumps[i] += (x_new - x) ** 2
+                    x = x_new
 
         return do_generate()
 
 
-class WorthlessConfiguration(Exception):
-    def __init__(self, flips):
-        super().__init__("The current spin configuration has too low a weight.")
-        self.suggestion = flips
-
-
-class Heisenberg(object):
+class ParallelTemperingMC(object):
     """
-    Isotropic Heisenberg Hamiltonian on a lattice.
+    Replica-exchange (parallel tempering) Markov chain.
+
+    Replicas sample |ψ|^(2β) for a ladder of inverse temperatures
+    β₀ = 1 > β₁ > ... > 0. Every step (sweep) each replica proposes one
+    exchange of a random up spin with a random down spin; all proposals are
+    evaluated in one batched forward pass (see :py:meth:`Machine.log_wf_batch`).
+    Every ``swap_every`` sweeps neighbouring replicas attempt to swap their
+    configurations (alternating between even and odd pairs). Only the β = 1
+    replica is exposed, so the chain can be used wherever
+    :py:class:`MetropolisMC` is.
     """
 
-    def __init__(self, edges: List[Tuple[int, int]]):
+    def __init__(
+        self, machine, spin: np.ndarray, betas, hamiltonian=None, swap_every: int = 1
+    ):
         """
-        Initialises the Hamiltonian given a list of edges.
+        :param betas: Inverse temperatures. Must start with 1 and decrease.
+        :param int swap_every: Number of sweeps between swap attempts.
         """
-        self._graph = edges
-        smallest = min(map(min, edges))
-        largest = max(map(max, edges))
-        if smallest != 0:
-            ValueError(
-                "Invalid graph: Counting from 0, but the minimal index "
-                "present is {}.".format(smallest)
+        betas = np.asarray(betas, dtype=np.float64)
+        if (
+            betas.ndim != 1
+            or betas[0] != 1.0
+            or np.any(betas <= 0)
+            or np.any(np.diff(betas) >= 0)
+        ):
+            raise ValueError(
+                "Invalid temperature ladder: {}; β's must start with 1 and be "
+                "strictly decreasing and positive.".format(betas)
             )
-        self._number_spins = largest + 1
+        if swap_every < 1:
+            raise ValueError("Invalid swap interval: {}".format(swap_every))
+        self._machine = machine
+        self._hamiltonian = hamiltonian
+        self._betas = betas
+        self._swap_every = swap_every
+        number_replicas = betas.size
+        # Replicas other than β = 1 start from random permutations of `spin`
+        # (which preserve the magnetisation).
+        self._spins = np.empty((number_replicas, spin.size), dtype=np.float32)
+        self._spins[0] = spin
+        for r in range(1, number_replicas):
+            self._spins[r] = np.random.permutation(spin)
+        self._proposed = np.empty_like(self._spins)
+        self.restart_()
+
+    def _reset_statistics(self):
+        number_replicas = self._betas.size
+        self._steps = 0
+        self._accepted = 0
+        self._replica_accepted = np.zeros(number_replicas, dtype=np.int64)
+        self._swaps_proposed = np.zeros(number_replicas - 1, dtype=np.int64)
+        self._swaps_accepted = np.zeros(number_replicas - 1, dtype=np.int64)
+        # Round trips: walker w (the replica which started in slot w) makes a
+        # round trip when it travels from β = 1 to the smallest β and back.
+        self._walkers = np.arange(number_replicas)
+        self._last_end = np.full(number_replicas, -1, dtype=np.int64)
+        self._last_end[0] = 0
+        self._trip_start = np.zeros(number_replicas, dtype=np.int64)
+        self._round_trips = []
 
-    def __call__(self, state: MonteCarloState) -> np.complex64:
+    @property
+    def spin(self) -> np.ndarray:
         """
-        Calculates local energy in the given state.
+        Returns the current spin configuration of the β = 1 replica.
         """
-        spin = state.spin
-        energy = 0
-        for (i, j) in self._graph:
-            if spin[i] == spin[j]:
-                energy += 1
-            else:
-                assert spin[i] == -spin[j]
-                x = state.log_quot_wf([i, j])
-                if x.real > 5.5:
-                    raise WorthlessConfiguration([i, j])
-                energy += -1 + 2 * cmath.exp(x)
-        return np.complex64(energy)
+        return self._state.spin
 
-    def reachable_from(self, spin):
-        reachable = []
-        for (i, j) in filter(lambda x: spin[x[0]] != spin[x[1]], self._graph):
-            assert spin[i] == -spin[j]
-            reachable.append(spin.copy())
-            reachable[-1][[i, j]] *= -1
-        return reachable
+    def restart_(self, spin: Optional[np.ndarray] = None):
+        """
+        Same as :py:meth:`MetropolisMC.restart_`. If ``spin`` is given, only
+        the β = 1 replica jumps to it.
+        """
+        if spin is not None:
+            self._spins[0] = spin
+        self._log_wf = self._machine.log_wf_batch(self._spins).real
+        self._state = MonteCarloState(self._machine, self._spins[0], self._hamiltonian)
+        self._sweeps = 0
+        self._reset_statistics()
+        return self
 
-    @property
-    def number_spins(self) -> int:
-        return self._number_spins
+    def _sweep(self):
+        spins = self._spins
+        proposed = self._proposed
+        proposed[:] = spins
+        flips = []
+        for r in range(spins.shape[0]):
+            ups = np.flatnonzero(spins[r] == 1.0)
+            downs = np.flatnonzero(spins[r] != 1.0)
+            i = int(ups[np.random.randint(ups.size)])
+            j = int(downs[np.random.randint(downs.size)])
+            proposed[r, i] *= -1
+            proposed[r, j] *= -1
+            flips.append([i, j])
+        log_wf = self._machine.log_wf_batch(proposed).real
+        log_u = np.log(np.random.random(spins.shape[0]))
+        accepted = 2 * self._betas * (log_wf - self._log_wf) > log_u
+        for r in np.flatnonzero(accepted):
+            spins[r] = proposed[r]
+            self._log_wf[r] = log_wf[r]
+        self._replica_accepted += accepted
+        if accepted[0]:
+            self._accepted += 1
+            self._state.update(flips[0])
+
+    def _swap(self):
+        betas = self._betas
+        if betas.size == 1:
+            return
+        log_u = np.log(np.random.random(betas.size))
+        for r in range(self._sweeps // self._swap_every % 2, betas.size - 1, 2):
+            self._swaps_proposed[r] += 1
+            # Acceptance probability is
+            # min(1, |ψ(S_{r+1})/ψ(S_r)|^{2(β_r - β_{r+1})})
+            log_p = (
+                2 * (betas[r] - betas[r + 1]) * (self._log_wf[r + 1] - self._log_wf[r])
+            )
+            if log_p > log_u[r]:
+                self._swaps_accepted[r] += 1
+                self._spins[[r, r + 1]] = self._spins[[r + 1, r]]
+                self._log_wf[[r, r + 1]] = self._log_wf[[r + 1, r]]
+                self._walkers[[r, r + 1]] = self._walkers[[r + 1, r]]
+                if r == 0:
+                    self._state = MonteCarloState(
+                        self._machine, self._spins[0], self._hamiltonian
+                    )
+        # Round trip bookkeeping
+        top = self._walkers[0]
+        bottom = self._walkers[-1]
+        self._last_end[bottom] = betas.size - 1
+        if self._last_end[top] == betas.size - 1:
+            self._round_trips.append(self._sweeps - self._trip_start[top])
+        if self._last_end[top] != 0:
+            self._trip_start[top] = self._sweeps
+        self._last_end[top] = 0
+
+    def swap_rates(self) -> np.ndarray:
+        """
+        Returns the swap acceptance rates of neighbouring pairs of replicas.
+        """
+        return self._swaps_accepted / np.maximum(self._swaps_proposed, 1)
 
+    def log_statistics(self):
+        logging.info(
+            "Acceptance rate: {:.2f}%".format(self._accepted / self._steps * 100)
+        )
+        logging.info(
+            "Replica acceptance rates: {}".format(
+                ", ".join(
+                    "β={:.3g}: {:.2%}".format(beta, rate)
+                    for (beta, rate) in zip(
+                        self._betas, self._replica_accepted / max(self._sweeps, 1)
+                    )
+                )
+            )
+        )
+        if self._betas.size == 1:
+            return
+        logging.info(
+            "Swap rates: {}".format(
+                ", ".join("{:.2%}".format(rate) for rate in self.swap_rates())
+            )
+        )
+        if self._round_trips:
+            logging.info(
+                "Round trips: {}, mean round-trip time {:.1f} sweeps".format(
+                    len(self._round_trips), np.mean(self._round_trips)
+                )
+            )
+        else:
+            logging.info("Round trips: none completed")
 
-def _load_hamiltonian(in_file):
-    specs = []
-    for (coupling, edges) in map(
-        lambda x: x.strip().split(maxsplit=1),
-        filter(lambda x: not x.startswith("#"), in_file),
-    ):
-        coupling = float(coupling)
-        # TODO: Parse the edges properly, it's not that difficult...
-        edges = eval(edges)
-        specs.append((coupling, edges))
-    # TODO: Generalise Heisenberg to support multiple graphs with different
+    def __iter__(self):
+        def do_generate():
+            while True:
+                self._steps += 1
+                yield self._state
+                self._sweep()
+                self._sweeps += 1
+                if self._sweeps % self._swap_every == 0:
+                    self._swap()
+
+        return do_generate()
+
+
+def temperature_ladder(number_replicas: int, beta_min: float) -> np.ndarray:
+    """
+    Returns a geometric ladder of ``number_replicas`` inverse temperatures
+    from 1 down to ``beta_min``.
+    """
+    if number_replicas == 1:
+        return np.ones(1)
+    return np.geomspace(1.0, beta_min, number_replicas)
+
+
+def _supports_direct_sampling(machine) -> bool:
+    """
+    Returns whether ``machine`` can draw configurations from |ψ|² directly,
+    i.e. whether it has a ``sample(batch_size)`` method.
+    """
+    return callable(getattr(machine, "sample", None))
+
+
+class DirectSampler(object):
+    """
+    "Chain" of independent configurations drawn exactly from |ψ|² by a
+    network which supports direct sampling, i.e. has a ``sample(batch_size)``
+    method returning a ``(batch_size, number_spins)`` tensor of ±1's (see
+    :py:mod:`nqs_playground.autoregressive`). It can be used wherever
+    :py:class:`MetropolisMC` is, but there is nothing to thermalise and no
+    autocorrelation, so thermalisation and thinning are skipped (see
+    :py:func:`_chain_steps`).
+    """
+
+    def __init__(self, machine, hamiltonian=None, batch_size: int = 1024):
+        """
+        :param int batch_size: Number of configurations drawn at once.
+        """
+        if batch_size < 1:
+            raise ValueError("Invalid batch size: {}".format(batch_size))
+        self._machine = machine
+        self._hamiltonian = hamiltonian
+        self._batch_size = batch_size
+        self._state = None
+        self.restart_()
+
+    @property
+    def spin(self) -> np.ndarray:
+        """
+        Returns the last sampled spin configuration or ``None`` if nothing
+        has been sampled yet.
+        """
+        return None if self._state is None else self._state.spin
+
+    def restart_(self, spin: Optional[np.ndarray] = None):
+        """
+        Discards configurations which were drawn but not used yet (they might
+        have been sampled with old variational parameters) and resets the
+        statistics. ``spin`` is ignored: samples are independent anyway.
+        """
+        self._spins = np.empty((0, self._machine.number_spins), dtype=np.float32)
+        self._k = 0
+        self._steps = 0
+        self._batches = 0
+        return self
+
+    def _draw(self) -> np.ndarray:
+        spins = self._machine.sample(self._batch_size).numpy().astype(np.float32)
+        # Fills the cache, so that MonteCarloState doesn't need to run the
+        # network again.
+        self._machine.log_wf_batch(spins)
+        self._batches += 1
+        return spins
+
+    def log_statistics(self):
+        logging.info(
+            "Direct sampling: {} independent configurations drawn in {} "
+            "batches".format(self._steps, self._batches)
+        )
+
+    def __iter__(self):
+        def do_generate():
+            while True:
+                if self._k == len(self._spins):
+                    self._spins = self._draw()
+                    self._k = 0
+                self._state = MonteCarloState(
+                    self._machine, self._spins[self._k], self._hamiltonian
+                )
+                self._k += 1
+                self._steps += 1
+                yield self._state
+
+        return do_generate()
+
+
+class WorthlessConfiguration(Exception):
+    def __init__(self, flips):
+        super().__init__("The current spin configuration has too low a weight.")
+        self.suggestion = flips
+
+
+class Heisenberg(object):
+    """
+    Isotropic Heisenberg Hamiltonian on a lattice.
+    """
+
+    def __init__(self, edges: List[Tuple[int, int]]):
+        """
+        Initialises the Hamiltonian given a list of edges.
+        """
+        self._graph = edges
+        smallest = min(map(min, edges))
+        largest = max(map(max, edges))
+        if smallest != 0:
+            ValueError(
+                "Invalid graph: Counting from 0, but the minimal index "
+                "present is {}.".format(smallest)
+            )
+        self._number_spins = largest + 1
+        # Reused by __call__ to avoid allocating a list per edge
+        self._flips = [0, 0]
+        # Indices of edges touching every site
+        adjacency = [[] for _ in range(self._number_spins)]
+        for k, (i, j) in enumerate(edges):
+            adjacency[i].append(k)
+            if j != i:
+                adjacency[j].append(k)
+        self._adjacency = [tuple(x) for x in adjacency]
+
+    class Bonds(object):
+        """
+        Running set of anti-aligned bonds and the corresponding diagonal
+        energy ∑ᵢⱼ σᶻᵢσᶻⱼ for a spin configuration.
+        """
+
+        def __init__(self, hamiltonian, spin: np.ndarray):
+            self.hamiltonian = hamiltonian
+            self._graph = hamiltonian.edges
+            self._adjacency = hamiltonian.adjacency
+            self.anti_aligned = set(
+                k for (k, (i, j)) in enumerate(self._graph) if spin[i] != spin[j]
+            )
+            self.diagonal = len(self._graph) - 2 * len(self.anti_aligned)
+
+        def update(self, spin: np.ndarray, flips: List[int]):
+            """
+            Updates the bonds after ``flips`` have been applied to ``spin``.
+            Only the edges touching flipped sites are visited.
+            """
+            graph = self._graph
+            anti_aligned = self.anti_aligned
+            for site in flips:
+                for k in self._adjacency[site]:
+                    i, j = graph[k]
+                    if spin[i] != spin[j]:
+                        anti_aligned.add(k)
+                    else:
+                        anti_aligned.discard(k)
+            self.diagonal = len(graph) - 2 * len(anti_aligned)
+
+    def track(self, spin: np.ndarray) -> "Heisenberg.Bonds":
+        """
+        Returns an object keeping track of the anti-aligned bonds in ``spin``.
+        It is meant to be stored in a :py:class:`MonteCarloState` and updated
+        on every accepted move.
+        """
+        return Heisenberg.Bonds(self, spin)
+
+    def __call__(self, state: MonteCarloState) -> np.complex64:
+        """
+        Calculates local energy in the given state.
+        """
+        spin = state.spin
+        flips = self._flips
+        bonds = getattr(state, "bonds", None)
+        if bonds is not None and bonds.hamiltonian is self:
+            # The diagonal part is already known, so only the off-diagonal
+            # terms (anti-aligned bonds) need to be computed.
+            energy = bonds.diagonal
+            for k in bonds.anti_aligned:
+                i, j = self._graph[k]
+                flips[0] = i
+                flips[1] = j
+                x = state.log_quot_wf(flips)
+                if x.real > 5.5:
+                    raise WorthlessConfiguration([i, j])
+                energy += 2 * cmath.exp(x)
+            return np.complex64(energy)
+        energy = 0
+        for (i, j) in self._graph:
+            if spin[i] == spin[j]:
+                energy += 1
+            else:
+                assert spin[i] == -spin[j]
+                flips[0] = i
+                flips[1] = j
+                x = state.log_quot_wf(flips)
+                if x.real > 5.5:
+                    raise WorthlessConfiguration([i, j])
+                energy += -1 + 2 * cmath.exp(x)
+        return np.complex64(energy)
+
+    def reachable_from(self, spin):
+        reachable = []
+        for (i, j) in filter(lambda x: spin[x[0]] != spin[x[1]], self._graph):
+            assert spin[i] == -spin[j]
+            reachable.append(spin.copy())
+            reachable[-1][[i, j]] *= -1
+        return reachable
+
+    @property
+    def number_spins(self) -> int:
+        return self._number_spins
+
+    @property
+    def edges(self) -> List[Tuple[int, int]]:
+        return self._graph
+
+    @property
+    def adjacency(self) -> List[Tuple[int, ...]]:
+        """
+        Returns, for every site, the indices (into :py:attr:`edges`) of the
+        edges touching it.
+        """
+        return self._adjacency
+
+
+def _load_hamiltonian(in_file):
+    specs = []
+    for (coupling, edges) in map(
+        lambda x: x.strip().split(maxsplit=1),
+        filter(lambda x: not x.startswith("#"), in_file),
+    ):
+        coupling = float(coupling)
+        # TODO: Parse the edges properly, it's not that difficult...
+        edges = eval(edges)
+        specs.append((coupling, edges))
+    # TODO: Generalise Heisenberg to support multiple graphs with different
     # couplings
     if len(specs) != 1:
         raise NotImplementedError("Multiple couplings are not yet supported.")
@@ -504,36 +1744,182 @@ def read_hamiltonian(in_file):
     return _load_hamiltonian(in_file)
 
 
-def monte_carlo_loop(machine, hamiltonian, initial_spin, steps):
+def _as_chain(machine, initial_spin, hamiltonian=None) -> MetropolisMC:
+    if isinstance(initial_spin, (MetropolisMC, ParallelTemperingMC, DirectSampler)):
+        return initial_spin
+    if _supports_direct_sampling(machine):
+        return DirectSampler(machine, hamiltonian)
+    return MetropolisMC(machine, initial_spin, hamiltonian)
+
+
+def _chain_steps(chain, steps):
+    """
+    Returns the ``(start, stop, step)`` slice of ``chain`` to use. For a
+    :py:class:`DirectSampler` thermalisation and thinning are dropped while
+    the number of samples is preserved.
+    """
+    if isinstance(chain, DirectSampler):
+        return (0, len(range(*steps)), 1)
+    return steps
+
+
+def monte_carlo_loop(
+    machine, hamiltonian, initial_spin, steps, deduplicate=False, record=None
+):
     """
     Runs the Monte-Carlo simulation.
 
-    :return: (all gradients, mean gradient, mean local energy, force)
+    :param initial_spin:
+        Either the initial spin configuration or an existing
+        :py:class:`MetropolisMC` which is then continued.
+    :param bool deduplicate:
+        If ``True``, the chain is collapsed into unique spin configurations
+        with visit counts. Gradients are then computed once per unique
+        configuration and all statistics are weighted. The matrix of
+        gradients thus has as many rows as there are unique configurations
+        rather than Monte Carlo steps.
+    :return: (all gradients, mean gradient, mean local energy, variance of
+             local energy, force, weights). ``weights`` are the normalised
+             visit counts of the configurations corresponding to rows of the
+             gradients matrix if ``deduplicate`` is ``True`` and ``None``
+             otherwise.
+    :param dict record:
+        Only used when ``deduplicate`` is ``True``. If given, the unique
+        configurations (``"spins"``), their visit counts (``"visits"``) and
+        log|Ψ| (``"log_wf"``) are stored in it so that the samples can later
+        be reused by :py:func:`reweight_samples`.
     """
-    derivatives = []
-    energies = []
+    if deduplicate:
+        return _monte_carlo_loop_deduplicated(
+            machine, hamiltonian, initial_spin, steps, record=record
+        )
+    number_samples = len(range(*steps))
+    derivatives = np.empty((number_samples, machine.size), dtype=np.complex64)
+    energies = np.empty((number_samples,), dtype=np.complex64)
     energies_cache = {}
-    chain = MetropolisMC(machine, initial_spin)
-    for state in islice(chain, *steps):
-        derivatives.append(state.der_log_wf())
+    chain = _as_chain(machine, initial_spin, hamiltonian)
+    steps = _chain_steps(chain, steps)
+    for k, state in enumerate(_allocations.trace(islice(chain, *steps))):
         spin = CompactSpin(state.spin)
+        state.der_log_wf(out=derivatives[k], key=spin)
         e_loc = energies_cache.get(spin)
         if e_loc is None:
             e_loc = hamiltonian(state)
             energies_cache[spin] = e_loc
-        energies.append(e_loc)
-    derivatives = np.array(derivatives, dtype=np.complex64)
-    energies = np.array(energies, dtype=np.complex64)
+        energies[k] = e_loc
     mean_O = np.mean(derivatives, axis=0)
     mean_E = np.mean(energies)
     std_E = np.std(energies)
     force = np.mean(energies * derivatives.conj().transpose(), axis=1)
     force -= mean_O.conj() * mean_E
     logging.info("Subspace dimension: {}".format(len(energies_cache)))
+    chain.log_statistics()
+    return derivatives, mean_O, mean_E, std_E ** 2, force, None
+
+
+def _weighted_statistics(machine, hamiltonian, spins, weights, energies=None):
+    """
+    Computes Monte Carlo estimates from a set of unique spin configurations
+    with (not necessarily normalised) weights.
+
+    :param spins: Unique spin configurations (rows of a 2D array of ``float32``).
+    :param weights: Non-negative weights of the configurations.
+    :param energies: Local energies of the configurations. If ``None``, they
+                     are computed here.
+    :return: (all gradients, mean gradient, mean local energy, variance of
+             local energy, force, normalised weights).
+    """
+    derivatives = np.empty((len(spins), machine.size), dtype=np.complex64)
+    if energies is None:
+        energies = np.empty((len(spins),), dtype=np.complex64)
+        for i, spin in enumerate(spins):
+            energies[i] = hamiltonian(MonteCarloState(machine, spin))
+    machine.der_log_wf_batch(spins, out=derivatives)
+    weights = np.asarray(weights, dtype=np.float32)
+    weights = weights / np.sum(weights)
+    mean_O = np.dot(weights, derivatives)
+    mean_E = np.dot(weights, energies)
+    var_E = np.dot(weights, np.abs(energies - mean_E) ** 2)
+    force = np.dot(weights * energies, derivatives.conj())
+    force -= mean_O.conj() * mean_E
+    return derivatives, mean_O, mean_E, var_E, force, weights
+
+
+def _monte_carlo_loop_deduplicated(
+    machine, hamiltonian, initial_spin, steps, record=None
+):
+    """
+    Implementation of :py:func:`monte_carlo_loop` with ``deduplicate=True``.
+    """
+    spins, energies, visits = _unique_loop(machine, hamiltonian, initial_spin, steps)
+    answer = _weighted_statistics(machine, hamiltonian, spins, visits, energies)
+    if record is not None:
+        record["spins"] = spins
+        record["visits"] = visits
+        record["log_wf"] = np.array(
+            [machine.log_wf(spin).real for spin in spins], dtype=np.float64
+        )
+    return answer
+
+
+def _unique_loop(machine, hamiltonian, initial_spin, steps):
+    """
+    Runs the Markov chain and collapses it into unique spin configurations.
+
+    :return: (spins, local energies, visit counts).
+    """
+    # Maps CompactSpin to [spin, local energy, number of visits]
+    visited = {}
+    chain = _as_chain(machine, initial_spin, hamiltonian)
+    steps = _chain_steps(chain, steps)
+    for state in _allocations.trace(islice(chain, *steps)):
+        spin = CompactSpin(state.spin)
+        cell = visited.get(spin)
+        if cell is None:
+            visited[spin] = [np.copy(state.spin), hamiltonian(state), 1]
+        else:
+            cell[2] += 1
+    spins = np.array([cell[0] for cell in visited.values()], dtype=np.float32)
+    energies = np.array([cell[1] for cell in visited.values()], dtype=np.complex64)
+    visits = np.array([cell[2] for cell in visited.values()], dtype=np.float32)
     logging.info(
-        "Acceptance rate: {:.2f}%".format(chain._accepted / chain._steps * 100)
+        "Subspace dimension: {} (duplication factor {:.1f})".format(
+            len(visited), np.sum(visits) / len(visited)
+        )
     )
-    return derivatives, mean_O, mean_E, std_E ** 2, force
+    chain.log_statistics()
+    return spins, energies, visits
+
+
+def reweight_samples(machine, hamiltonian, samples, ess_threshold):
+    """
+    Reuses configurations sampled from an earlier |Ψ'|² to estimate
+    statistics for the current |Ψ|² via importance sampling.
+
+    All configurations are re-evaluated in one batched pass (see
+    :py:meth:`Machine.log_wf_batch`) and get weights
+    ``visits · |Ψ(x)/Ψ'(x)|²``.
+
+    :param dict samples: Record filled in by :py:func:`monte_carlo_loop`.
+    :param float ess_threshold: Minimal acceptable effective sample size as a
+                                fraction of the total number of visits.
+    :return: Same as :py:func:`monte_carlo_loop` with ``deduplicate=True``
+             or ``None`` if the effective sample size dropped below
+             ``ess_threshold``.
+    """
+    visits = samples["visits"]
+    log_wf = machine.log_wf_batch(samples["spins"]).real
+    log_ratio = 2 * (log_wf - samples["log_wf"])
+    ratio = np.exp(log_ratio - np.max(log_ratio))
+    weights = visits * ratio
+    ess = np.sum(weights) ** 2 / np.sum(visits * ratio**2) / np.sum(visits)
+    if ess < ess_threshold:
+        logging.info(
+            "Effective sample size {:.1f}% is below the threshold".format(100 * ess)
+        )
+        return None
+    logging.info("Reusing samples, effective sample size {:.1f}%".format(100 * ess))
+    return _weighted_statistics(machine, hamiltonian, samples["spins"], weights)
 
 
 def monte_carlo_loop_for_lanczos(machine, hamiltonian, initial_spin, steps):
@@ -541,7 +1927,8 @@ def monte_carlo_loop_for_lanczos(machine, hamiltonian, initial_spin, steps):
     energies = []
     energies_cache = {}
     wave_function = {}
-    chain = MetropolisMC(machine, initial_spin)
+    chain = _as_chain(machine, initial_spin, hamiltonian)
+    steps = _chain_steps(chain, steps)
     for state in islice(chain, *steps):
         spin = CompactSpin(state.spin)
         e_loc = energies_cache.get(spin)
@@ -556,43 +1943,106 @@ def monte_carlo_loop_for_lanczos(machine, hamiltonian, initial_spin, steps):
     mean_E = np.mean(energies)
     std_E = np.std(energies)
     logging.info("Subspace dimension: {}".format(len(wave_function)))
-    logging.info(
-        "Acceptance rate: {:.2f}%".format(chain._accepted / chain._steps * 100)
-    )
+    chain.log_statistics()
     logging.info("E = {}, Var[E] = {}".format(mean_E, std_E ** 2))
     return mean_E, std_E ** 2, wave_function
 
 
-def compute_l2_norm(machine, initial_spin, steps):
-    _old_dps = mpmath.mp.dps
-    mpmath.mp.dps = 50
-    wave_function = {}
+def _log_mean_exp(x: np.ndarray) -> float:
+    """
+    Computes log(mean(exp(x))) without overflowing.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    x_max = np.max(x)
+    if not np.isfinite(x_max):
+        return float(x_max)
+    return float(x_max + np.log(np.mean(np.exp(x - x_max))))
+
+
+def log_l2_norm(machine, initial_spin, steps) -> float:
+    """
+    Estimates log(‖ψ‖₂) where ‖ψ‖₂² is the mean of |ψ(S)|² over the unique
+    spin configurations S visited by the Markov chain.
+
+    The sum is computed in the log-domain (log-sum-exp), so it can't
+    overflow even if the amplitudes can't be represented as floats.
+    """
+    log_amplitudes = {}
     chain = MetropolisMC(machine, initial_spin)
     for state in islice(chain, *steps):
-        spin = CompactSpin(state.spin)
-        wave_function[spin] = mpmath.exp(mpmath.mpc(state.log_wf()))
-    l2_norm = mpmath.sqrt(
-        sum(map(lambda x: mpmath.fabs(x) ** 2, wave_function.values()), mpmath.mpf(0))
-        / len(wave_function)
+        log_amplitudes[CompactSpin(state.spin)] = state.log_wf().real
+    log_amplitudes = np.fromiter(
+        log_amplitudes.values(), dtype=np.float64, count=len(log_amplitudes)
+    )
+    # |ψ(S)|² = exp(2·Re[log(ψ(S))])
+    return 0.5 * _log_mean_exp(2.0 * log_amplitudes)
+
+
+def compute_l2_norm(machine, initial_spin, steps) -> float:
+    """
+    Same as :py:func:`log_l2_norm`, but returns ‖ψ‖₂ itself.
+    """
+    return float(np.exp(log_l2_norm(machine, initial_spin, steps)))
+
+
+def monte_carlo(
+    machine, hamiltonian, initial_spin, steps, deduplicate=False, record=None
+):
+    """
+    Runs :py:func:`monte_carlo_loop` restarting it (from a slightly modified
+    configuration) when the chain gets stuck in a configuration with too low
+    a weight.
+
+    :param initial_spin: Either the initial spin configuration or an existing
+                         :py:class:`MetropolisMC` which is then continued.
+    """
+    return _with_restarts(
+        lambda chain: monte_carlo_loop(
+            machine,
+            hamiltonian,
+            chain,
+            steps,
+            deduplicate=deduplicate,
+            record=record,
+        ),
+        machine,
+        initial_spin,
+        hamiltonian,
+    )
+
+
+def sample_unique(machine, hamiltonian, initial_spin, steps):
+    """
+    Runs the Monte Carlo simulation (restarting it like
+    :py:func:`monte_carlo`), but instead of computing gradients returns the
+    unique configurations which were visited.
+
+    :return: (spins, local energies, visit counts).
+    """
+    return _with_restarts(
+        lambda chain: _unique_loop(machine, hamiltonian, chain, steps),
+        machine,
+        initial_spin,
+        hamiltonian,
     )
-    mpmath.mp.dps = _old_dps
-    return float(l2_norm)
 
 
-def monte_carlo(machine, hamiltonian, initial_spin, steps):
+def _with_restarts(loop, machine, initial_spin, hamiltonian=None):
     logging.info("Running Monte-Carlo...")
     start = time.time()
     restarts = 5
-    spin = np.copy(initial_spin)
+    chain = _as_chain(machine, initial_spin, hamiltonian)
     answer = None
     while answer is None:
         try:
-            answer = monte_carlo_loop(machine, hamiltonian, spin, steps)
+            answer = loop(chain)
         except WorthlessConfiguration as err:
             if restarts > 0:
                 logging.warning("Restarting the Monte-Carlo simulation...")
                 restarts -= 1
+                spin = np.copy(chain.spin)
                 spin[err.suggestion] *= -1
+                chain.restart_(spin)
             else:
                 raise
     finish = time.time()
@@ -683,20 +2133,29 @@ def monte_carlo(machine, hamiltonian, initial_spin, steps):
 #         return x
 
 
-class Covariance(LinearOperator):
+class Covariance(object):
     """
     Covariance matrix matrix S.
     """
 
-    def __init__(self, gradients, mean_gradient, regulariser):
+    def __init__(self, gradients, mean_gradient, regulariser, weights=None):
         """
+        :param weights: Normalised weights of the rows of ``gradients`` (see
+                        :py:func:`monte_carlo_loop`). ``None`` means that all
+                        rows have equal weight.
         """
         (steps, n) = gradients.shape
-        super().__init__(np.float32, (n, n))
+        self.shape = (n, n)
+        self.dtype = np.dtype(np.float32)
         self._gradients = gradients - mean_gradient
+        if weights is None:
+            self._scale = 1 / steps
+        else:
+            # S = ∑ᵢ wᵢ(Oᵢ - 〈O〉)†(Oᵢ - 〈O〉), so we scale rows by √wᵢ
+            self._gradients *= np.sqrt(weights)[:, np.newaxis]
+            self._scale = 1
         self._conj_gradients = self._gradients.transpose().conj()
         self._lambda = regulariser
-        self._scale = 1 / steps
 
     def _S(self, x: np.ndarray):
         assert x.dtype == np.complex64
@@ -740,8 +2199,12 @@ class Covariance(LinearOperator):
         assert b.dtype == np.complex64
         start = time.time()
         logging.info("Calculating S⁻¹F...")
+        from scipy.sparse.linalg import LinearOperator, lgmres
+
         b_ = np.ascontiguousarray(self._S(b).real)
-        x, info = scipy.sparse.linalg.lgmres(self, b_, x0)
+        x, info = lgmres(
+            LinearOperator(self.shape, matvec=self._matvec, dtype=self.dtype), b_, x0
+        )
         finish = time.time()
         if info == 0:
             logging.info("Done in {:.2f} seconds!".format(finish - start))
@@ -752,6 +2215,223 @@ class Covariance(LinearOperator):
         raise ValueError("The hell has just happened?")
 
 
+def _all_reduce_(x: np.ndarray) -> np.ndarray:
+    """
+    Sums ``x`` over all processes of the default ``torch.distributed`` group
+    in place and returns it. ``x`` must be contiguous.
+    """
+    if np.iscomplexobj(x):
+        dist.all_reduce(torch.from_numpy(x.view(x.real.dtype)))
+    else:
+        dist.all_reduce(torch.from_numpy(x))
+    return x
+
+
+def _broadcast_(x: np.ndarray, src: int = 0) -> np.ndarray:
+    """
+    Overwrites ``x`` with its value on process ``src``.
+    """
+    if np.iscomplexobj(x):
+        dist.broadcast(torch.from_numpy(x.view(x.real.dtype)), src)
+    else:
+        dist.broadcast(torch.from_numpy(x), src)
+    return x
+
+
+def _all_reduce_statistics(answer):
+    """
+    Combines results of :py:func:`monte_carlo_loop` obtained by all processes
+    into global estimates. All processes must have run chains of the same
+    length, so that every process carries the same total weight.
+
+    Rows of the gradients matrix (and their weights) stay local, only the
+    means, the variance and the force are replaced by global ones, i.e. the
+    matrix of gradients becomes sharded by samples (see
+    :py:class:`DistributedCovariance`).
+    """
+    Os, mean_O, E, var_E, F, weights = answer
+    n = mean_O.size
+    # 〈O〉, 〈EO*〉, 〈E〉 and 〈|E|²〉 are averaged in one go
+    packed = np.empty((2 * n + 2,), dtype=np.complex128)
+    packed[:n] = mean_O
+    packed[n : 2 * n] = F + mean_O.conj() * E
+    packed[2 * n] = E
+    packed[2 * n + 1] = var_E + abs(E) ** 2
+    _all_reduce_(packed)
+    packed /= dist.get_world_size()
+    mean_O = packed[:n]
+    E = packed[2 * n]
+    var_E = packed[2 * n + 1].real - abs(E) ** 2
+    F = packed[n : 2 * n] - mean_O.conj() * E
+    return (
+        Os,
+        mean_O.astype(np.complex64),
+        np.complex64(E),
+        np.float32(var_E),
+        F.astype(np.complex64),
+        weights,
+    )
+
+
+class DistributedCovariance(Covariance):
+    """
+    Covariance matrix S with the matrix of gradients sharded by samples
+    across the processes of the default ``torch.distributed`` group.
+
+    Every process passes its own rows (see :py:func:`_all_reduce_statistics`)
+    and the global mean gradient. A product S·x is then a local product
+    followed by one all-reduce. All processes thus see the same operator and
+    run the same Krylov iteration.
+    """
+
+    def __init__(self, gradients, mean_gradient, regulariser, weights=None):
+        super().__init__(gradients, mean_gradient, regulariser, weights=weights)
+        # Every process carries 1/world_size of the total weight
+        self._scale /= dist.get_world_size()
+
+    def _S(self, x: np.ndarray):
+        return _all_reduce_(super()._S(x))
+
+
+class KFAC(object):
+    """
+    Kronecker-factored approximation of the covariance matrix S (K-FAC).
+
+    For an ``nn.Linear`` layer with (bias-augmented) input a and output s,
+    ∂log(Ψ(σ))/∂W = g ⊗ a where g = ∂log(Ψ(σ))/∂s. The corresponding block
+    of S is approximated by G ⊗ A with A = 〈(a - 〈a〉)(a - 〈a〉)ᵀ〉 and
+    G = Re〈(g - 〈g〉)†(g - 〈g〉)〉 (centring both factors stands in for the
+    subtraction of 〈O〉〈O〉† in S). Only these small factors are ever formed
+    and inverted, so the cost scales with layer widths rather than with the
+    number of samples times the number of parameters.
+
+    Every ``nn.Linear`` is assumed to be applied once per forward pass.
+    Parameters which do not belong to such a layer are updated with the
+    plain gradient.
+    """
+
+    def __init__(self, machine):
+        self._machine = machine
+        # Offsets of the parameters in the flattened parameter vector
+        self._offsets = dict(zip(machine.parameters(), machine.parameter_offsets))
+        self._layers = [m for m in machine.modules() if isinstance(m, nn.Linear)]
+        if not self._layers:
+            raise ValueError("K-FAC requires at least one nn.Linear layer.")
+
+    def _forward(self, spins):
+        """
+        Batched forward propagation which records inputs and outputs of all
+        ``nn.Linear`` layers.
+        """
+        inputs = {}
+        outputs = {}
+
+        def hook(module, args, output):
+            inputs[module] = args[0].detach()
+            outputs[module] = output
+
+        handles = [m.register_forward_hook(hook) for m in self._layers]
+        try:
+            # NOTE: Hooks only fire in eager mode, so we bypass the compiled
+            # forward (see compile_network) if there is one.
+            machine = self._machine
+            y = type(machine).forward(machine, torch.from_numpy(spins))
+        finally:
+            for handle in handles:
+                handle.remove()
+        if tuple(y.size()) != (len(spins), 2):
+            raise ValueError("K-FAC requires a network which supports batched input.")
+        layers = [
+            m
+            for m in self._layers
+            if m in outputs and outputs[m].dim() == 2 and outputs[m].requires_grad
+        ]
+        return y, layers, inputs, outputs
+
+    def solve(self, spins, energies, weights, regulariser) -> np.ndarray:
+        """
+        Computes the preconditioned force (S + λ)⁻¹Re[F].
+
+        :param spins: Unique spin configurations (rows of a 2D array of ``float32``).
+        :param energies: Local energies of the configurations.
+        :param weights: Non-negative weights of the configurations.
+        :param float regulariser: λ. It is split between the two factors
+                                  using π-damping.
+        :return: Update for the variational parameters as a numpy array of
+                 ``float32``.
+        """
+        start = time.time()
+        logging.info("Calculating K-FAC update...")
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = weights / np.sum(weights)
+        energies = np.asarray(energies, dtype=np.complex128)
+        energies = energies - np.dot(weights, energies)
+        y, layers, inputs, outputs = self._forward(
+            np.ascontiguousarray(spins, dtype=np.float32)
+        )
+        parameters = list(self._machine.parameters())
+        # Re[F] = ∇ ∑ᵢ wᵢ Re[(Eᵢ - 〈E〉)* log(Ψ(σᵢ))]
+        c_re = torch.from_numpy((weights * energies.real).astype(np.float32))
+        c_im = torch.from_numpy((weights * energies.imag).astype(np.float32))
+        force = torch.autograd.grad(
+            torch.dot(c_re, y[:, 0]) + torch.dot(c_im, y[:, 1]),
+            parameters,
+            retain_graph=True,
+            allow_unused=True,
+        )
+        delta = np.zeros((self._machine.size,), dtype=np.float64)
+        for p, f in zip(parameters, force):
+            if f is not None:
+                i = self._offsets[p]
+                delta[i : i + p.numel()] = f.view(-1).numpy()
+        if layers:
+            s = [outputs[m] for m in layers]
+            g_re = torch.autograd.grad(y[:, 0].sum(), s, retain_graph=True)
+            g_im = torch.autograd.grad(y[:, 1].sum(), s)
+            w = torch.from_numpy(weights)
+            for m, gr, gi in zip(layers, g_re, g_im):
+                self._precondition(m, inputs[m], gr, gi, w, regulariser, delta)
+        finish = time.time()
+        logging.info("Done in {:.2f} seconds!".format(finish - start))
+        return delta.astype(np.float32)
+
+    def _precondition(self, layer, a, g_re, g_im, w, regulariser, delta):
+        """
+        Replaces the gradient of ``layer`` in ``delta`` by
+        (G + γ/π)⁻¹ ∇W (A + πγ)⁻¹ where γ = √λ.
+        """
+        a = a.to(torch.float64)
+        a = a - w @ a
+        if layer.bias is not None:
+            a = torch.cat([a, torch.ones(a.size(0), 1, dtype=a.dtype)], dim=1)
+        A = (a * w[:, None]).t() @ a
+        G = torch.zeros(g_re.size(1), g_re.size(1), dtype=torch.float64)
+        for g in (g_re, g_im):
+            g = g.to(torch.float64)
+            g = g - w @ g
+            G += (g * w[:, None]).t() @ g
+        n_out, n_in = layer.weight.size()
+        i = self._offsets[layer.weight]
+        grad = delta[i : i + n_out * n_in].reshape(n_out, n_in)
+        if layer.bias is not None:
+            j = self._offsets[layer.bias]
+            grad = np.concatenate([grad, delta[j : j + n_out, np.newaxis]], axis=1)
+        grad = torch.from_numpy(grad)
+        # π-damping: distribute √λ between the factors according to their
+        # average eigenvalues
+        gamma = math.sqrt(regulariser)
+        trace_A = torch.trace(A).item() / A.size(0)
+        trace_G = torch.trace(G).item() / G.size(0)
+        pi = math.sqrt(trace_A / trace_G) if trace_A > 0 and trace_G > 0 else 1.0
+        A += pi * gamma * torch.eye(A.size(0), dtype=A.dtype)
+        G += gamma / pi * torch.eye(G.size(0), dtype=G.dtype)
+        x = torch.linalg.solve(G, grad)
+        x = torch.linalg.solve(A, x.t()).t().numpy()
+        delta[i : i + n_out * n_in] = x[:, :n_in].reshape(-1)
+        if layer.bias is not None:
+            delta[j : j + n_out] = x[:, n_in]
+
+
 def random_spin(n, magnetisation=None):
     if n <= 0:
         raise ValueError("Invalid number of spins: {}".format(n))
@@ -779,12 +2459,314 @@ def random_spin(n, magnetisation=None):
         return np.random.choice([np.float32(-1.0), np.float32(1.0)], size=n)
 
 
-class Optimiser(object):
-    def __init__(
-        self,
-        machine,
-        hamiltonian,
-        magnetisation,
+def _get_numpy_rng_state():
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return (name, keys.tolist(), position, has_gauss, cached_gaussian)
+
+
+def _set_numpy_rng_state(state):
+    name, keys, position, has_gauss, cached_gaussian = state
+    np.random.set_state(
+        (name, np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian)
+    )
+
+
+def _get_numba_rng_state():
+    """
+    Returns the state of the random number generator used by ``np.random``
+    functions in numba-compiled code (e.g. in ``_Flipper``). It is separate
+    from NumPy's one. ``None`` is returned if numba doesn't let us access it.
+    """
+    try:
+        from numba import _helperlib
+
+        return _helperlib.rnd_get_state(_helperlib.rnd_get_np_state_ptr())
+    except (ImportError, AttributeError):
+        return None
+
+
+def _set_numba_rng_state(state):
+    if state is None:
+        return
+    try:
+        from numba import _helperlib
+
+        _helperlib.rnd_set_state(_helperlib.rnd_get_np_state_ptr(), state)
+    except (ImportError, AttributeError):
+        logging.warning("Could not restore the state of numba's RNG.")
+
+
+def _atomic_save(obj, path: str, save=torch.save):
+    """
+    Serialises ``obj`` using ``save`` (``torch.save`` by default) to a
+    temporary file in the same directory as ``path`` and then atomically
+    renames it to ``path``. Thus ``path`` always contains a complete
+    checkpoint even if we're killed midway.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(
+        dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as out_file:
+            save(obj, out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class _CheckpointWriter(object):
+    """
+    Writes checkpoints to disk on a background thread so that the
+    optimisation loop never waits for I/O. If checkpoints are submitted
+    faster than they can be written, only the most recent one is kept.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._pending = None
+        self._busy = False
+        self._closed = False
+        # Duration of the slowest write so far in seconds
+        self.write_time = 0.0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, name="checkpoint-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, checkpoint: dict):
+        with self._condition:
+            if self._closed:
+                raise ValueError("Writer has already been closed.")
+            self._pending = checkpoint
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                checkpoint, self._pending = self._pending, None
+                self._busy = True
+            try:
+                start = time.time()
+                _atomic_save(checkpoint, self._path)
+                self.write_time = max(self.write_time, time.time() - start)
+                logging.debug(
+                    "Checkpoint (epoch {}) written in {:.2f} seconds.".format(
+                        checkpoint["epoch"], time.time() - start
+                    )
+                )
+            except Exception as e:
+                logging.error("Failed to write the checkpoint: {}".format(e))
+            with self._condition:
+                self._busy = False
+                self._condition.notify_all()
+
+    def flush(self):
+        """
+        Blocks until all submitted checkpoints are written.
+        """
+        with self._condition:
+            while self._pending is not None or self._busy:
+                self._condition.wait()
+
+    def close(self):
+        """
+        Writes the remaining checkpoint (if any) and stops the thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+class BudgetScheduler(object):
+    """
+    Fits the optimisation into a wall-clock budget.
+
+    Before every epoch :py:meth:`plan` chooses the number of Monte Carlo
+    samples so that the remaining epochs evenly use up the remaining time.
+    The cost of an epoch is modelled as ``a + b·samples`` and fitted to the
+    most recent epochs. The number of samples is kept within
+    ``[min_samples, max_samples]``. If even ``min_samples`` don't leave
+    enough time for all the remaining epochs, the epochs are run with
+    ``min_samples`` until the time runs out, i.e. the epoch count is reduced.
+    Some time is always kept in reserve for writing the final weights and
+    checkpoint.
+    """
+
+    def __init__(
+        self,
+        budget: float,
+        monte_carlo_steps: Tuple[int, int, int],
+        samples_range: Optional[Tuple[int, int]] = None,
+        safety: float = 0.05,
+        window: int = 5,
+    ):
+        """
+        :param float budget: Wall-clock budget in seconds.
+        :param monte_carlo_steps: Nominal ``(start, stop, step)`` (see
+                                  :py:func:`monte_carlo_loop`). Thermalisation
+                                  and the step are kept, only the number of
+                                  samples changes.
+        :param samples_range: Bounds ``(min_samples, max_samples)`` on the
+                              number of samples per epoch. Defaults to a
+                              quarter and four times the nominal number.
+        :param float safety: Fraction of the budget which is kept in reserve
+                             to absorb fluctuations of the epoch duration.
+        :param int window: Number of recent epochs used to fit the cost model.
+        """
+        if budget <= 0:
+            raise ValueError("Invalid time budget: {}".format(budget))
+        start, stop, step = monte_carlo_steps
+        samples = len(range(start, stop, step))
+        if samples_range is None:
+            samples_range = (max(1, samples // 4), 4 * samples)
+        min_samples, max_samples = samples_range
+        if not 1 <= min_samples <= max_samples:
+            raise ValueError("Invalid range of samples: {}".format(samples_range))
+        self._budget = budget
+        self._thermalisation = start
+        self._step = step
+        self._samples = min(max(samples, min_samples), max_samples)
+        self._min_samples = min_samples
+        self._max_samples = max_samples
+        self._safety = safety
+        # (number of samples, duration) of the most recent epochs
+        self._history = collections.deque(maxlen=window)
+        self._save_time = 0.0
+        self._deadline = None
+
+    def start(self):
+        """
+        Starts the clock.
+        """
+        self._deadline = time.time() + self._budget
+
+    @property
+    def remaining(self) -> float:
+        """
+        Returns the number of seconds left until the deadline.
+        """
+        return self._deadline - time.time()
+
+    def record_epoch(self, samples: int, duration: float):
+        self._history.append((samples, duration))
+
+    def record_save(self, duration: float):
+        self._save_time = max(self._save_time, duration)
+
+    def _cost_model(self) -> Tuple[float, float]:
+        """
+        Returns ``(a, b)`` such that an epoch with ``samples`` samples takes
+        ``a + b·samples`` seconds.
+        """
+        samples, durations = (
+            np.array(x, dtype=np.float64) for x in zip(*self._history)
+        )
+        if np.unique(samples).size > 1:
+            b, a = np.polyfit(samples, durations, 1)
+            if b > 0:
+                # A negative fixed cost would make small epochs look free
+                return max(a, 0.0), b
+        # Not enough information to separate the fixed cost, so we
+        # (pessimistically for larger epochs) attribute everything to sampling.
+        return 0.0, np.mean(durations / samples)
+
+    def plan(self, epochs_left: int, reserve: float = 0.0) -> Optional[int]:
+        """
+        Returns the number of samples for the next epoch or ``None`` if there
+        is no time left for another one.
+
+        :param int epochs_left: Number of epochs left including the next one.
+        :param float reserve: Time (in seconds) needed for saving the results
+                              on top of what has been recorded with
+                              :py:meth:`record_save`.
+        """
+        available = (
+            self.remaining - max(self._save_time, reserve) - self._safety * self._budget
+        )
+        if available <= 0:
+            return None
+        if not self._history:
+            # Nothing is known about the cost yet
+            return self._samples
+        a, b = self._cost_model()
+        samples = int((available / epochs_left - a) / b)
+        if samples >= self._min_samples:
+            return min(samples, self._max_samples)
+        if a + b * self._min_samples <= available:
+            return self._min_samples
+        return None
+
+    def monte_carlo_steps(self, samples: int) -> Tuple[int, int, int]:
+        """
+        Returns ``(start, stop, step)`` for ``samples`` samples.
+        """
+        start, step = self._thermalisation, self._step
+        return (start, start + samples * step, step)
+
+
+def init_distributed():
+    """
+    Joins the ``torch.distributed`` job described by the ``RANK``,
+    ``WORLD_SIZE``, ``MASTER_ADDR`` and ``MASTER_PORT`` environment
+    variables (as set by ``torchrun``) using the gloo backend.
+
+    :return: (rank, world size).
+    """
+    missing = [
+        name
+        for name in ("RANK", "WORLD_SIZE", "MASTER_ADDR", "MASTER_PORT")
+        if name not in os.environ
+    ]
+    if missing:
+        raise ValueError(
+            "Environment variable(s) {} not set. Use torchrun to launch "
+            "distributed jobs.".format(", ".join(missing))
+        )
+    dist.init_process_group(backend="gloo", init_method="env://")
+    return dist.get_rank(), dist.get_world_size()
+
+
+def _broadcast_parameters(module: nn.Module, src: int = 0):
+    """
+    Overwrites parameters and buffers of ``module`` with their values on
+    process ``src``.
+    """
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor.data, src)
+
+
+def _seed_process():
+    """
+    Seeds the random number generators of this process with a seed drawn on
+    rank 0 plus the rank. Processes thus sample independent chains, but the
+    whole run is reproducible.
+    """
+    seed = torch.tensor([np.random.randint(2**31 - 2**16)], dtype=torch.int64)
+    dist.broadcast(seed, 0)
+    seed = int(seed) + dist.get_rank()
+    np.random.seed(seed)
+    _seed_numba(seed)
+    torch.manual_seed(seed)
+
+
+class Optimiser(object):
+    def __init__(
+        self,
+        machine,
+        hamiltonian,
+        magnetisation,
         epochs,
         monte_carlo_steps,
         learning_rate,
@@ -792,7 +2774,25 @@ class Optimiser(object):
         regulariser,
         model_file,
         time_limit,
+        checkpoint_file=None,
+        checkpoint_every=None,
+        deduplicate=False,
+        persistent_chains=False,
+        rethermalisation=0,
+        reuse_samples=False,
+        ess_threshold=0.5,
+        kfac=False,
+        kernels=None,
+        betas=None,
+        swap_every=1,
+        distributed=False,
+        budget=None,
+        samples_range=None,
     ):
+        if distributed and (kfac or reuse_samples):
+            raise ValueError(
+                "K-FAC and sample reuse are not supported in distributed mode."
+            )
         self._machine = machine
         self._hamiltonian = hamiltonian
         self._magnetisation = magnetisation
@@ -802,32 +2802,173 @@ class Optimiser(object):
         self._use_sr = use_sr
         self._model_file = model_file
         self._time_limit = time_limit
-        if use_sr:
+        self._checkpoint_file = checkpoint_file
+        self._checkpoint_every = checkpoint_every
+        self._deduplicate = deduplicate
+        # If persistent_chains is True, the Markov chain is carried over
+        # between epochs and thermalisation is replaced by
+        # `rethermalisation` steps.
+        self._persistent_chains = persistent_chains
+        self._rethermalisation = rethermalisation
+        self._chain = None
+        # Proposal kernels for MetropolisMC (see make_kernels)
+        self._kernels = kernels
+        # If betas is given, ParallelTemperingMC is used instead of MetropolisMC
+        self._betas = betas
+        self._swap_every = swap_every
+        # If reuse_samples is True, configurations from the last Monte Carlo
+        # run are reweighted and reused as long as the effective sample size
+        # stays above `ess_threshold`.
+        self._reuse_samples = reuse_samples
+        self._ess_threshold = ess_threshold
+        self._samples = None
+        # Index of the next epoch to run. It is only non-zero when resuming
+        # from a checkpoint.
+        self._start_epoch = 0
+        self._delta = None
+        # If kfac is True, K-FAC is used instead of SR
+        self._kfac = KFAC(machine) if kfac else None
+        # If distributed is True, this is one process of a torch.distributed
+        # job (see init_distributed). Every process samples its own chains,
+        # statistics are all-reduced and only rank 0 saves the results.
+        self._distributed = distributed
+        if distributed:
+            _broadcast_parameters(machine)
+            _seed_process()
+        # If budget is given, the number of Monte Carlo steps and epochs are
+        # adjusted to finish within `budget` seconds (see BudgetScheduler).
+        self._scheduler = (
+            BudgetScheduler(budget, monte_carlo_steps, samples_range)
+            if budget is not None
+            else None
+        )
+        if use_sr or kfac:
             self._regulariser = regulariser
-            self._delta = None
-            self._optimizer = torch.optim.SGD(
-                self._machine.parameters(), lr=self._learning_rate
+        self._optimizer = torch.optim.SGD(
+            self._machine.parameters(), lr=self._learning_rate
+        )
+
+    def _initial_and_steps(self):
+        """
+        Returns the starting point and steps for the Monte Carlo simulation.
+        """
+        if self._chain is not None:
+            # Continuing from the last configuration of the previous epoch
+            self._chain.restart_()
+            (start, stop, step) = self._monte_carlo_steps
+            initial = self._chain
+            steps = (
+                self._rethermalisation,
+                self._rethermalisation + stop - start,
+                step,
             )
         else:
-            self._optimizer = torch.optim.SGD(
-                self._machine.parameters(), lr=self._learning_rate
+            initial = random_spin(self._machine.number_spins, self._magnetisation)
+            if (
+                self._persistent_chains
+                or self._kernels is not None
+                or self._betas is not None
+            ):
+                initial = self._make_chain(initial)
+                if self._persistent_chains:
+                    self._chain = initial
+            steps = self._monte_carlo_steps
+        return initial, steps
+
+    def _make_chain(self, spin):
+        if _supports_direct_sampling(self._machine):
+            return DirectSampler(self._machine, self._hamiltonian)
+        if self._betas is not None:
+            return ParallelTemperingMC(
+                self._machine,
+                spin,
+                self._betas,
+                self._hamiltonian,
+                swap_every=self._swap_every,
             )
+        return MetropolisMC(
+            self._machine, spin, self._hamiltonian, kernels=self._kernels
+        )
 
-    def learning_cycle(self, iteration):
-        logging.info("==================== {} ====================".format(iteration))
-        # Monte Carlo
-        spin = random_spin(self._machine.number_spins, self._magnetisation)
-        (Os, mean_O, E, var_E, F) = monte_carlo(
-            self._machine, self._hamiltonian, spin, self._monte_carlo_steps
+    def _sample(self):
+        """
+        Runs a fresh Monte Carlo simulation.
+        """
+        initial, steps = self._initial_and_steps()
+        record = {} if self._reuse_samples else None
+        answer = monte_carlo(
+            self._machine,
+            self._hamiltonian,
+            initial,
+            steps,
+            # Samples can only be reused in deduplicated form
+            deduplicate=self._deduplicate or self._reuse_samples,
+            record=record,
         )
+        if record is not None:
+            self._samples = record
+        return answer
+
+    def _set_kfac_gradients(self, iteration):
+        initial, steps = self._initial_and_steps()
+        spins, energies, visits = sample_unique(
+            self._machine, self._hamiltonian, initial, steps
+        )
+        weights = visits / np.sum(visits)
+        E = np.dot(weights, energies)
+        var_E = np.dot(weights, np.abs(energies - E) ** 2)
+        logging.info("E = {}, Var[E] = {}".format(E, var_E))
+        self._delta = self._kfac.solve(
+            spins, energies, visits, self._regulariser(iteration)
+        )
+        self._machine.set_gradients(self._delta)
+        logging.info("∥δ∥₂ = {}".format(np.linalg.norm(self._delta)))
+
+    def learning_cycle(self, iteration) -> bool:
+        """
+        Runs one epoch.
+
+        :return: whether a Monte Carlo simulation was run (rather than
+                 previous samples reused).
+        """
+        logging.info("==================== {} ====================".format(iteration))
+        if self._kfac is not None:
+            self._set_kfac_gradients(iteration)
+            self._optimizer.step()
+            self._machine.clear_cache()
+            return True
+        answer = None
+        if self._samples is not None:
+            try:
+                answer = reweight_samples(
+                    self._machine,
+                    self._hamiltonian,
+                    self._samples,
+                    self._ess_threshold,
+                )
+            except WorthlessConfiguration:
+                answer = None
+            if answer is None:
+                self._samples = None
+        sampled = answer is None
+        if sampled:
+            answer = self._sample()
+        if self._distributed:
+            answer = _all_reduce_statistics(answer)
+        Os, mean_O, E, var_E, F, weights = answer
         logging.info("E = {}, Var[E] = {}".format(E, var_E))
         # Calculate the "true" gradients
         if self._use_sr:
             # We also cache δ to use it as a guess the next time we're computing
             # S⁻¹F.
-            self._delta = Covariance(Os, mean_O, self._regulariser(iteration)).solve(
-                F, x0=self._delta
-            )
+            S = DistributedCovariance if self._distributed else Covariance
+            self._delta = S(
+                Os, mean_O, self._regulariser(iteration), weights=weights
+            ).solve(F, x0=self._delta)
+            if self._distributed:
+                # All processes should have arrived at the same δ, but we
+                # don't want round-off to make the replicas drift apart.
+                self._delta = _broadcast_(np.ascontiguousarray(self._delta))
             self._machine.set_gradients(self._delta)
             logging.info(
                 "∥F∥₂ = {}, ∥δ∥₂ = {}".format(
@@ -844,11 +2985,69 @@ class Optimiser(object):
         # Update the variational parameters
         self._optimizer.step()
         self._machine.clear_cache()
+        return sampled
+
+    def checkpoint(self, epoch: int) -> dict:
+        """
+        Returns a snapshot of the full optimisation state which is safe to
+        serialise while the optimisation continues.
+
+        :param int epoch: Index of the next epoch to run.
+        """
+        return {
+            "epoch": epoch,
+            "model": {
+                k: v.detach().clone() for k, v in self._machine.state_dict().items()
+            },
+            "optimizer": copy.deepcopy(self._optimizer.state_dict()),
+            # NOTE: Only tensors and plain Python objects are stored so that
+            # the checkpoint can be loaded with `torch.load(..., weights_only=True)`.
+            "delta": (
+                None if self._delta is None else torch.from_numpy(np.copy(self._delta))
+            ),
+            "numpy_rng": _get_numpy_rng_state(),
+            "numba_rng": _get_numba_rng_state(),
+            "torch_rng": torch.get_rng_state(),
+        }
+
+    def load_checkpoint(self, checkpoint: dict):
+        """
+        Restores the state saved by :py:meth:`checkpoint`.
+        """
+        self._machine.load_state_dict(checkpoint["model"])
+        self._optimizer.load_state_dict(checkpoint["optimizer"])
+        delta = checkpoint["delta"]
+        self._delta = None if delta is None else delta.numpy()
+        _set_numpy_rng_state(checkpoint["numpy_rng"])
+        _set_numba_rng_state(checkpoint["numba_rng"])
+        torch.set_rng_state(checkpoint["torch_rng"])
+        self._start_epoch = checkpoint["epoch"]
+        if self._distributed:
+            # All processes have just restored the same state
+            _seed_process()
+        self._machine.clear_cache()
+        logging.info("Resuming from epoch {}...".format(self._start_epoch))
+
+    @property
+    def _is_root(self) -> bool:
+        return not self._distributed or dist.get_rank() == 0
+
+    def _plan_epoch(self, epoch: int, reserve: float) -> Optional[int]:
+        """
+        Asks the scheduler for the number of samples for ``epoch``. In
+        distributed mode the decision of rank 0 is used by all processes.
+        """
+        samples = self._scheduler.plan(self._epochs - epoch, reserve)
+        if self._distributed:
+            samples = np.array([-1 if samples is None else samples], dtype=np.int64)
+            samples = int(_broadcast_(samples)[0])
+            samples = None if samples < 0 else samples
+        return samples
 
     def __call__(self):
-        if self._model_file is not None:
+        if self._model_file is not None and self._is_root:
 
-            def save():
+            def save_weights():
                 # NOTE: This is important, because we want to overwrite the
                 # previous weights
                 self._model_file.seek(0)
@@ -856,18 +3055,70 @@ class Optimiser(object):
                 torch.save(self._machine.state_dict(), self._model_file)
 
         else:
-            save = lambda: None
-        if self._time_limit is not None:
+            save_weights = lambda: None
+        if self._checkpoint_file is not None and self._is_root:
+            writer = _CheckpointWriter(self._checkpoint_file)
+            save_checkpoint = lambda epoch: writer.submit(self.checkpoint(epoch))
+        else:
+            writer = None
+            save_checkpoint = lambda epoch: None
+        scheduler = self._scheduler
+
+        def save(epoch):
+            start = time.time()
+            save_weights()
+            save_checkpoint(epoch)
+            if scheduler is not None:
+                scheduler.record_save(time.time() - start)
+
+        try:
             start = time.time()
-            for i in range(self._epochs):
-                if time.time() - start > self._time_limit:
-                    save()
+            if scheduler is not None:
+                scheduler.start()
+            epoch = self._start_epoch
+            while epoch < self._epochs:
+                if scheduler is not None:
+                    # Checkpoints are written in the background, but the last
+                    # one has to hit the disk before the deadline.
+                    samples = self._plan_epoch(
+                        epoch, 0.0 if writer is None else 2 * writer.write_time
+                    )
+                    if samples is None:
+                        logging.warning(
+                            "Stopping after {} epochs to stay within the time "
+                            "budget...".format(epoch)
+                        )
+                        break
+                    self._monte_carlo_steps = scheduler.monte_carlo_steps(samples)
+                    logging.info(
+                        "{:.1f} seconds left, using {} Monte Carlo samples...".format(
+                            scheduler.remaining, samples
+                        )
+                    )
+                if (
+                    self._time_limit is not None
+                    and time.time() - start > self._time_limit
+                ):
+                    save(epoch)
                     start = time.time()
-                self.learning_cycle(i)
-        else:
-            for i in range(self._epochs):
-                self.learning_cycle(i)
-        save()
+                elif (
+                    self._checkpoint_every is not None
+                    and epoch > self._start_epoch
+                    and (epoch - self._start_epoch) % self._checkpoint_every == 0
+                ):
+                    save_checkpoint(epoch)
+                epoch_start = time.time()
+                sampled = self.learning_cycle(epoch)
+                # Epochs which reuse previous samples are much cheaper and
+                # would make sampling look cheap as well.
+                if scheduler is not None and sampled:
+                    scheduler.record_epoch(samples, time.time() - epoch_start)
+                epoch += 1
+            save(epoch)
+        finally:
+            if writer is not None:
+                # Waits for the last checkpoint to hit the disk.
+                writer.close()
         return self._machine
 
 
@@ -876,6 +3127,13 @@ def _make_normalised_machine(BaseNet):
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
             self._scale = complex(0.0, 0.0)
+            # Tensor version of _scale which is reused by forward
+            self._scale_tensor = torch.zeros(2, dtype=torch.float32)
+
+        def _set_scale(self, value: complex):
+            self._scale = value
+            self._scale_tensor[0] = value.real
+            self._scale_tensor[1] = value.imag
 
         @property
         def scale(self):
@@ -883,7 +3141,15 @@ def _make_normalised_machine(BaseNet):
 
         @scale.setter
         def scale(self, value):
-            self._scale = complex(math.log(value), self._scale.imag)
+            self._set_scale(complex(math.log(value), self._scale.imag))
+
+        @property
+        def log_scale(self):
+            return self._scale.real
+
+        @log_scale.setter
+        def log_scale(self, value):
+            self._set_scale(complex(value, self._scale.imag))
 
         @property
         def phase(self):
@@ -891,18 +3157,13 @@ def _make_normalised_machine(BaseNet):
 
         @phase.setter
         def phase(self, value):
-            self._scale = complex(self._scale.real, value)
+            self._set_scale(complex(self._scale.real, value))
 
-        def log_wf(self, x):
-            return super().log_wf(x) + self._scale
+        # NOTE: There's no need to override log_wf, because Machine.log_wf
+        # calls forward which already takes the scale into account.
 
         def forward(self, x):
-            scale = torch.tensor(
-                [self._scale.real, self._scale.imag],
-                dtype=torch.float32,
-                requires_grad=False,
-            )
-            return super().forward(x) + scale
+            return super().forward(x) + self._scale_tensor
 
         def backward(self, x):
             raise NotImplementedError("NormalisedMachine is not trainable")
@@ -910,6 +3171,9 @@ def _make_normalised_machine(BaseNet):
         def der_log_wf(self, x):
             raise NotImplementedError("NormalisedMachine is not trainable")
 
+        def der_log_wf_batch(self, xs, out=None):
+            raise NotImplementedError("NormalisedMachine is not trainable")
+
         def set_gradients(self, x):
             raise NotImplementedError("NormalisedMachine is not trainable")
 
@@ -919,65 +3183,417 @@ def _make_normalised_machine(BaseNet):
     return NormalisedMachine
 
 
+def _complex_log_mean_exp(y: torch.Tensor) -> torch.Tensor:
+    """
+    Given ``y`` of shape ``(M, ..., 2)`` where ``y[m, ...]`` are log(ψₘ) stored
+    as (real, imag) pairs, computes log(1/M ∑ₘ ψₘ) in a numerically stable way.
+    """
+    a, b = y[..., 0], y[..., 1]
+    a_max = torch.max(a, dim=0)[0]
+    w = torch.exp(a - a_max)
+    re = torch.mean(w * torch.cos(b), dim=0)
+    im = torch.mean(w * torch.sin(b), dim=0)
+    return torch.stack(
+        [a_max + 0.5 * torch.log(re * re + im * im), torch.atan2(im, re)], dim=-1
+    )
+
+
+class _Ensemble(object):
+    """
+    Evaluates all members of an ensemble of networks which share the same
+    architecture ``BaseNet`` in one pass.
+
+    If ``torch.func`` is available, the weights of all members are stacked
+    into batched tensors and ``BaseNet.forward`` is vectorised over the
+    member dimension. Otherwise (or if the architecture can't be vectorised,
+    e.g. because it uses custom autograd functions) we fall back to looping
+    over members, which is still batched over spin configurations.
+    """
+
+    def __init__(self, BaseNet, members):
+        if len(members) == 0:
+            raise ValueError("Ensemble must contain at least one member.")
+        self._BaseNet = BaseNet
+        self._members = members
+        self._scales = torch.zeros((len(members), 2), dtype=torch.float32)
+        self._evaluate = self._evaluate_loop
+        try:
+            from torch.func import functional_call, vmap
+        except ImportError:
+            logging.info(
+                "torch.func is not available, members are evaluated one by one."
+            )
+            return
+
+        number_spins = members[0].number_spins
+        template = BaseNet(number_spins)
+        stack = lambda tensors: torch.stack([t.detach() for t in tensors])
+        parameters = {
+            name: stack(dict(m.named_parameters())[name] for m in members)
+            for (name, _) in template.named_parameters()
+        }
+        buffers = {
+            name: stack(dict(m.named_buffers())[name] for m in members)
+            for (name, _) in template.named_buffers()
+        }
+        batched = vmap(
+            lambda p, b, x: functional_call(template, (p, b), (x,)),
+            in_dims=(0, 0, None),
+        )
+        evaluate = lambda x: batched(parameters, buffers, x)
+        x = torch.from_numpy(
+            np.stack([random_spin(number_spins) for _ in range(2)]).astype(np.float32)
+        )
+        try:
+            with torch.no_grad():
+                ok = torch.allclose(
+                    evaluate(x), self._evaluate_loop(x), rtol=1e-4, atol=1e-5
+                )
+        except Exception as e:
+            logging.debug("Vectorising {} failed: {}".format(BaseNet.__name__, e))
+            ok = False
+        if ok:
+            self._evaluate = evaluate
+        else:
+            logging.info(
+                "Could not vectorise the ensemble, members are evaluated one by one."
+            )
+
+    def _evaluate_loop(self, x: torch.Tensor) -> torch.Tensor:
+        # NOTE: Calling BaseNet.forward directly to bypass the scales
+        # added by NormalisedMachine.forward.
+        return torch.stack([self._BaseNet.forward(psi, x) for psi in self._members])
+
+    def set_scales(self, scales: List[complex]):
+        """
+        Sets log-normalisations and phases of the members.
+        """
+        self._scales = torch.tensor(
+            [[z.real, z.imag] for z in scales], dtype=torch.float32
+        )
+
+    def log_members(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Returns log(|cₘ|ψₘ(x)) for all members m, i.e. including the
+        normalisation, but not the phase. The result has shape ``(M, ..., 2)``.
+        """
+        with torch.no_grad():
+            y = self._evaluate(x)
+            y[..., 0] += self._scales[:, 0].view(-1, *([1] * (y.dim() - 2)))
+            return y
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Computes log(1/M ∑ₘ cₘψₘ(x)) where cₘ are the scales set using
+        :py:meth:`set_scales`. ``x`` is either a single spin configuration or a
+        batch of them.
+        """
+        with torch.no_grad():
+            y = self._evaluate(x)
+            y += self._scales.view(-1, *([1] * (y.dim() - 2)), 2)
+            return _complex_log_mean_exp(y)
+
+
+@jit(void(int64), nopython=True, cache=True)
+def _seed_numba(seed: int):
+    """
+    Seeds the random number generator used by numba-compiled code, which is
+    separate from NumPy's one.
+    """
+    np.random.seed(seed)
+
+
+# Members of the ensemble being normalised by the current worker process.
+_normalisation_members = None
+
+
+def _init_normalisation_worker(nn_file, number_spins, states, scales):
+    global _normalisation_members
+    # NOTE: Members are instances of classes created at runtime which can't be
+    # pickled, so workers rebuild them from the architecture file.
+    Machine = _make_normalised_machine(import_network(nn_file))
+    _normalisation_members = []
+    for state, scale in zip(states, scales):
+        psi = Machine(number_spins)
+        psi.load_state_dict(state)
+        psi._set_scale(scale)
+        _normalisation_members.append(psi)
+    # Parallelism comes from running many chains at once.
+    torch.set_num_threads(1)
+
+
+def _normalisation_task(members, task):
+    i, seed, steps, magnetisation = task
+    # Every run is seeded here rather than in the worker, so that results
+    # don't depend on whether runs are distributed over processes.
+    seed = int(seed)
+    np.random.seed(seed)
+    _seed_numba(seed)
+    torch.manual_seed(seed)
+    psi = members[i]
+    return i, log_l2_norm(psi, random_spin(psi.number_spins, magnetisation), steps)
+
+
+def _normalisation_worker(task):
+    return _normalisation_task(_normalisation_members, task)
+
+
 class AverageNet(nn.Module):
     def __init__(self, BaseNet, n, weight_files):
+        super().__init__()
         self._machines = []
         self._number_spins = n
+        self._BaseNet = BaseNet
         Machine = _make_normalised_machine(BaseNet)
         for file_name in weight_files:
             with open(file_name, "rb") as in_file:
                 psi = Machine(n)
                 psi.load_state_dict(torch.load(in_file))
                 self._machines.append(psi)
+        self._ensemble = _Ensemble(BaseNet, self._machines)
+        self._update_scales()
+
+    def _update_scales(self):
+        self._ensemble.set_scales([psi._scale for psi in self._machines])
 
     @property
     def number_spins(self):
         return self._number_spins
 
-    def normalise_(self, steps, magnetisation=None):
-        for psi in self._machines:
-            n_runs = 10
-            l2_norms = np.array(
-                [
-                    compute_l2_norm(
-                        psi, random_spin(psi.number_spins, magnetisation), steps
-                    )
-                    for _ in range(n_runs)
-                ]
-            )
-            l2_mean = np.mean(l2_norms)
-            logging.info(
-                "After {} runs: ||ψ||₂ = {} ± {}".format(
-                    n_runs, l2_mean, np.std(l2_norms)
+    def normalise_(self, steps, magnetisation=None, n_runs=10, processes=None):
+        """
+        Normalises every member by estimating its L2 norm ``n_runs`` times.
+
+        All (member, run) pairs are independent Monte Carlo runs which are
+        distributed over a pool of ``processes`` worker processes (defaults to
+        the number of CPUs). Each run gets its own random seed, so the result
+        doesn't depend on the number of processes.
+
+        Workers are spawned rather than forked (forking after torch has
+        started its thread pools may deadlock). They import the architecture
+        from the file ``BaseNet`` was defined in, so it must be importable
+        with :py:func:`import_network`.
+        """
+        number_members = len(self._machines)
+        seeds = np.random.randint(0, 2**31 - 1, size=number_members * n_runs)
+        tasks = [
+            (i, seeds[i * n_runs + j], steps, magnetisation)
+            for i in range(number_members)
+            for j in range(n_runs)
+        ]
+        if processes is None:
+            processes = os.cpu_count() or 1
+        processes = min(processes, len(tasks))
+        log_l2_norms = [[] for _ in range(number_members)]
+
+        def collect(results):
+            for count, (i, log_l2) in enumerate(results, 1):
+                log_l2_norms[i].append(log_l2)
+                logging.debug(
+                    "Normalisation: {}/{} runs done".format(count, len(tasks))
                 )
+                if len(log_l2_norms[i]) == n_runs:
+                    self._set_norm(i, np.array(log_l2_norms[i]))
+
+        if processes > 1:
+            initargs = (
+                inspect.getsourcefile(self._BaseNet),
+                self._number_spins,
+                [psi.state_dict() for psi in self._machines],
+                [psi._scale for psi in self._machines],
             )
-            psi.scale = 1.0 / l2_mean
-            psi.clear_cache()
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(
+                processes, initializer=_init_normalisation_worker, initargs=initargs
+            ) as pool:
+                collect(pool.imap_unordered(_normalisation_worker, tasks))
+        else:
+            # Tasks reseed the global random number generators. In the
+            # parallel case only the workers' ones are touched, so we restore
+            # ours to leave them in the same state.
+            states = (
+                _get_numpy_rng_state(),
+                _get_numba_rng_state(),
+                torch.get_rng_state(),
+            )
+            try:
+                collect(_normalisation_task(self._machines, t) for t in tasks)
+            finally:
+                _set_numpy_rng_state(states[0])
+                _set_numba_rng_state(states[1])
+                torch.set_rng_state(states[2])
+        self._update_scales()
+
+    def _set_norm(self, i, log_l2_norms):
+        # Everything is done in the log-domain to avoid overflows
+        psi = self._machines[i]
+        log_l2_mean = _log_mean_exp(log_l2_norms)
+        l2_rel_std = np.std(np.exp(log_l2_norms - log_l2_mean))
+        logging.info(
+            "[{}/{}] After {} runs: ||ψ||₂ = {} ± {}".format(
+                i + 1,
+                len(self._machines),
+                len(log_l2_norms),
+                np.exp(log_l2_mean),
+                np.exp(log_l2_mean) * l2_rel_std,
+            )
+        )
+        # NOTE: The norm was computed with the current scale included.
+        psi.log_scale = psi.log_scale - log_l2_mean
+        psi.clear_cache()
 
     def align_(self, spin):
-        for psi in self._machines:
-            psi.phase = -psi.log_wf(spin).imag
+        """
+        Sets the phases of the members such that all cₘψₘ(spin) are real and
+        positive.
+        """
+        # NOTE: log_members doesn't include the phases, so the result depends
+        # neither on the previous alignment nor on amplitudes cached by the
+        # members (which are computed with the old phase).
+        phases = self.log_members(torch.from_numpy(spin))[:, 1]
+        for psi, phase in zip(self._machines, phases.tolist()):
+            psi.phase = -phase
+            psi.clear_cache()
+        self._update_scales()
 
     def forward(self, x):
-        with torch.no_grad():
+        """
+        Computes log of the average of normalised members. ``x`` may be either
+        a single spin configuration or a batch of them.
+        """
+        return self._ensemble(x)
 
-            def wf(psi, x):
-                (a, b) = psi.forward(x)
-                return cmath.exp(complex(a, b))
+    def log_members(self, x):
+        """
+        See :py:meth:`_Ensemble.log_members`.
+        """
+        return self._ensemble.log_members(x)
 
-            avg_psi = np.mean(np.array([wf(psi, x) for psi in self._machines]))
-            avg_log_psi = cmath.log(avg_psi)
-            x = torch.tensor(
-                [avg_log_psi.real, avg_log_psi.imag],
-                dtype=torch.float32,
-                requires_grad=False,
-            )
-            return x
+
+class _MixtureProposal(object):
+    """
+    Proposal distribution q(S) ∝ 1/M ∑ₘ|cₘψₘ(S)|² for an ensemble. It doesn't
+    depend on the phases of the members and thus can be used to sample for
+    all alignments at once. Only provides the ``log_wf`` needed by
+    :py:class:`MetropolisMC`.
+    """
+
+    def __init__(self, psi):
+        self._psi = psi
+        self._cache = {}
+
+    def log_wf(self, x: np.ndarray) -> complex:
+        key = CompactSpin(x)
+        log_q = self._cache.get(key)
+        if log_q is None:
+            y = self._psi.log_members(torch.from_numpy(x))[:, 0].numpy()
+            log_q = 0.5 * _log_mean_exp(2.0 * y)
+            self._cache[key] = log_q
+        return complex(log_q, 0.0)
+
+
+def _complex_log_mean(log_psi: np.ndarray) -> np.ndarray:
+    """
+    Given a complex array ``log_psi`` of shape ``(N, M)``, computes
+    log(1/M ∑ₘ exp(log_psi[:, m])) in a numerically stable way.
+    """
+    shift = np.max(log_psi.real, axis=1, keepdims=True)
+    return shift[:, 0] + np.log(np.mean(np.exp(log_psi - shift), axis=1))
+
+
+def reweighted_alignments(
+    psi, hamiltonian, initial_spin, steps, alignments, batch_size=1024
+):
+    """
+    Computes E and Var[E] of the ensemble ``psi`` (a ``Machine`` built from
+    :py:class:`AverageNet`) for every alignment spin in ``alignments`` using a
+    single Markov chain.
+
+    Alignment only changes the phases of the members. We therefore sample
+    from a phase-independent proposal (see :py:class:`_MixtureProposal`),
+    store per-member amplitudes for all visited configurations and their
+    neighbours, and evaluate every alignment by importance reweighting.
+
+    :return: a list of ``(E, Var[E], effective sample size)``, one per
+             alignment.
+    """
+    logging.info("Running Monte Carlo...")
+    proposal = _MixtureProposal(psi)
+    chain = MetropolisMC(proposal, initial_spin)
+    counts = {}
+    for state in islice(chain, *steps):
+        key = CompactSpin(state.spin)
+        if key in counts:
+            counts[key][1] += 1
+        else:
+            counts[key] = [np.copy(state.spin), 1]
+    chain.log_statistics()
+
+    # Indices of all configurations for which we need amplitudes: visited
+    # ones come first, their neighbours after.
+    index = {key: i for (i, key) in enumerate(counts)}
+    spins = [spin for (spin, _) in counts.values()]
+    visits = np.array([count for (_, count) in counts.values()], dtype=np.float64)
+    owners, neighbours = [], []
+    number_flippable = np.empty(len(counts), dtype=np.float64)
+    for i, spin in enumerate(list(spins)):
+        reachable = hamiltonian.reachable_from(spin)
+        number_flippable[i] = len(reachable)
+        for s in reachable:
+            key = CompactSpin(s)
+            j = index.get(key)
+            if j is None:
+                j = len(spins)
+                index[key] = j
+                spins.append(s)
+            owners.append(i)
+            neighbours.append(j)
+    owners = np.array(owners, dtype=np.int64)
+    neighbours = np.array(neighbours, dtype=np.int64)
+    logging.info(
+        "Subspace dimension: {} ({} with neighbours)".format(len(counts), len(spins))
+    )
+
+    # log(|cₘ|ψₘ(S)) for all configurations and members, shape (N, M)
+    log_psi = np.concatenate(
+        [
+            psi.log_members(torch.from_numpy(np.stack(spins[i : i + batch_size])))
+            .numpy()
+            .astype(np.float64)
+            .view(np.complex128)[..., 0]
+            .transpose()
+            for i in range(0, len(spins), batch_size)
+        ]
+    )
+    sampled = slice(0, len(counts))
+    # log(q(S)) for the visited configurations
+    log_q = np.array([_log_mean_exp(2.0 * row) for row in log_psi[sampled].real])
+    # Aligned bonds contribute +1 and anti-aligned ones -1 to the diagonal.
+    diagonal = len(hamiltonian.edges) - 2 * number_flippable
+
+    results = []
+    for spin in alignments:
+        # Phases such that all members are real and positive at `spin`.
+        phases = -psi.log_members(torch.from_numpy(spin))[:, 1].numpy()
+        log_psi_aligned = _complex_log_mean(log_psi + 1j * phases)
+        ratios = np.exp(log_psi_aligned[neighbours] - log_psi_aligned[owners])
+        off_diagonal = np.zeros(len(counts), dtype=np.complex128)
+        np.add.at(off_diagonal, owners, ratios)
+        energies = diagonal + 2 * off_diagonal
+        # Importance ratios |ψ(S)|²/q(S) up to a constant
+        log_r = 2 * log_psi_aligned[sampled].real - log_q
+        r = np.exp(log_r - np.max(log_r))
+        w = visits * r
+        w_sum = np.sum(w)
+        mean_E = np.sum(w * energies) / w_sum
+        var_E = np.sum(w * np.abs(energies - mean_E) ** 2) / w_sum
+        ess = w_sum**2 / np.sum(visits * r**2)
+        results.append((mean_E, var_E, ess))
+    return results
 
 
 def heisenberg6():
-    hamiltonian = Heisenberg([(0, 1), (1, 2), (2, 3), (3, 4), (4, 5), (5, 0)])
-    machine = Machine(6)
+    hamiltonian = Heisenberg(lattice.chain(6))
     return hamiltonian
 
 
@@ -1013,44 +3629,596 @@ def kagome12():
     return hamiltonian
 
 
-def heisenberg3x3():
-    hamiltonian = Heisenberg(
-        [
-            (0, 1),
-            (1, 2),
-            (2, 0),
-            (3, 4),
-            (4, 5),
-            (5, 3),
-            (6, 7),
-            (7, 8),
-            (8, 6),
-            (0, 3),
-            (3, 6),
-            (6, 0),
-            (1, 4),
-            (4, 7),
-            (7, 1),
-            (2, 5),
-            (5, 8),
-            (8, 2),
-        ]
-    )
-    return hamiltonian
+def heisenberg3x3():
+    hamiltonian = Heisenberg(
+        [
+            (0, 1),
+            (1, 2),
+            (2, 0),
+            (3, 4),
+            (4, 5),
+            (5, 3),
+            (6, 7),
+            (7, 8),
+            (8, 6),
+            (0, 3),
+            (3, 6),
+            (6, 0),
+            (1, 4),
+            (4, 7),
+            (7, 1),
+            (2, 5),
+            (5, 8),
+            (8, 2),
+        ]
+    )
+    return hamiltonian
+
+
+def import_network(nn_file):
+    module_name, extension = os.path.splitext(os.path.basename(nn_file))
+    module_dir = os.path.dirname(nn_file)
+    if extension != ".py":
+        raise ValueError(
+            "Could not import the network from {}: not a python source file."
+        )
+    # Insert in the beginning
+    sys.path.insert(0, module_dir)
+    module = importlib.import_module(module_name)
+    sys.path.pop(0)
+    return module.Net
+
+
+def _compiled_network_path(nn_file: str, mode: str, number_spins: int) -> str:
+    """
+    Returns the location of the cached compiled network. The key includes the
+    hash of the source file and the PyTorch version, so editing the
+    architecture or upgrading PyTorch invalidates the cache.
+
+    The cache lives in ``$NQS_CACHE_DIR`` (defaults to
+    ``~/.cache/nqs_playground``).
+    """
+    with open(nn_file, "rb") as f:
+        digest = hashlib.sha256(f.read())
+    digest.update(torch.__version__.encode())
+    cache_dir = os.environ.get(
+        "NQS_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "nqs_playground"),
+    )
+    module_name = os.path.splitext(os.path.basename(nn_file))[0]
+    return os.path.join(
+        cache_dir,
+        "{}-{}-{}-{}.pt".format(
+            module_name, digest.hexdigest()[:16], mode, number_spins
+        ),
+    )
+
+
+def _alias_parameters(compiled, net):
+    """
+    Makes parameters and buffers of ``compiled`` (a ``torch.jit.load``-ed
+    module) point to those of ``net``, so that both always see the same
+    weights.
+    """
+    for name, tensor in list(net.named_parameters()) + list(net.named_buffers()):
+        *path, attribute = name.split(".")
+        module = compiled
+        for part in path:
+            module = getattr(module, part)
+        setattr(module, attribute, tensor)
+
+
+def _random_spins(n: int, batch_size: Optional[int] = None) -> torch.Tensor:
+    """
+    Returns a random spin configuration or, if ``batch_size`` is given, a
+    batch of them.
+    """
+    if batch_size is None:
+        return torch.from_numpy(random_spin(n))
+    return torch.stack([torch.from_numpy(random_spin(n)) for _ in range(batch_size)])
+
+
+def _supports_batches(net) -> bool:
+    """
+    Checks whether (eager-mode) ``net`` maps an ``(N, number_spins)`` tensor
+    to an ``(N, 2)`` one.
+    """
+    x = _random_spins(net.number_spins, 2)
+    try:
+        with torch.no_grad():
+            y = type(net).forward(net, x)
+    except (RuntimeError, ValueError, IndexError):
+        return False
+    return tuple(y.size()) == (2, 2)
+
+
+def _accept_single(traced):
+    """
+    Wraps a module traced on a batch, which only accepts batches, such that
+    it also accepts a single spin configuration.
+    """
+
+    def forward(x):
+        if x.dim() == 1:
+            return traced(x.unsqueeze(0)).squeeze(0)
+        return traced(x)
+
+    return forward
+
+
+def _agrees_with_eager(net, forward, batched: bool) -> bool:
+    """
+    Compares ``forward`` with the eager-mode forward of ``net`` on a random
+    spin configuration and, if ``batched``, on a batch of them.
+    """
+    n = net.number_spins
+    inputs = [_random_spins(n)]
+    if batched:
+        inputs.append(_random_spins(n, 16))
+    with torch.no_grad():
+        for x in inputs:
+            expected = type(net).forward(net, x)
+            try:
+                y = forward(x)
+            except RuntimeError:
+                return False
+            if y.size() != expected.size() or not torch.allclose(
+                y, expected, rtol=1e-4, atol=1e-5
+            ):
+                return False
+    return True
+
+
+def compile_network(net, nn_file: str, mode: str = "script"):
+    """
+    Compiles ``net`` with TorchScript to get rid of the Python overhead of
+    eager-mode module dispatch, which dominates the cost of small
+    per-configuration forward passes.
+
+    Compiled modules are cached on disk (see :py:func:`_compiled_network_path`),
+    so later runs skip compilation. Every compiled module (including the ones
+    loaded from the cache) is checked against eager mode; if compilation
+    fails or the results differ, a warning is printed and ``net`` is left in
+    eager mode.
+
+    Call this function after the weights have been loaded: the compiled module
+    shares parameters with ``net``, but ``load_state_dict`` doesn't
+    invalidate tracing-time constants.
+
+    :param net: Network (or :py:class:`Machine`) to compile. Its ``forward`` is
+                replaced by the compiled one, everything else (parameters,
+                ``state_dict``, other methods) stays as is.
+    :param str nn_file: Source file of the architecture (see :py:func:`import_network`).
+    :param str mode: Either ``"script"`` (``torch.jit.script``) or ``"trace"``
+                     (``torch.jit.trace``). Tracing uses a batch of spin
+                     configurations as the example input if ``net`` supports
+                     batches (single configurations are then passed as
+                     batches of one) and a single configuration otherwise.
+    :return: ``net``.
+    """
+    if mode not in ("script", "trace"):
+        raise ValueError("Invalid compilation mode: {}".format(mode))
+    path = _compiled_network_path(nn_file, mode, net.number_spins)
+    batched = _supports_batches(net)
+    # Modules traced on a batch don't accept single configurations
+    wrap = _accept_single if mode == "trace" and batched else lambda m: m.forward
+    compiled = None
+    # NOTE: torch.jit is deprecated in favour of torch.export, but the latter
+    # doesn't support our use case (autograd through the compiled module) yet.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        # Traces are checked against eager mode anyway
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        if os.path.exists(path):
+            try:
+                compiled = torch.jit.load(path)
+                _alias_parameters(compiled, net)
+            except (RuntimeError, AttributeError) as e:
+                logging.warning("Failed to load {}: {}".format(path, e))
+                compiled = None
+            if compiled is not None and not _agrees_with_eager(
+                net, wrap(compiled), batched
+            ):
+                logging.warning("Cached {} is out of date, recompiling...".format(path))
+                compiled = None
+            if compiled is not None:
+                logging.info("Loaded the compiled network from {}".format(path))
+        if compiled is None:
+            start = time.time()
+            try:
+                if mode == "script":
+                    compiled = torch.jit.script(net)
+                else:
+                    # NOTE: The example batch size differs from the one used
+                    # by _agrees_with_eager to check that it isn't hardcoded.
+                    example = _random_spins(net.number_spins, 8 if batched else None)
+                    compiled = torch.jit.trace(net, example, check_trace=False)
+            # NOTE: torch.jit reports unsupported constructs using all kinds of
+            # exception types.
+            except Exception as e:
+                logging.warning(
+                    "Failed to compile the network, falling back to eager "
+                    "mode: {}".format(e)
+                )
+                return net
+            if not _agrees_with_eager(net, wrap(compiled), batched):
+                logging.warning(
+                    "Compiled network disagrees with eager mode, falling back to "
+                    "eager mode."
+                )
+                return net
+            logging.info(
+                "Compiled the network in {:.2f} seconds!".format(time.time() - start)
+            )
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                _atomic_save(compiled, path, save=torch.jit.save)
+            except (RuntimeError, OSError) as e:
+                logging.warning("Failed to cache the compiled network: {}".format(e))
+    # NOTE: Assigning a function rather than the module itself, because
+    # nn.Module would register the latter as a submodule.
+    net.forward = wrap(compiled)
+    return net
+
+
+def _log_direct_sampling(psi, proposals, replicas):
+    """
+    Tells the user that Markov chain options have no effect when ``psi``
+    supports direct sampling.
+    """
+    if not _supports_direct_sampling(psi):
+        return
+    logging.info("The network supports direct sampling, Markov chains are not used.")
+    if proposals or replicas > 1:
+        logging.warning("--proposal and --replicas are ignored.")
+
+
+def _encode_array(x: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(x).tobytes()).decode("ascii")
+
+
+def _decode_array(s: str, dtype) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(s), dtype=dtype)
+
+
+class AmplitudeServer(object):
+    """
+    Serves log(ψ) and ∇log(ψ) of a trained network over a Unix socket or a
+    TCP port, so that analysis scripts don't have to load the weights
+    themselves.
+
+    Requests arriving concurrently (from one or many connections) are
+    grouped into batches: a batch is evaluated as soon as it contains
+    ``max_batch`` configurations or when the oldest request in it has waited
+    for ``max_delay`` seconds. Each batch costs a single forward pass (see
+    :py:meth:`Machine.log_wf_packed`).
+
+    The protocol is newline-delimited JSON. Requests are
+
+    * ``{"id": <id>, "op": "log_wf", "spins": [<hex>, ...], "gradient": <bool>}``
+      where every spin configuration is packed as in :py:func:`to_bytes` and
+      written in hex (i.e. it is the bit string of the configuration with 1
+      meaning spin up). The response is ``{"id": <id>, "log_wf": <base64>}``
+      with log(ψ) as ``complex128`` and, if ``"gradient"`` is true, also
+      ``"gradient": <base64>`` with ∇log(ψ) as a row-major
+      ``(len(spins), size)`` array of ``complex64``.
+    * ``{"id": <id>, "op": "stats"}``. The response is
+      ``{"id": <id>, "stats": {...}}`` (see :py:meth:`statistics`).
+
+    Responses on one connection may come out of order, so clients should
+    match them by ``id``. Failed requests get ``{"id": <id>, "error": <message>}``.
+    See :py:class:`AmplitudeClient` for a client.
+    """
+
+    # Maximal length of one request or response in bytes
+    _LINE_LIMIT = 2**28
+
+    def __init__(self, machine, max_batch: int = 1024, max_delay: float = 0.002):
+        """
+        :param machine: Variational state.
+        :param int max_batch: Number of configurations at which a batch is
+                              evaluated immediately. Larger requests are
+                              evaluated on their own.
+        :param float max_delay: Latency deadline in seconds.
+        """
+        if max_batch < 1:
+            raise ValueError("Invalid maximal batch size: {}".format(max_batch))
+        if max_delay < 0:
+            raise ValueError("Invalid maximal delay: {}".format(max_delay))
+        self._machine = machine
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._queue = None
+        # Batches are evaluated in a separate thread, so that new requests
+        # keep arriving (and forming the next batch) in the meantime.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._start = time.time()
+        self._requests = 0
+        self._configurations = 0
+        self._batches = 0
+        # Latencies of the most recent requests in seconds
+        self._latencies = collections.deque(maxlen=10000)
+
+    def statistics(self) -> Dict[str, float]:
+        """
+        Returns the number of served requests, configurations and batches,
+        throughput (configurations per second since start-up) and latency
+        percentiles (in milliseconds, over the most recent requests).
+        """
+        uptime = time.time() - self._start
+        latencies = 1000 * np.array(self._latencies, dtype=np.float64)
+        if latencies.size == 0:
+            latencies = np.zeros(1)
+        return {
+            "uptime": uptime,
+            "requests": self._requests,
+            "configurations": self._configurations,
+            "batches": self._batches,
+            "mean_batch_size": self._configurations / max(self._batches, 1),
+            "throughput": self._configurations / uptime,
+            "latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p90": float(np.percentile(latencies, 90)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "latency_max": float(np.max(latencies)),
+        }
+
+    async def evaluate(self, spins: np.ndarray, gradient: bool = False):
+        """
+        Schedules ``spins`` for evaluation and waits for the result.
+
+        :param spins: Spin configurations packed with :py:func:`to_bytes`
+                      (rows of a 2D array of ``uint8``).
+        :return: log(ψ) as a 1D array of ``complex128`` and, if ``gradient``
+                 is true, ∇log(ψ) as a 2D array of ``complex64``.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((spins, gradient, future, time.perf_counter()))
+        return await future
+
+    def _evaluate(self, items):
+        """
+        Evaluates a batch of requests. Runs in the worker thread.
+        """
+        machine = self._machine
+        spins = np.concatenate([item[0] for item in items])
+        log_wf = machine.log_wf_packed(spins)
+        # The weights never change, but we don't want the cache to grow
+        # without bounds either.
+        if len(machine._cache) > 2**20:
+            machine.clear_cache()
+        results = []
+        offset = 0
+        for xs, gradient, _, _ in items:
+            n = len(xs)
+            if gradient:
+                gradients = np.empty((n, machine.size), dtype=np.complex64)
+                for k, x in enumerate(xs):
+                    machine.der_log_wf(
+                        from_bytes(x.tobytes(), machine.number_spins), out=gradients[k]
+                    )
+                results.append((log_wf[offset : offset + n], gradients))
+            else:
+                results.append(log_wf[offset : offset + n])
+            offset += n
+        return results
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self._queue.get()]
+            size = len(items[0][0])
+            deadline = items[0][3] + self._max_delay
+            while size < self._max_batch:
+                if not self._queue.empty():
+                    item = self._queue.get_nowait()
+                else:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                items.append(item)
+                size += len(item[0])
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._evaluate, items
+                )
+            except Exception as e:
+                for _, _, future, _ in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.perf_counter()
+            for (_, _, future, arrival), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+                self._latencies.append(now - arrival)
+            self._requests += len(items)
+            self._configurations += size
+            self._batches += 1
+
+    async def _respond(self, line: bytes) -> dict:
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            op = request.get("op")
+            if op == "stats":
+                return {"id": request_id, "stats": self.statistics()}
+            if op != "log_wf":
+                raise ValueError("Unknown operation: {!r}".format(op))
+            size = (self._machine.number_spins + 7) // 8
+            spins = np.empty((len(request["spins"]), size), dtype=np.uint8)
+            for i, x in enumerate(request["spins"]):
+                spins[i] = np.frombuffer(int(x, 16).to_bytes(size, "big"), np.uint8)
+            gradient = bool(request.get("gradient", False))
+            result = await self.evaluate(spins, gradient)
+            if gradient:
+                return {
+                    "id": request_id,
+                    "log_wf": _encode_array(result[0]),
+                    "gradient": _encode_array(result[1]),
+                }
+            return {"id": request_id, "log_wf": _encode_array(result)}
+        except Exception as e:
+            return {"id": request_id, "error": "{}: {}".format(type(e).__name__, e)}
+
+    async def _handle(self, reader, writer):
+        lock = asyncio.Lock()
+        tasks = set()
+
+        async def respond(line):
+            response = (json.dumps(await self._respond(line)) + "\n").encode()
+            async with lock:
+                writer.write(response)
+                await writer.drain()
 
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, path: Optional[str] = None, port: Optional[int] = None):
+        """
+        Listens on the Unix socket ``path`` or on ``localhost:port`` until
+        cancelled.
+        """
+        if (path is None) == (port is None):
+            raise ValueError("Exactly one of path and port must be specified.")
+        self._queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self._batcher())
+        if path is not None:
+            server = await asyncio.start_unix_server(
+                self._handle, path=path, limit=self._LINE_LIMIT
+            )
+            logging.info("Listening on {}...".format(path))
+        else:
+            server = await asyncio.start_server(
+                self._handle, host="127.0.0.1", port=port, limit=self._LINE_LIMIT
+            )
+            logging.info("Listening on 127.0.0.1:{}...".format(port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            if path is not None and os.path.exists(path):
+                os.remove(path)
 
-def import_network(nn_file):
-    module_name, extension = os.path.splitext(os.path.basename(nn_file))
-    module_dir = os.path.dirname(nn_file)
-    if extension != ".py":
-        raise ValueError(
-            "Could not import the network from {}: not a python source file."
+
+class AmplitudeClient(object):
+    """
+    asyncio client for :py:class:`AmplitudeServer`. Requests may be issued
+    concurrently from multiple tasks: they are pipelined over one connection
+    and can thus end up in the same batch on the server.
+
+    Example::
+
+        client = await AmplitudeClient.connect(path="/tmp/psi.sock")
+        log_psi = await client.log_wf(spins)
+        print(await client.statistics())
+        await client.close()
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._pending = {}
+        self._next_id = 0
+        self._reading = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, path: Optional[str] = None, port: Optional[int] = None):
+        """
+        Connects to a server listening on the Unix socket ``path`` or on
+        ``localhost:port``.
+        """
+        if (path is None) == (port is None):
+            raise ValueError("Exactly one of path and port must be specified.")
+        limit = AmplitudeServer._LINE_LIMIT
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path, limit=limit)
+        else:
+            reader, writer = await asyncio.open_connection(
+                "127.0.0.1", port, limit=limit
+            )
+        return cls(reader, writer)
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                response = json.loads(line)
+                future = self._pending.pop(response.get("id"), None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Connection closed."))
+            self._pending.clear()
+
+    async def _request(self, request: dict) -> dict:
+        if self._reading.done():
+            raise ConnectionError("Connection closed.")
+        request["id"] = self._next_id
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request["id"]] = future
+        self._writer.write((json.dumps(request) + "\n").encode())
+        await self._writer.drain()
+        response = await future
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    async def log_wf(self, spins: np.ndarray, gradient: bool = False):
+        """
+        Computes log(ψ) (and ∇log(ψ) if ``gradient`` is true) for every row
+        of ``spins``.
+
+        :param spins: A spin configuration or a 2D array of them.
+        :return: Same as :py:meth:`AmplitudeServer.evaluate`.
+        """
+        spins = np.atleast_2d(np.asarray(spins, dtype=np.float32))
+        response = await self._request(
+            {
+                "op": "log_wf",
+                "spins": [to_bytes(x).tobytes().hex() for x in spins],
+                "gradient": gradient,
+            }
         )
-    # Insert in the beginning
-    sys.path.insert(0, module_dir)
-    module = importlib.import_module(module_name)
-    sys.path.pop(0)
-    return module.Net
+        log_wf = _decode_array(response["log_wf"], np.complex128)
+        if not gradient:
+            return log_wf
+        return (
+            log_wf,
+            _decode_array(response["gradient"], np.complex64).reshape(len(spins), -1),
+        )
+
+    async def statistics(self) -> Dict[str, float]:
+        """
+        Returns server statistics (see :py:meth:`AmplitudeServer.statistics`).
+        """
+        return (await self._request({"op": "stats"}))["stats"]
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._reading
 
 
 def int_to_spin(spin: int, n: int) -> np.ndarray:
@@ -1090,6 +4258,15 @@ def load_explicit(stream):
     return psi, number_spins
 
 
+_COMPILE_HELP = (
+    "Compile the network with TorchScript (torch.jit.script or "
+    "torch.jit.trace) to reduce the overhead of small forward passes. The "
+    "compiled network is checked against eager mode and cached in "
+    "$NQS_CACHE_DIR (~/.cache/nqs_playground by default). If compilation "
+    "fails, eager mode is used."
+)
+
+
 @click.group()
 def cli():
     pass
@@ -1154,7 +4331,25 @@ def cli():
     help="Time interval (in seconds) that specifies how often the model is written "
     "to the output file. If not specified, the weights are saved after every iteration.",
 )
-def train(nn_file, train_file, out_file, in_file, lr, optimizer, epochs, time_limit):
+@click.option(
+    "--compile",
+    "compile_mode",
+    type=click.Choice(["eager", "script", "trace"]),
+    default="eager",
+    show_default=True,
+    help=_COMPILE_HELP,
+)
+def train(
+    nn_file,
+    train_file,
+    out_file,
+    in_file,
+    lr,
+    optimizer,
+    epochs,
+    time_limit,
+    compile_mode,
+):
     """
     Supervised learning.
     """
@@ -1167,6 +4362,8 @@ def train(nn_file, train_file, out_file, in_file, lr, optimizer, epochs, time_li
     if in_file is not None:
         logging.info("Reading the initial weights...")
         psi.load_state_dict(torch.load(in_file))
+    if compile_mode != "eager":
+        compile_network(psi, nn_file, compile_mode)
 
     magnetisation = 0 if number_spins % 2 == 0 else 1
     # NOTE(twesterhout): This is a hack :)
@@ -1252,7 +4449,61 @@ def train(nn_file, train_file, out_file, in_file, lr, optimizer, epochs, time_li
     show_default=True,
     help="Length of the Markov Chain.",
 )
-def sample(nn_file, in_file, out_file, hamiltonian_file, steps):
+@click.option(
+    "--proposal",
+    "proposals",
+    type=str,
+    multiple=True,
+    metavar="<kind>[:<weight>]",
+    help="Proposal kernel for the Metropolis algorithm; may be given multiple "
+    "times to mix kernels with the given relative weights. <kind> is one of "
+    "exchange (default), bond (exchange along an edge of the Hamiltonian), "
+    "multi<N> (exchange N up-down pairs at once) or inversion (flip all "
+    "spins). Per-kernel statistics are logged when kernels are mixed.",
+)
+@click.option(
+    "--replicas",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of replicas for parallel tempering. Replicas sample |ψ|^(2β) "
+    "with a geometric ladder of β's from 1 down to --beta-min and only the β = 1 "
+    "replica is used for estimates. 1 means plain Metropolis.",
+)
+@click.option(
+    "--beta-min",
+    type=click.FloatRange(min=0.0, max=1.0, min_open=True),
+    default=0.1,
+    show_default=True,
+    help="Smallest β for parallel tempering.",
+)
+@click.option(
+    "--swap-every",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of sweeps between replica swap attempts.",
+)
+@click.option(
+    "--compile",
+    "compile_mode",
+    type=click.Choice(["eager", "script", "trace"]),
+    default="eager",
+    show_default=True,
+    help=_COMPILE_HELP,
+)
+def sample(
+    nn_file,
+    in_file,
+    out_file,
+    hamiltonian_file,
+    steps,
+    proposals,
+    replicas,
+    beta_min,
+    swap_every,
+    compile_mode,
+):
     """
     Runs Monte Carlo on a NQS with given architecture and weights. The result
     is an explicit representation of the NQS, i.e. |ψ〉= ∑ψ(S)|S〉where
@@ -1271,6 +4522,8 @@ def sample(nn_file, in_file, out_file, hamiltonian_file, steps):
     H = read_hamiltonian(hamiltonian_file)
     psi = Machine(H.number_spins)
     psi.load_state_dict(torch.load(in_file))
+    if compile_mode != "eager":
+        compile_network(psi, nn_file, compile_mode)
     magnetisation = 0 if psi.number_spins % 2 == 0 else 1
     thermalisation = int(0.1 * steps)
     monte_carlo_steps = (
@@ -1278,8 +4531,28 @@ def sample(nn_file, in_file, out_file, hamiltonian_file, steps):
         (thermalisation + steps) * psi.number_spins,
         psi.number_spins,
     )
+    if proposals and replicas > 1:
+        raise click.UsageError("--proposal cannot be combined with --replicas.")
+    _log_direct_sampling(psi, proposals, replicas)
+    if _supports_direct_sampling(psi):
+        chain = DirectSampler(psi, H)
+    elif replicas > 1:
+        chain = ParallelTemperingMC(
+            psi,
+            random_spin(psi.number_spins, magnetisation),
+            temperature_ladder(replicas, beta_min),
+            H,
+            swap_every=swap_every,
+        )
+    else:
+        chain = MetropolisMC(
+            psi,
+            random_spin(psi.number_spins, magnetisation),
+            H,
+            kernels=make_kernels(proposals, H) if proposals else None,
+        )
     E, var_E, wave_function = monte_carlo_loop_for_lanczos(
-        psi, H, random_spin(psi.number_spins, magnetisation), monte_carlo_steps
+        psi, H, chain, monte_carlo_steps
     )
     # For normalisation
     scale = 1.0 / math.sqrt(sum(map(lambda x: abs(x) ** 2, wave_function.values())))
@@ -1322,7 +4595,31 @@ def sample(nn_file, in_file, out_file, hamiltonian_file, steps):
     show_default=True,
     help="Length of the Markov Chain.",
 )
-def sample_average(nn_file, in_file, hamiltonian_file, steps):
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    help="Number of processes used to normalise the members of the ensemble. "
+    "Defaults to the number of CPUs.",
+)
+@click.option(
+    "--align",
+    "alignments",
+    type=str,
+    multiple=True,
+    help="Spin configuration (as a bit string, 1 meaning spin up) to align the "
+    "members of the ensemble to. May be given multiple times. Defaults to a few "
+    "hard-coded configurations for 12 spins.",
+)
+@click.option(
+    "--reweight",
+    is_flag=True,
+    help="Run a single Markov chain and evaluate all alignments by importance "
+    "reweighting instead of running one chain per alignment.",
+)
+def sample_average(
+    nn_file, in_file, hamiltonian_file, steps, jobs, alignments, reweight
+):
     """
     NOTE: DO NOT USE ME (YET).
     """
@@ -1332,18 +4629,37 @@ def sample_average(nn_file, in_file, hamiltonian_file, steps):
     Net = import_network(nn_file)
     # Machine = _make_machine(Net)
     H = read_hamiltonian(hamiltonian_file)
+    for s in alignments:
+        if len(s) != H.number_spins or not set(s) <= {"0", "1"}:
+            raise click.BadParameter(
+                "expected a bit string of length {}, but got '{}'".format(
+                    H.number_spins, s
+                ),
+                param_hint="--align",
+            )
     magnetisation = 0 if H.number_spins % 2 == 0 else 1
     AverageMachine = _make_machine(AverageNet)
     with open(in_file, "r") as f:
         input_files = map(lambda x: x.strip(), f.readlines())
     psi = AverageMachine(Net, H.number_spins, input_files)
+    if alignments:
+        alignments = [int_to_spin(int(s, base=2), H.number_spins) for s in alignments]
+    elif H.number_spins == 12:
+        alignments = [
+            np.array([1, 1, -1, -1, -1, 1, -1, -1, 1, 1, 1, -1], dtype=np.float32),
+            np.array([1, 1, -1, -1, -1, 1, 1, 1, -1, -1, -1, 1], dtype=np.float32),
+            np.array([1, -1, 1, -1, 1, -1, -1, 1, -1, 1, -1, 1], dtype=np.float32),
+            np.array([1, 1, -1, -1, 1, 1, 1, -1, -1, 1, -1, -1], dtype=np.float32),
+        ]
+    else:
+        raise click.UsageError("--align is required for systems other than 12 spins.")
     thermalisation = int(0.1 * steps)
     monte_carlo_steps = (
         thermalisation * psi.number_spins,
         (thermalisation + steps) * psi.number_spins,
         psi.number_spins,
     )
-    psi.normalise_(monte_carlo_steps, magnetisation)
+    psi.normalise_(monte_carlo_steps, magnetisation, processes=jobs)
 
     monte_carlo_steps = (
         thermalisation * psi.number_spins,
@@ -1351,14 +4667,24 @@ def sample_average(nn_file, in_file, hamiltonian_file, steps):
         psi.number_spins,
     )
     spin_fmt = "{:0" + str(psi.number_spins) + "b}"
-    for magical_spin in [
-        np.array([1, 1, -1, -1, -1, 1, -1, -1, 1, 1, 1, -1], dtype=np.float32),
-        np.array([1, 1, -1, -1, -1, 1, 1, 1, -1, -1, -1, 1], dtype=np.float32),
-        np.array([1, -1, 1, -1, 1, -1, -1, 1, -1, 1, -1, 1], dtype=np.float32),
-        np.array([1, 1, -1, -1, 1, 1, 1, -1, -1, 1, -1, -1], dtype=np.float32),
-    ]:
+    if reweight:
+        results = reweighted_alignments(
+            psi,
+            H,
+            random_spin(psi.number_spins, magnetisation),
+            monte_carlo_steps,
+            alignments,
+        )
+        for magical_spin, (E, var_E, ess) in zip(alignments, results):
+            logging.info(("S = " + spin_fmt).format(int(CompactSpin(magical_spin))))
+            logging.info("    E = {} + {}".format(E.real, E.imag))
+            logging.info("    Var[E] = {}".format(var_E))
+            logging.info("    Effective sample size: {:.1f}".format(ess))
+        return
+    for magical_spin in alignments:
         logging.info(("S = " + spin_fmt).format(int(CompactSpin(magical_spin))))
         psi.align_(magical_spin)
+        psi.clear_cache()
         E, var_E, _ = monte_carlo_loop_for_lanczos(
             psi, H, random_spin(psi.number_spins, magnetisation), monte_carlo_steps
         )
@@ -1433,21 +4759,231 @@ def sample_average(nn_file, in_file, hamiltonian_file, steps):
     show_default=True,
     help="Length of the Markov Chain.",
 )
+@click.option(
+    "--budget",
+    type=click.FloatRange(min=1.0e-10),
+    help="Wall-clock budget for the optimisation in seconds. The length of "
+    "the Markov Chain is adjusted every epoch (within --min-steps and "
+    "--max-steps) based on the measured cost of previous epochs so that all "
+    "--epochs fit into the budget. If they don't fit even with --min-steps, "
+    "fewer epochs are run. The final weights and checkpoint are written "
+    "before the deadline.",
+)
+@click.option(
+    "--min-steps",
+    type=click.IntRange(min=1),
+    help="Shortest Markov Chain allowed with --budget. Defaults to a quarter "
+    "of --steps.",
+)
+@click.option(
+    "--max-steps",
+    type=click.IntRange(min=1),
+    help="Longest Markov Chain allowed with --budget. Defaults to four times "
+    "--steps.",
+)
+@click.option(
+    "--checkpoint",
+    "checkpoint_file",
+    type=click.Path(dir_okay=False, writable=True, resolve_path=True, path_type=str),
+    help="Where to save checkpoints to. A checkpoint contains the weights, the "
+    "state of the optimizer, the cached SR solution, the epoch counter and the "
+    "states of random number generators. It is written whenever the weights are "
+    "saved (see `--time`) and at the end.",
+)
+@click.option(
+    "--checkpoint-every",
+    type=click.IntRange(min=1),
+    help="Additionally write a checkpoint every that many epochs.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Resume the optimisation from the checkpoint file if it exists. This "
+    "takes precedence over `--in-file`.",
+)
+@click.option(
+    "--deduplicate",
+    is_flag=True,
+    help="Collapse the Markov chain into unique spin configurations with visit "
+    "counts. Gradients are computed once per configuration and SR works with "
+    "weighted samples, which is much cheaper when the chain revisits the same "
+    "configurations often.",
+)
+@click.option(
+    "--persistent-chains",
+    is_flag=True,
+    help="Continue the Markov chain from where it stopped in the previous epoch "
+    "instead of starting from a random configuration. Full thermalisation is "
+    "then only done in the first epoch.",
+)
+@click.option(
+    "--rethermalisation",
+    type=click.IntRange(min=0),
+    default=1,
+    show_default=True,
+    help="Number of sweeps discarded at the beginning of every epoch except the "
+    "first one when --persistent-chains is used.",
+)
+@click.option(
+    "--reuse-samples",
+    is_flag=True,
+    help="Reuse configurations sampled in previous epochs by reweighting them "
+    "with |ψ_new/ψ_old|² instead of running Monte Carlo every epoch. Fresh "
+    "samples are only generated when the effective sample size becomes too "
+    "small. Implies --deduplicate.",
+)
+@click.option(
+    "--ess-threshold",
+    type=click.FloatRange(min=0.0, max=1.0),
+    default=0.5,
+    show_default=True,
+    help="Minimal effective sample size (as a fraction of the number of samples) "
+    "for --reuse-samples.",
+)
+@click.option(
+    "--kfac",
+    is_flag=True,
+    help="Precondition gradients with a Kronecker-factored approximation of the "
+    "SR matrix (K-FAC) built per nn.Linear layer instead of using --use-sr. "
+    "Requires a network which accepts batched input.",
+)
+@click.option(
+    "--flat-parameters/--no-flat-parameters",
+    default=False,
+    show_default=True,
+    help="Store all weights and their gradients in two contiguous buffers so "
+    "that gradients are read and written as one array.",
+)
+@click.option(
+    "--proposal",
+    "proposals",
+    type=str,
+    multiple=True,
+    metavar="<kind>[:<weight>]",
+    help="Proposal kernel for the Metropolis algorithm; may be given multiple "
+    "times to mix kernels with the given relative weights. <kind> is one of "
+    "exchange (default), bond (exchange along an edge of the Hamiltonian), "
+    "multi<N> (exchange N up-down pairs at once) or inversion (flip all "
+    "spins). Per-kernel statistics are logged when kernels are mixed.",
+)
+@click.option(
+    "--replicas",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of replicas for parallel tempering. Replicas sample |ψ|^(2β) "
+    "with a geometric ladder of β's from 1 down to --beta-min and only the β = 1 "
+    "replica is used for estimates. 1 means plain Metropolis.",
+)
+@click.option(
+    "--beta-min",
+    type=click.FloatRange(min=0.0, max=1.0, min_open=True),
+    default=0.1,
+    show_default=True,
+    help="Smallest β for parallel tempering.",
+)
+@click.option(
+    "--swap-every",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Number of sweeps between replica swap attempts.",
+)
+@click.option(
+    "--compile",
+    "compile_mode",
+    type=click.Choice(["eager", "script", "trace"]),
+    default="eager",
+    show_default=True,
+    help=_COMPILE_HELP,
+)
+@click.option(
+    "--distributed",
+    is_flag=True,
+    help="Run as one process of a distributed job using torch.distributed with "
+    "the gloo backend. Launch with torchrun (or set RANK, WORLD_SIZE, "
+    "MASTER_ADDR and MASTER_PORT). Every process samples --steps "
+    "configurations, statistics and SR are computed over all of them, and only "
+    "rank 0 writes the weights and checkpoints. Cannot be combined with --kfac "
+    "or --reuse-samples.",
+)
 def optimise(
-    nn_file, in_file, out_file, hamiltonian_file, use_sr, epochs, lr, steps, time_limit
+    nn_file,
+    in_file,
+    out_file,
+    hamiltonian_file,
+    use_sr,
+    epochs,
+    lr,
+    steps,
+    time_limit,
+    budget,
+    min_steps,
+    max_steps,
+    checkpoint_file,
+    checkpoint_every,
+    resume,
+    deduplicate,
+    persistent_chains,
+    rethermalisation,
+    reuse_samples,
+    ess_threshold,
+    kfac,
+    flat_parameters,
+    proposals,
+    replicas,
+    beta_min,
+    swap_every,
+    compile_mode,
+    distributed,
 ):
     """
     Variational Monte Carlo optimising E.
     """
+    if resume and checkpoint_file is None:
+        raise click.UsageError("--resume requires --checkpoint.")
+    if kfac and reuse_samples:
+        raise click.UsageError("--kfac cannot be combined with --reuse-samples.")
+    if proposals and replicas > 1:
+        raise click.UsageError("--proposal cannot be combined with --replicas.")
+    if distributed and (kfac or reuse_samples):
+        raise click.UsageError(
+            "--distributed cannot be combined with --kfac or --reuse-samples."
+        )
+    if budget is None and (min_steps is not None or max_steps is not None):
+        raise click.UsageError("--min-steps and --max-steps require --budget.")
+    min_steps = min_steps if min_steps is not None else max(1, steps // 4)
+    max_steps = max_steps if max_steps is not None else 4 * steps
+    if min_steps > max_steps:
+        raise click.UsageError("--min-steps must not exceed --max-steps.")
+    rank = 0
+    if distributed:
+        try:
+            rank, world_size = init_distributed()
+        except ValueError as e:
+            raise click.UsageError(str(e))
+    # Only rank 0 is chatty
     logging.basicConfig(
-        format="[%(asctime)s] [%(levelname)s] %(message)s", level=logging.DEBUG
+        format=(
+            "[%(asctime)s] [%(levelname)s] %(message)s"
+            if not distributed
+            else "[%(asctime)s] [%(levelname)s] [rank {}] %(message)s".format(rank)
+        ),
+        level=logging.DEBUG if rank == 0 else logging.WARNING,
     )
+    if distributed:
+        logging.info("Running with {} processes...".format(world_size))
     Machine = _make_machine(import_network(nn_file))
     H = read_hamiltonian(hamiltonian_file)
     psi = Machine(H.number_spins)
     if in_file is not None:
         logging.info("Reading the weights...")
         psi.load_state_dict(torch.load(in_file))
+    if flat_parameters:
+        psi.flatten_parameters_()
+    if compile_mode != "eager":
+        compile_network(psi, nn_file, compile_mode)
+    _log_direct_sampling(psi, proposals, replicas)
     magnetisation = 0 if psi.number_spins % 2 == 0 else 1
     thermalisation = int(0.1 * steps)
     opt = Optimiser(
@@ -1465,15 +5001,212 @@ def optimise(
         regulariser=lambda i: 100.0 * 0.9 ** i + 0.01,
         model_file=out_file,
         time_limit=time_limit,
+        checkpoint_file=checkpoint_file,
+        checkpoint_every=checkpoint_every,
+        deduplicate=deduplicate,
+        persistent_chains=persistent_chains,
+        rethermalisation=rethermalisation * psi.number_spins,
+        reuse_samples=reuse_samples,
+        ess_threshold=ess_threshold,
+        kfac=kfac,
+        kernels=make_kernels(proposals, H) if proposals else None,
+        betas=temperature_ladder(replicas, beta_min) if replicas > 1 else None,
+        swap_every=swap_every,
+        distributed=distributed,
+        budget=budget,
+        samples_range=(min_steps, max_steps),
     )
+    if resume:
+        if os.path.exists(checkpoint_file):
+            opt.load_checkpoint(torch.load(checkpoint_file))
+        else:
+            logging.warning(
+                "Checkpoint {} does not exist, starting from scratch...".format(
+                    checkpoint_file
+                )
+            )
     opt()
-    print(
-        compute_l2_norm(
-            psi,
-            random_spin(psi.number_spins, magnetisation),
-            (1000, 1000 + 10000 * psi.number_spins, psi.number_spins),
+    if distributed:
+        dist.destroy_process_group()
+    if rank == 0:
+        print(
+            compute_l2_norm(
+                psi,
+                random_spin(psi.number_spins, magnetisation),
+                (1000, 1000 + 10000 * psi.number_spins, psi.number_spins),
+            )
         )
+
+
+@cli.command()
+@click.argument(
+    "nn-file",
+    type=click.Path(exists=True, resolve_path=True, path_type=str),
+    metavar="<arch_file>",
+)
+@click.option(
+    "-i",
+    "--in-file",
+    type=click.File(mode="rb"),
+    required=True,
+    help="File containing the Neural Network weights as a PyTorch `state_dict` "
+    "serialised using `torch.save`.",
+)
+@click.option(
+    "-n",
+    "--number-spins",
+    type=click.IntRange(min=1),
+    required=True,
+    help="Number of spins the network was constructed for.",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    type=click.Path(dir_okay=False, path_type=str),
+    help="Unix socket to listen on.",
+)
+@click.option(
+    "--port",
+    type=click.IntRange(min=1, max=65535),
+    help="TCP port to listen on (on localhost only).",
+)
+@click.option(
+    "--max-batch",
+    type=click.IntRange(min=1),
+    default=1024,
+    show_default=True,
+    help="Number of configurations at which a batch is evaluated immediately.",
+)
+@click.option(
+    "--max-delay",
+    type=click.FloatRange(min=0.0),
+    default=2.0,
+    show_default=True,
+    help="Latency deadline in milliseconds: a request never waits longer than "
+    "this for other requests to join its batch.",
+)
+@click.option(
+    "--compile",
+    "compile_mode",
+    type=click.Choice(["eager", "script", "trace"]),
+    default="eager",
+    show_default=True,
+    help=_COMPILE_HELP,
+)
+def serve(
+    nn_file,
+    in_file,
+    number_spins,
+    socket_path,
+    port,
+    max_batch,
+    max_delay,
+    compile_mode,
+):
+    """
+    Loads a NQS once and serves log(ψ) and ∇log(ψ) to clients connected over a
+    Unix socket or a localhost TCP port. Concurrent requests are evaluated in
+    batches. See `AmplitudeServer` for the protocol and `AmplitudeClient` for
+    an asyncio client.
+    """
+    if (socket_path is None) == (port is None):
+        raise click.UsageError("Exactly one of --socket and --port is required.")
+    logging.basicConfig(
+        format="[%(asctime)s] [%(levelname)s] %(message)s", level=logging.DEBUG
+    )
+    Machine = _make_machine(import_network(nn_file))
+    psi = Machine(number_spins)
+    psi.load_state_dict(torch.load(in_file))
+    if compile_mode != "eager":
+        compile_network(psi, nn_file, compile_mode)
+    server = AmplitudeServer(psi, max_batch=max_batch, max_delay=1e-3 * max_delay)
+
+    async def run():
+        # Shuts down cleanly (removing the socket file) on SIGINT and SIGTERM
+        task = asyncio.ensure_future(server.serve(path=socket_path, port=port))
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+    logging.info(
+        "Served {requests} requests ({configurations} configurations) in "
+        "{batches} batches".format(**server.statistics())
+    )
+
+
+@cli.command(name="lattice")
+@click.argument("spec", type=str, metavar="<kind>:<extents>")
+@click.option(
+    "-o",
+    "--out-file",
+    type=click.File(mode="w"),
+    default=sys.stdout,
+    show_default=True,
+    help="Where to write the Hamiltonian to.",
+)
+@click.option(
+    "--coupling",
+    type=float,
+    default=1.0,
+    show_default=True,
+    help="Exchange coupling J.",
+)
+def make_lattice(spec, out_file, coupling):
+    """
+    Generates the Heisenberg Hamiltonian on a lattice with periodic boundary
+    conditions in the format expected by `--hamiltonian`. <kind> is one of
+    chain, square, triangular or kagome; <extents> is the number of sites (for
+    a chain) or unit cells along each direction, e.g. `chain:24`, `square:4x4`
+    or `kagome:2x2`.
+    """
+    try:
+        edges = lattice.from_spec(spec)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    lattice.write_hamiltonian(out_file, edges, coupling)
+
+
+@cli.command()
+@click.argument(
+    "nn-file",
+    type=click.Path(exists=True, resolve_path=True, path_type=str),
+    metavar="[<arch_file>]",
+    required=False,
+)
+def warmup(nn_file):
+    """
+    Compiles all numba kernels and stores them in the on-disk cache so that
+    later invocations (e.g. a job array of `sample` runs) start quickly. Run
+    it once before submitting the jobs. If the package directory is not
+    writable, point NUMBA_CACHE_DIR to a shared writable location for both
+    this command and the jobs.
+
+    If <arch_file> is given, the network is also imported and evaluated once.
+    """
+    logging.basicConfig(
+        format="[%(asctime)s] [%(levelname)s] %(message)s", level=logging.INFO
     )
+    start = time.time()
+    # Kernels with explicit signatures are compiled (or loaded from the cache)
+    # at import time. Calling them is just a sanity check.
+    from nqs_playground import functional
+
+    spin = random_spin(8, 0)
+    assert np.array_equal(from_bytes(to_bytes(spin).tobytes(), spin.size), spin)
+    flipper = _Flipper(spin)
+    for _ in range(2 * spin.size):
+        flipper.next(True)
+    z = torch.zeros(4, dtype=torch.float32, requires_grad=True)
+    functional.logcosh(z).backward(torch.ones_like(z))
+    if nn_file is not None:
+        psi = _make_machine(import_network(nn_file))(spin.size)
+        psi.der_log_wf(spin)
+    logging.info("Done in {:.2f} seconds!".format(time.time() - start))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,162 @@
+# Copyright Tom Westerhout (c) 2018
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of Tom Westerhout nor the names of other
+#       contributors may be used to endorse or promote products derived
+#       from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from typing import Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class _MaskedLinear(nn.Linear):
+    """
+    Dense layer whose weight matrix is multiplied elementwise by a constant
+    binary mask.
+    """
+
+    def __init__(self, mask: torch.Tensor):
+        out_features, in_features = mask.size()
+        super().__init__(in_features, out_features, bias=True)
+        self.register_buffer("mask", mask.to(torch.float32))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(x, self.weight * self.mask, self.bias)
+
+
+class Net(nn.Module):
+    """
+    Autoregressive ansatz: |ψ(S)|² = ∏ᵢ p(Sᵢ | S₁, ..., Sᵢ₋₁).
+
+    The conditionals are computed by a masked dense network (MADE) with one
+    hidden layer, so all of them are obtained in a single forward pass. The
+    magnetisation is built in: whenever the remaining spins are fully
+    determined by it, the corresponding conditionals are 0 or 1. Hence |ψ|²
+    is exactly normalised on the sector with the given magnetisation and
+    configurations can be sampled from it directly (see :py:meth:`sample`)
+    instead of running a Markov chain.
+
+    The phase is a linear function of the spins, which is enough to express
+    the Marshall sign rule.
+    """
+
+    def __init__(self, n: int, magnetisation: Optional[int] = None):
+        """
+        Constructs a new network for ``n`` spins. ``magnetisation`` defaults
+        to 0 for even and to 1 for odd ``n``.
+        """
+        if n < 1:
+            raise ValueError("Number of spins must be positive, but got {}".format(n))
+        if magnetisation is None:
+            magnetisation = 0 if n % 2 == 0 else 1
+        if abs(magnetisation) > n or (n + magnetisation) % 2 != 0:
+            raise ValueError("Invalid magnetisation: {}".format(magnetisation))
+        super().__init__()
+        self._number_spins = n
+        self._number_ups = (n + magnetisation) // 2
+
+        # NOTE: Feel free to tune alpha for your needs
+        alpha = 4
+
+        # Hidden unit h depends on spins 0, ..., degree[h] and conditional i
+        # depends on hidden units with degree < i.
+        degrees = torch.arange(alpha * n) % max(n - 1, 1)
+        sites = torch.arange(n)
+        self._hidden = _MaskedLinear(sites[None, :] <= degrees[:, None])
+        self._conditionals = _MaskedLinear(degrees[None, :] < sites[:, None])
+        self._phase = nn.Linear(n, 1, bias=False)
+        nn.init.normal_(self._conditionals.weight, std=1e-2)
+        nn.init.zeros_(self._conditionals.bias)
+        nn.init.normal_(self._phase.weight, std=1e-2)
+        # Number of spins left when site i is reached, i.e. n - i
+        self.register_buffer("_remaining", torch.arange(n, 0, -1))
+
+    def _logits(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Returns logits of p(Sᵢ = ↑ | S₁, ..., Sᵢ₋₁) for all i.
+        """
+        return self._conditionals(torch.tanh(self._hidden(x)))
+
+    def _forced(
+        self, ups_before: torch.Tensor, remaining: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Given the number of up spins among S₁, ..., Sᵢ₋₁ and the number of
+        spins left (including Sᵢ) returns masks telling whether Sᵢ must be up
+        or down to satisfy the magnetisation constraint.
+        """
+        needed = self._number_ups - ups_before
+        return needed == remaining, needed == 0
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the forward propagation. ``x`` is either a single spin
+        configuration or a batch of them.
+        """
+        logits = self._logits(x)
+        up = x > 0
+        log_p = torch.where(up, F.logsigmoid(logits), F.logsigmoid(-logits))
+        ups = up.to(torch.int64)
+        forced_up, forced_down = self._forced(
+            torch.cumsum(ups, dim=-1) - ups, self._remaining
+        )
+        log_p = torch.where(forced_up | forced_down, torch.zeros_like(log_p), log_p)
+        return torch.cat(
+            [0.5 * log_p.sum(dim=-1, keepdim=True), self._phase(x)], dim=-1
+        )
+
+    def sample(self, batch_size: int) -> torch.Tensor:
+        """
+        Draws ``batch_size`` independent spin configurations from |ψ|² using
+        ancestral sampling, i.e. sites are sampled one after another from the
+        conditionals. This requires ``number_spins`` batched forward passes.
+
+        :return: ``(batch_size, number_spins)`` tensor of ±1's.
+        """
+        n = self._number_spins
+        with torch.no_grad():
+            x = torch.zeros(batch_size, n)
+            ups = torch.zeros(batch_size, dtype=torch.int64)
+            for i in range(n):
+                p = torch.sigmoid(self._logits(x)[:, i])
+                forced_up, forced_down = self._forced(ups, self._remaining[i])
+                p = torch.where(forced_up, torch.ones_like(p), p)
+                p = torch.where(forced_down, torch.zeros_like(p), p)
+                up = torch.rand(batch_size) < p
+                x[:, i] = 2 * up.to(torch.float32) - 1
+                ups += up.to(torch.int64)
+        return x
+
+    @property
+    def number_spins(self) -> int:
+        """
+        Returns the number of spins the network expects as input.
+        """
+        return self._number_spins
@@ -13,6 +13,7 @@ from torch.autograd import Function
     ],
     nopython=True,
     fastmath=True,
+    cache=True,
 )
 def _log_cosh_forward_impl(z, out, tanh_x):
     """
@@ -43,6 +44,7 @@ def _log_cosh_forward_impl(z, out, tanh_x):
     ],
     nopython=True,
     fastmath=True,
+    cache=True,
 )
 def _log_cosh_backward_impl(dz, out, tanh_x, tan_y):
     """
@@ -93,7 +95,7 @@ class _LogCosh(Function):
             )
 
         # To make sure we're not computing derivatives.
-        z = z.detach()
+        z = z.detach().contiguous()
         # x := Re[z]
         x = z.view(-1, 2)[:, 0]
         # y := Im[z]
@@ -102,9 +104,10 @@ class _LogCosh(Function):
         # backward passes.
         tanh_x = torch.tanh(x)
         out = torch.empty(z.size(), dtype=z.dtype, requires_grad=False)
+        # NOTE: Kernels operate on 1D arrays, so batches are flattened.
         _log_cosh_forward_impl(
-            z.numpy().view(dtype=complex_type),
-            out.numpy().view(dtype=complex_type),
+            z.numpy().reshape(-1).view(dtype=complex_type),
+            out.numpy().reshape(-1).view(dtype=complex_type),
             tanh_x.numpy(),
         )
         ctx.save_for_backward(z, tanh_x)
@@ -147,8 +150,8 @@ class _LogCosh(Function):
         tan_y = torch.tan(y)
         out = torch.empty(z.size(), dtype=z.dtype, requires_grad=False)
         _log_cosh_backward_impl(
-            dz.detach().numpy().view(dtype=complex_type),
-            out.numpy().view(dtype=complex_type),
+            dz.detach().contiguous().numpy().reshape(-1).view(dtype=complex_type),
+            out.numpy().reshape(-1).view(dtype=complex_type),
             tanh_x.numpy(),
             tan_y.numpy(),
         )
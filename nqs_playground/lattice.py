@@ -0,0 +1,214 @@
+# Copyright Tom Westerhout (c) 2018
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of Tom Westerhout nor the names of other
+#       contributors may be used to endorse or promote products derived
+#       from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Generators of lattices with periodic boundary conditions. Every generator
+returns a list of edges ``(i, j)`` with ``i < j`` which can be passed to
+:py:class:`nqs_playground.Trial.Heisenberg` directly or written to a file
+using :py:func:`write_hamiltonian`.
+
+NOTE: For very small lattices periodic boundary conditions may map two
+different bonds onto the same pair of sites. Such duplicates are removed,
+i.e. every pair of sites is coupled at most once.
+"""
+
+from typing import List, Tuple
+
+
+def _normalise(edges, number_sites: int) -> List[Tuple[int, int]]:
+    """
+    Sorts the endpoints of every edge, removes self-loops and duplicates while
+    preserving the order in which the edges were generated.
+    """
+    seen = set()
+    result = []
+    for i, j in edges:
+        assert 0 <= i < number_sites and 0 <= j < number_sites
+        if i == j:
+            continue
+        edge = (min(i, j), max(i, j))
+        if edge not in seen:
+            seen.add(edge)
+            result.append(edge)
+    return result
+
+
+def _check_extent(*extents):
+    for l in extents:
+        if l < 1:
+            raise ValueError("Invalid lattice extent: {}".format(l))
+
+
+def chain(n: int) -> List[Tuple[int, int]]:
+    """
+    Returns the edges of a periodic chain of ``n`` sites.
+    """
+    _check_extent(n)
+    return _normalise(((i, (i + 1) % n) for i in range(n)), n)
+
+
+def square(lx: int, ly: int) -> List[Tuple[int, int]]:
+    """
+    Returns the edges of a periodic ``lx × ly`` square lattice. Site ``(x, y)``
+    has index ``x + lx * y``.
+    """
+    _check_extent(lx, ly)
+    index = lambda x, y: (x % lx) + lx * (y % ly)
+    edges = []
+    for y in range(ly):
+        for x in range(lx):
+            edges.append((index(x, y), index(x + 1, y)))
+            edges.append((index(x, y), index(x, y + 1)))
+    return _normalise(edges, lx * ly)
+
+
+def triangular(lx: int, ly: int) -> List[Tuple[int, int]]:
+    """
+    Returns the edges of a periodic ``lx × ly`` triangular lattice with
+    primitive vectors a₁ = (1, 0) and a₂ = (1/2, √3/2). Site ``x·a₁ + y·a₂``
+    has index ``x + lx * y``.
+    """
+    _check_extent(lx, ly)
+    index = lambda x, y: (x % lx) + lx * (y % ly)
+    edges = []
+    for y in range(ly):
+        for x in range(lx):
+            edges.append((index(x, y), index(x + 1, y)))
+            edges.append((index(x, y), index(x, y + 1)))
+            edges.append((index(x, y), index(x - 1, y + 1)))
+    return _normalise(edges, lx * ly)
+
+
+def kagome(lx: int, ly: int) -> List[Tuple[int, int]]:
+    """
+    Returns the edges of a periodic kagome lattice of ``lx × ly`` unit cells.
+    Every unit cell contains three sites A = 0, B = a₁/2 and C = a₂/2 (with the
+    primitive vectors of the underlying triangular lattice a₁ and a₂). Site
+    ``s ∈ {0, 1, 2}`` of cell ``(x, y)`` has index ``3 * (x + lx * y) + s``.
+    """
+    _check_extent(lx, ly)
+    index = lambda x, y, s: 3 * ((x % lx) + lx * (y % ly)) + s
+    edges = []
+    for y in range(ly):
+        for x in range(lx):
+            a, b, c = index(x, y, 0), index(x, y, 1), index(x, y, 2)
+            # "Up" triangle
+            edges.append((a, b))
+            edges.append((a, c))
+            edges.append((b, c))
+            # "Down" triangle
+            edges.append((b, index(x + 1, y, 0)))
+            edges.append((c, index(x, y + 1, 0)))
+            edges.append((b, index(x + 1, y - 1, 2)))
+    return _normalise(edges, 3 * lx * ly)
+
+
+LATTICES = {
+    "chain": chain,
+    "square": square,
+    "triangular": triangular,
+    "kagome": kagome,
+}
+
+
+def _parse_spec(spec: str) -> Tuple[str, Tuple[int, ...]]:
+    """
+    Splits a lattice specification (see :py:func:`from_spec`) into the kind
+    and the extents.
+    """
+    try:
+        kind, extents = spec.split(":")
+        if kind not in LATTICES:
+            raise KeyError(kind)
+        return kind, tuple(int(l) for l in extents.split("x"))
+    except (KeyError, ValueError) as e:
+        raise ValueError(
+            "Invalid lattice specification '{}': expected <kind>:<extents> "
+            "where <kind> is one of {}.".format(spec, ", ".join(LATTICES))
+        ) from e
+
+
+def from_spec(spec: str) -> List[Tuple[int, int]]:
+    """
+    Constructs a lattice from a short textual specification such as
+    ``"chain:24"``, ``"square:4x4"`` or ``"kagome:2x2"``.
+    """
+    kind, extents = _parse_spec(spec)
+    try:
+        return LATTICES[kind](*extents)
+    except TypeError as e:
+        raise ValueError(
+            "Invalid lattice specification '{}': wrong number of extents.".format(spec)
+        ) from e
+
+
+def translations(spec: str) -> List[List[int]]:
+    """
+    Returns all translations of the lattice ``spec`` (see :py:func:`from_spec`)
+    as permutations of sites: translation ``t`` maps site ``i`` to
+    ``translations(spec)[t][i]``. Site indices are the same as in the
+    corresponding generator.
+    """
+    kind, extents = _parse_spec(spec)
+    if len(extents) != (1 if kind == "chain" else 2):
+        raise ValueError(
+            "Invalid lattice specification '{}': wrong number of extents.".format(spec)
+        )
+    _check_extent(*extents)
+    # Number of sites per unit cell
+    cell = 3 if kind == "kagome" else 1
+    lx, ly = extents if len(extents) == 2 else (extents[0], 1)
+    index = lambda x, y, s: cell * ((x % lx) + lx * (y % ly)) + s
+    return [
+        [
+            index(x + tx, y + ty, s)
+            for y in range(ly)
+            for x in range(lx)
+            for s in range(cell)
+        ]
+        for ty in range(ly)
+        for tx in range(lx)
+    ]
+
+
+def write_hamiltonian(out_file, edges: List[Tuple[int, int]], coupling: float = 1.0):
+    """
+    Writes the Heisenberg Hamiltonian on the lattice ``edges`` to ``out_file``
+    in the format understood by :py:func:`nqs_playground.Trial.read_hamiltonian`.
+    """
+    number_sites = max(map(max, edges)) + 1
+    out_file.write(
+        "# Heisenberg model on {} sites with {} bonds\n".format(
+            number_sites, len(edges)
+        )
+    )
+    out_file.write("{} {}\n".format(coupling, list(edges)))
@@ -29,6 +29,8 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from typing import List, Optional
+
 import torch
 from nqs_playground.functional import logcosh
 
@@ -63,9 +65,87 @@ class Net(torch.nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """
-        Runs the forward propagation.
+        Runs the forward propagation. ``x`` is either a single spin
+        configuration or a batch of them.
+        """
+        y = logcosh(self._dense(x))
+        return y.reshape(*y.size()[:-1], -1, 2).sum(-2)
+
+    @property
+    def number_spins(self) -> int:
+        """
+        Returns the number of spins the network expects as input.
+        """
+        return self._number_spins
+
+
+class SymmetricNet(torch.nn.Module):
+    """
+    Complex RBM with hidden units shared across a group of lattice symmetries
+    (e.g. translations), i.e. a "convolutional" RBM.
+
+    Every filter is applied to all symmetry-transformed copies of the input,
+    so ``α`` filters give ``α·|G|`` complex hidden units but only ``α·(n + 1)``
+    complex parameters (compared to ``α·n·(n + 1)`` in :py:class:`Net`).
+
+    The command-line interface looks for ``Net`` in the architecture file, so
+    to use it on e.g. a square lattice write::
+
+        from nqs_playground import lattice, rbm
+
+        class Net(rbm.SymmetricNet):
+            def __init__(self, n):
+                super().__init__(n, lattice.translations("square:4x4"))
+    """
+
+    def __init__(self, n: int, permutations: Optional[List[List[int]]] = None):
+        """
+        Constructs a new symmetric RBM given the number of spins ``n``.
+
+        :param permutations: Symmetry group as a list of permutations of
+            ``range(n)`` (see e.g. :py:func:`nqs_playground.lattice.translations`).
+            Defaults to the translations of a periodic chain.
+        """
+        if n < 1:
+            raise ValueError("Number of spins must be positive, but got {}".format(n))
+        super().__init__()
+        self._number_spins = n
+        if permutations is None:
+            permutations = [[(i + t) % n for i in range(n)] for t in range(n)]
+        permutations = torch.tensor(permutations, dtype=torch.int64)
+        if permutations.dim() != 2 or permutations.size(1) != n:
+            raise ValueError(
+                "Invalid permutations: expected a list of permutations of {} "
+                "sites, but got a tensor of shape {}".format(
+                    n, tuple(permutations.size())
+                )
+            )
+        expected = torch.arange(n)
+        for p in permutations:
+            if not torch.equal(torch.sort(p)[0], expected):
+                raise ValueError("Invalid permutation: {}".format(p.tolist()))
+        self.register_buffer("_permutations", permutations)
+
+        # NOTE: Feel free to tune alpha for your needs. Unlike in Net, it has
+        # to be an integer: it's the number of complex filters.
+        alpha = 2
+
+        # Extra factor 2 comes from the fact that a complex number is
+        # equivalent to two real numbers.
+        self._filters = torch.nn.Linear(n, 2 * alpha, bias=True)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        Runs the forward propagation. ``x`` is either a single spin
+        configuration or a batch of them.
         """
-        return logcosh(self._dense(x)).reshape(-1, 2).sum(0)
+        number_symmetries, n = self._permutations.size()
+        # Gathers all transformed copies of x at once: (..., |G|, n). All
+        # filters are then applied to them in one matrix-matrix product.
+        xs = x.index_select(-1, self._permutations.view(-1))
+        xs = xs.view(x.size()[:-1] + (number_symmetries, n))
+        y = logcosh(self._filters(xs))
+        return y.reshape(*x.size()[:-1], -1, 2).sum(-2)
 
     @property
     def number_spins(self) -> int: